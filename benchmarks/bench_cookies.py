@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""
+Benchmark how many new session cookies L{CookieInstaller.getSet} can issue
+per second, with L{os.urandom} and with a L{RandomPool}.
+
+Usage: python benchmarks/bench_cookies.py [cookies]
+"""
+
+import os
+import sys
+import time
+
+from twisted.web import http
+
+from webmagic.fakes import DummyChannel
+from webmagic.untwist import CookieInstaller
+from webmagic.randompool import RandomPool
+
+
+def run(secureRandom, cookies):
+	installer = CookieInstaller(secureRandom, '__', '_s')
+	requests = [http.Request(DummyChannel(), None) for i in xrange(cookies)]
+	start = time.time()
+	for request in requests:
+		installer.getSet(request)
+	return cookies / (time.time() - start)
+
+
+def main():
+	cookies = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	for name, secureRandom in [
+		('os.urandom', os.urandom),
+		('RandomPool(4096)', RandomPool(os.urandom, 4096)),
+		('RandomPool(65536)', RandomPool(os.urandom, 65536)),
+	]:
+		print '%-18s %d cookies/s' % (name, run(secureRandom, cookies))
+
+
+if __name__ == '__main__':
+	main()
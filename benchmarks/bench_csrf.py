@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Benchmark L{CsrfStopper}: tokens made and checked per second.  The
+"hmac.new" rows compute each HMAC from scratch, the way CsrfStopper used
+to, for comparison.  Also benchmark L{constantTimeCompare} with and
+without L{hmac.compare_digest}, and check that comparing strings that
+differ in their first byte takes about as long as comparing strings that
+differ in their last byte.
+
+Usage: python benchmarks/bench_csrf.py [tokens]
+"""
+
+import sys
+import time
+import timeit
+import hmac
+import base64
+import hashlib
+
+from webmagic import csrf
+from webmagic.csrf import (
+	CsrfStopper, KeyringCsrfStopper, constantTimeCompare)
+
+
+def rate(f, n):
+	start = time.time()
+	f()
+	return n / (time.time() - start)
+
+
+def timingRatio(n):
+	"""
+	@return: the best time to compare 4096-byte strings that differ in
+		their first byte, divided by the best time for strings that differ
+		in their last byte.
+	"""
+	expected = 'x' * 4096
+	def best(actual):
+		return min(timeit.repeat(
+			lambda: constantTimeCompare(expected, actual), repeat=5, number=n))
+	return best('y' + 'x' * 4095) / best('x' * 4095 + 'y')
+
+
+def main():
+	n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+	secret = 'secret string of a realistic length, 32+ bytes'
+	c = CsrfStopper(secret)
+	uuids = ['%016d' % (i,) for i in xrange(n)]
+	tokens = c.makeTokens(uuids)
+	pairs = zip(uuids, tokens)
+
+	def makeWithHmacNew():
+		for uuid in uuids:
+			base64.urlsafe_b64encode(c.version +
+				hmac.new(secret, uuid, hashlib.sha256).digest()[:16])
+
+	def makeToken():
+		for uuid in uuids:
+			c.makeToken(uuid)
+
+	def makeTokens():
+		c.makeTokens(uuids)
+
+	def checkToken():
+		for uuid, token in pairs:
+			c.checkToken(uuid, token)
+
+	keyring = KeyringCsrfStopper(dict((v, secret + str(v)) for v in xrange(8)), 7)
+	keyringPairs = zip(uuids, keyring.makeTokens(uuids))
+	def checkTokenKeyring():
+		for uuid, token in keyringPairs:
+			keyring.checkToken(uuid, token)
+
+	for name, f in [
+		('makeToken (hmac.new)', makeWithHmacNew),
+		('makeToken', makeToken),
+		('makeTokens', makeTokens),
+		('checkToken', checkToken),
+		('checkToken (keyring)', checkTokenKeyring),
+	]:
+		print '%-22s %d tokens/s' % (name, rate(f, n))
+
+	a = tokens[0]
+	b = tokens[0][:-1] + 'x'
+	def compare():
+		for i in xrange(n):
+			constantTimeCompare(a, b)
+
+	# Early/late ratios far from 1 mean that the comparison leaks where
+	# the strings differ.
+	compareDigest = csrf._compareDigest
+	if compareDigest is not None:
+		print '%-22s %d compares/s' % ('compare_digest', rate(compare, n))
+		print '%-22s %.2f early/late' % ('compare_digest', timingRatio(20000))
+	csrf._compareDigest = None
+	try:
+		print '%-22s %d compares/s' % ('pure Python', rate(compare, n))
+		print '%-22s %.2f early/late' % ('pure Python', timingRatio(20))
+		print '%-22s %d tokens/s' % ('checkToken (pure)', rate(checkToken, n))
+	finally:
+		csrf._compareDigest = compareDigest
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Benchmark L{FileCache} rechecks for an asset tree of many files in a few
+directories: how many rechecks happen on the request path, how many
+C{stat} calls they make, and how long a full sweep of requests takes, with
+per-file fingerprints, with L{defaultDirectoryFingerprint}, and with a
+L{FileCacheRefresher} doing the rechecks between sweeps.
+
+Usage: python benchmarks/bench_filecache_dirs.py [directories] [files-per-directory]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from twisted.internet.task import Clock
+
+from webmagic import filecache
+
+
+class Counter(object):
+
+	def __init__(self, f):
+		self.f = f
+		self.calls = 0
+
+
+	def __call__(self, *args):
+		self.calls += 1
+		return self.f(*args)
+
+
+
+def makeTree(root, directories, files):
+	filenames = []
+	for d in xrange(directories):
+		directory = os.path.join(root, 'd%d' % (d,))
+		os.mkdir(directory)
+		for f in xrange(files):
+			filename = os.path.join(directory, 'f%d.png' % (f,))
+			with open(filename, 'wb') as fh:
+				fh.write('x' * 100)
+			filenames.append(filename)
+	return filenames
+
+
+def run(filenames, batched, background=False, sweeps=5):
+	clock = Clock()
+	fingerprint = Counter(filecache.defaultFingerprint)
+	directoryFingerprint = Counter(filecache.defaultDirectoryFingerprint)
+	fc = filecache.FileCache(clock.seconds, 10,
+		fingerprintCallable=fingerprint,
+		directoryFingerprintCallable=directoryFingerprint if batched else None)
+	for filename in filenames:
+		fc.getContent(filename)
+	fingerprint.calls = 0
+	refresher = None
+	if background:
+		# Enough checks per tick to get through everything in 10 ticks.
+		refresher = filecache.FileCacheRefresher(fc,
+			maxChecksPerTick=len(filenames) // 10 + 1, clock=clock)
+		refresher.start()
+
+	realStat = os.stat
+	stat = os.stat = Counter(realStat)
+	try:
+		order = filenames[:]
+		random.seed(0)
+		elapsed = 0
+		backgroundStats = 0
+		for i in xrange(sweeps):
+			before = stat.calls
+			clock.pump([1] * 10)
+			backgroundStats += stat.calls - before
+			random.shuffle(order)
+			start = time.time()
+			for filename in order:
+				fc.getContent(filename)
+			elapsed += time.time() - start
+	finally:
+		os.stat = realStat
+		if refresher is not None:
+			refresher.stop()
+	return {
+		'rechecks': fingerprint.calls + directoryFingerprint.calls,
+		'requestStats': stat.calls - backgroundStats,
+		'backgroundStats': backgroundStats,
+		'usPerRequest': elapsed / (sweeps * len(filenames)) * 1e6,
+	}
+
+
+def main():
+	directories = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	files = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+	root = tempfile.mkdtemp(prefix='webmagic-bench-')
+	try:
+		filenames = makeTree(root, directories, files)
+		print '%d files in %d directories, 5 sweeps; scandir %s' % (
+			len(filenames), directories,
+			'installed' if filecache._scandir is not None else 'not installed')
+		print '%-14s %8s %14s %17s %11s' % ('', 'rechecks',
+			'request stats', 'background stats', 'us/request')
+		for name, batched, background in [
+			('per-file', False, False),
+			('per-directory', True, False),
+			('background', False, True),
+		]:
+			r = run(filenames, batched, background)
+			print '%-14s %8d %14d %17d %11.2f' % (
+				name, r['rechecks'], r['requestStats'], r['backgroundStats'],
+				r['usPerRequest'])
+	finally:
+		shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+	main()
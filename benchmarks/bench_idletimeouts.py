@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Benchmark idle-timeout bookkeeping in L{BetterSite} with many connections,
+comparing the shared L{TimingWheel} against one L{IDelayedCall} per
+connection.
+
+Usage: python benchmarks/bench_idletimeouts.py [connections] [linesPerConnection]
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+
+from webmagic.fakes import DummyTCPTransport
+from webmagic.untwist import BetterResource, BetterSite
+
+
+def run(timeoutGranularity, connections, lines):
+	site = BetterSite(BetterResource(), timeoutGranularity=timeoutGranularity)
+	channels = []
+
+	start = time.time()
+	for i in xrange(connections):
+		channel = site.buildProtocol(None)
+		channel.makeConnection(DummyTCPTransport())
+		channel.dataReceived('GET / HTTP/1.1\r\n')
+		channels.append(channel)
+	connected = time.time()
+
+	# Every header line resets the idle timeout.
+	for n in xrange(lines):
+		for channel in channels:
+			channel.dataReceived('X-Header: value\r\n')
+	received = time.time()
+
+	pendingCalls = len(reactor.getDelayedCalls())
+
+	for channel in channels:
+		channel.connectionLost(None)
+	lost = time.time()
+
+	return {
+		'connect': connected - start,
+		'reset': received - connected,
+		'resetsPerSecond': connections * lines / (received - connected),
+		'disconnect': lost - received,
+		'pendingDelayedCalls': pendingCalls,
+	}
+
+
+def main():
+	connections = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	lines = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	for name, granularity in [('delayed-calls', None), ('timing-wheel', 1)]:
+		result = run(granularity, connections, lines)
+		print '%-14s connect=%.3fs reset=%.3fs (%d/s) disconnect=%.3fs ' \
+			'pendingDelayedCalls=%d' % (
+				name, result['connect'], result['reset'],
+				result['resetsPerSecond'], result['disconnect'],
+				result['pendingDelayedCalls'])
+
+
+if __name__ == '__main__':
+	main()
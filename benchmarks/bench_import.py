@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the cost of C{import webmagic.untwist} in a fresh interpreter:
+wall time, and the growth of the resident set size (on Linux), and list
+any test-only modules that it imports.
+
+Usage: python benchmarks/bench_import.py [runs] [module]
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+
+CHILD = r"""
+import sys, time, json
+
+def rss():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * %(pageSize)d
+	except (IOError, OSError, ValueError):
+		return None
+
+rssBefore = rss()
+start = time.time()
+__import__(%(module)r)
+elapsed = time.time() - start
+rssAfter = rss()
+print json.dumps({
+	'seconds': elapsed,
+	'rssBytes': None if rssBefore is None else rssAfter - rssBefore,
+	'testModules': sorted(m for m in sys.modules
+		if m is not None and ('fakes' in m or '.test' in m)),
+})
+"""
+
+
+def runOnce(module):
+	code = CHILD % {'module': module, 'pageSize': os.sysconf('SC_PAGE_SIZE')}
+	env = os.environ.copy()
+	env['PYTHONPATH'] = os.pathsep.join(sys.path)
+	out = subprocess.Popen(
+		[sys.executable, '-c', code], env=env,
+		stdout=subprocess.PIPE).communicate()[0]
+	return json.loads(out)
+
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+
+def main():
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 11
+	module = sys.argv[2] if len(sys.argv) > 2 else 'webmagic.untwist'
+	results = [runOnce(module) for i in xrange(runs)]
+	print 'import %s (median of %d runs)' % (module, runs)
+	print '  %-12s %.1f ms' % ('time', median(r['seconds'] for r in results) * 1000)
+	if results[0]['rssBytes'] is not None:
+		print '  %-12s %.1f MB' % (
+			'rss growth', median(r['rssBytes'] for r in results) / 1048576.0)
+	print '  %-12s %s' % ('test modules', ', '.join(results[0]['testModules']) or 'none')
+
+
+if __name__ == '__main__':
+	main()
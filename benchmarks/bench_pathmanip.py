@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Benchmark L{getResourceForPath}, which L{getCacheBrokenHref} and
+L{CSSResource} call for every href: lookups per second, and how many
+objects each lookup request keeps alive, compared to a lookup request
+built from L{webmagic.fakes.DummyRequest} (which builds a L{server.Site}
+and a L{Clock} for every lookup).
+
+Usage: python benchmarks/bench_pathmanip.py [lookups]
+"""
+
+import gc
+import sys
+import time
+from urllib import unquote
+
+from twisted.web import server
+from twisted.web.resource import getChildForRequest
+
+from webmagic.fakes import DummyRequest
+from webmagic.untwist import BetterResource
+from webmagic.pathmanip import makeRequestForPath
+
+
+def makeFakeRequestForPath(site, path):
+	postpath = unquote(path).split('/')
+	postpath.pop(0)
+	request = DummyRequest(postpath)
+	request.path = path
+	request.channel.site = site
+	return request
+
+
+def makeSite():
+	root = node = BetterResource()
+	for name in ['static', 'images', 'icons']:
+		child = BetterResource()
+		node.putChild(name, child)
+		node = child
+	node.putChild('a.png', BetterResource())
+	return server.Site(root)
+
+
+def objectsPerRequest(makeRequest, site, path, n=10000):
+	gc.collect()
+	before = len(gc.get_objects())
+	requests = [makeRequest(site, path) for i in xrange(n)]
+	gc.collect()
+	after = len(gc.get_objects())
+	del requests
+	return (after - before - 1) / float(n)
+
+
+def lookupsPerSecond(makeRequest, site, path, n):
+	root = site.resource
+	start = time.time()
+	for i in xrange(n):
+		getChildForRequest(root, makeRequest(site, path))
+	return n / (time.time() - start)
+
+
+def main():
+	lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	site = makeSite()
+	path = '/static/images/icons/a.png'
+	for name, makeRequest in [
+		('DummyRequest', makeFakeRequestForPath),
+		('makeRequestForPath', makeRequestForPath),
+	]:
+		print '%-20s %8.1f objects/request %10d lookups/s' % (
+			name,
+			objectsPerRequest(makeRequest, site, path),
+			lookupsPerSecond(makeRequest, site, path, lookups))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+An in-process load harness for L{BetterSite}: opens thousands of simulated
+connections (real L{HTTPChannel}s on L{DummyTCPTransport}s, driven by a
+L{Clock}), and measures
+
+*	memory per idle connection (Python objects, and resident set size on
+	Linux),
+
+*	requests per second for short keep-alive requests,
+
+*	requests per second and timer overhead for long-lived
+	L{WaitResource} requests (how many delayed calls are pending, and how
+	long it takes to advance the clock through the wait).
+
+No network or real reactor is involved, so the numbers reflect only the
+connection and request hot paths.
+
+Usage: python benchmarks/loadharness.py [options]
+"""
+
+import gc
+import os
+import json
+import time
+import optparse
+
+from twisted.internet.task import Clock
+
+from webmagic.fakes import DummyTCPTransport
+from webmagic.untwist import BetterResource, BetterSite, ConnectionTrackingSite
+from webmagic.special import WaitResource
+
+
+class OkResource(BetterResource):
+	isLeaf = True
+
+	def render_GET(self, request):
+		return 'ok'
+
+
+
+def getRSS():
+	"""
+	@return: the resident set size of this process in bytes, or C{None}
+		if it is not available.
+	"""
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError, ValueError):
+		return None
+
+
+def makeSite(siteClass, clock, timeoutGranularity):
+	root = BetterResource()
+	root.putChild('ok', OkResource())
+	root.putChild('wait', WaitResource(clock))
+	return siteClass(root, clock=clock, timeoutGranularity=timeoutGranularity)
+
+
+def connect(site, clock, n):
+	channels = []
+	for i in xrange(n):
+		channel = site.buildProtocol(None)
+		# Without a timing wheel, TimeoutMixin schedules on the reactor.
+		channel.callLater = clock.callLater
+		channel.makeConnection(DummyTCPTransport())
+		channels.append(channel)
+	return channels
+
+
+def run(connections=10000, requestsPerConnection=5, waitSeconds=30,
+siteClass=BetterSite, timeoutGranularity=None):
+	clock = Clock()
+	site = makeSite(siteClass, clock, timeoutGranularity)
+	result = {
+		'site': siteClass.__name__,
+		'timeoutGranularity': timeoutGranularity,
+		'connections': connections,
+	}
+
+	gc.collect()
+	objectsBefore = len(gc.get_objects())
+	rssBefore = getRSS()
+	start = time.time()
+	channels = connect(site, clock, connections)
+	result['connectsPerSecond'] = connections / (time.time() - start)
+	gc.collect()
+	result['objectsPerConnection'] = \
+		(len(gc.get_objects()) - objectsBefore) / float(connections)
+	rssAfter = getRSS()
+	if rssBefore is not None and rssAfter is not None:
+		result['rssBytesPerConnection'] = \
+			(rssAfter - rssBefore) / float(connections)
+	result['idleDelayedCalls'] = len(clock.getDelayedCalls())
+
+	# Short keep-alive requests
+	okRequest = 'GET /ok HTTP/1.1\r\nHost: example.com\r\n\r\n'
+	start = time.time()
+	for i in xrange(requestsPerConnection):
+		for channel in channels:
+			channel.dataReceived(okRequest)
+			channel.transport.clear()
+	elapsed = time.time() - start
+	result['shortRequestsPerSecond'] = \
+		connections * requestsPerConnection / elapsed
+
+	# Long-lived requests
+	waitRequest = 'GET /wait?wait=%d HTTP/1.1\r\nHost: example.com\r\n\r\n' % (
+		waitSeconds,)
+	start = time.time()
+	for channel in channels:
+		channel.dataReceived(waitRequest)
+	result['waitRequestsStartedPerSecond'] = connections / (time.time() - start)
+	result['waitingDelayedCalls'] = len(clock.getDelayedCalls())
+
+	start = time.time()
+	clock.pump([1] * (waitSeconds + 2))
+	result['waitDrainSeconds'] = time.time() - start
+	result['waitRequestsFinished'] = sum(
+		1 for channel in channels if 'GIF89a' in channel.transport.value())
+
+	start = time.time()
+	for channel in channels:
+		channel.connectionLost(None)
+	result['disconnectsPerSecond'] = connections / (time.time() - start)
+	result['leftoverDelayedCalls'] = len(clock.getDelayedCalls())
+	return result
+
+
+def main():
+	parser = optparse.OptionParser(usage=__doc__.strip().splitlines()[-1])
+	parser.add_option('-c', '--connections', type='int', default=10000)
+	parser.add_option('-r', '--requests', type='int', default=5,
+		help='short requests per connection')
+	parser.add_option('-w', '--wait', type='int', default=30,
+		help='seconds each WaitResource request waits')
+	parser.add_option('--tracking', action='store_true',
+		help='use ConnectionTrackingSite instead of BetterSite')
+	parser.add_option('--wheel', action='store_true',
+		help='keep idle timeouts in a timing wheel')
+	parser.add_option('--json', action='store_true',
+		help='print the results as JSON')
+	options, args = parser.parse_args()
+
+	result = run(
+		connections=options.connections,
+		requestsPerConnection=options.requests,
+		waitSeconds=options.wait,
+		siteClass=ConnectionTrackingSite if options.tracking else BetterSite,
+		timeoutGranularity=1 if options.wheel else None)
+	if options.json:
+		print json.dumps(result, sort_keys=True)
+	else:
+		for k in sorted(result):
+			v = result[k]
+			print '%-30s %s' % (k, '%.2f' % (v,) if isinstance(v, float) else v)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for webmagic's hot paths.
+
+Each benchmark is run in batches of calls, with the batch size calibrated
+so that a batch takes about C{--time} seconds.  The best of C{--repeat}
+batches is reported, as seconds per call.
+
+	python benchmarks/microbench.py                     # run all
+	python benchmarks/microbench.py csrf cookie         # names containing these
+	python benchmarks/microbench.py --json > base.json  # machine-readable
+	python benchmarks/microbench.py --compare base.json # compare to a baseline
+
+With C{--compare}, the exit status is 1 if any benchmark is slower than
+the baseline by more than C{--threshold} percent.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+
+from twisted.internet.task import Clock
+from twisted.web import server, http
+
+from webmagic.fakes import DummyRequest, DummyChannel
+from webmagic.filecache import FileCache
+from webmagic.pathmanip import getCacheBrokenHref, getResourceForPath
+from webmagic.cssfixer import fixUrls
+from webmagic.csrf import CsrfStopper
+from webmagic.randompool import RandomPool
+from webmagic.untwist import (
+	BetterResource, BetterFile, CookieInstaller, ResponseCacheOptions,
+	setDefaultHeadersOnRequest, setCachingHeadersOnRequest)
+
+
+# name -> function(fixture) that returns a 0-arg callable to time
+BENCHMARKS = {}
+
+def benchmark(f):
+	BENCHMARKS[f.__name__] = f
+	return f
+
+
+
+class Fixture(object):
+	"""
+	A temporary directory of static files, served by a site with a
+	L{BetterFile} at /static/.
+	"""
+
+	def __init__(self, images=20):
+		self.dir = tempfile.mkdtemp(prefix='webmagic-microbench-')
+		self.images = ['img%d.png' % (i,) for i in xrange(images)]
+		for name in self.images:
+			self._write(name, ('\x89PNG' + name) * 100)
+		self.css = ''.join(
+			'.c%d { background: url(%s) no-repeat; color: #%06x; }\n' % (
+				i, name, i) for i, name in enumerate(self.images))
+		self._write('style.css', self.css)
+
+		self.clock = Clock()
+		self.fileCache = FileCache(self.clock.seconds, 1)
+		self.root = BetterResource()
+		self.static = BetterFile(
+			self.dir, fileCache=self.fileCache, rewriteCss=True)
+		self.root.putChild('static', self.static)
+		self.site = server.Site(self.root)
+
+
+	def _write(self, name, content):
+		with open(os.path.join(self.dir, name), 'wb') as f:
+			f.write(content)
+
+
+	def path(self, name):
+		return os.path.join(self.dir, name)
+
+
+	def makeRequest(self, path):
+		postpath = path.split('/')[1:]
+		request = DummyRequest(postpath)
+		request.path = path
+		request.channel.site = self.site
+		return request
+
+
+	def close(self):
+		shutil.rmtree(self.dir)
+
+
+
+@benchmark
+def filecache_hit(fx):
+	fc = FileCache(fx.clock.seconds, 1000)
+	filename = fx.path('style.css')
+	fc.getContent(filename)
+	return lambda: fc.getContent(filename)
+
+
+@benchmark
+def filecache_stale_check(fx):
+	"""
+	Every call stats the file, which has not changed.
+	"""
+	fc = FileCache(fx.clock.seconds, 0)
+	filename = fx.path('style.css')
+	fc.getContent(filename)
+	def f():
+		fx.clock.advance(1)
+		fc.getContent(filename)
+	return f
+
+
+@benchmark
+def filecache_miss(fx):
+	filename = fx.path('style.css')
+	def f():
+		FileCache(fx.clock.seconds, 1).getContent(filename)
+	return f
+
+
+@benchmark
+def getCacheBrokenHref_(fx):
+	request = fx.makeRequest('/static/page.html')
+	getCacheBrokenHref(fx.fileCache, request, '/static/img0.png')
+	return lambda: getCacheBrokenHref(fx.fileCache, request, '/static/img0.png')
+
+
+@benchmark
+def getCacheBrokenHref_missing(fx):
+	request = fx.makeRequest('/static/page.html')
+	return lambda: getCacheBrokenHref(fx.fileCache, request, '/static/nope.png')
+
+
+@benchmark
+def getResourceForPath_(fx):
+	return lambda: getResourceForPath(fx.site, '/static/img0.png')
+
+
+@benchmark
+def fixUrls_(fx):
+	request = fx.makeRequest('/static/style.css')
+	fixUrls(fx.fileCache, request, fx.css)
+	return lambda: fixUrls(fx.fileCache, request, fx.css)
+
+
+@benchmark
+def cssresource_render(fx):
+	def f():
+		request = fx.makeRequest('/static/style.css')
+		child = fx.static.getChild('style.css', request)
+		child.render(request)
+	f()
+	return f
+
+
+@benchmark
+def setDefaultHeadersOnRequest_(fx):
+	request = DummyRequest([])
+	return lambda: setDefaultHeadersOnRequest(request)
+
+
+@benchmark
+def setCachingHeadersOnRequest_(fx):
+	request = DummyRequest([])
+	options = ResponseCacheOptions(
+		cacheTime=3600, httpCachePublic=True, httpsCachePublic=False)
+	return lambda: setCachingHeadersOnRequest(request, options)
+
+
+def _makeDeepTree(depth):
+	root = node = BetterResource()
+	segments = []
+	for i in xrange(depth):
+		child = BetterResource()
+		name = 'level%d' % (i,)
+		node.putChild(name, child)
+		segments.append(name)
+		node = child
+	# So that walking to .../levelN/ finds a resource instead of a 404.
+	node.putChild('', BetterResource())
+	return root, segments
+
+
+class _WalkRequest(object):
+	"""
+	Just enough of a request for L{BetterResource.getChildWithDefault},
+	so that the walk benchmarks don't mostly time building a
+	L{DummyRequest} (which builds a site and a clock).
+	"""
+	__slots__ = ('uri', 'prepath', 'postpath')
+
+	def __init__(self, segments):
+		self.uri = '/' + '/'.join(segments)
+		self.prepath = []
+		self.postpath = []
+
+
+
+def _walker(root, segments):
+	request = _WalkRequest(segments)
+	def walk():
+		request.prepath = []
+		request.postpath = postpath = list(segments)
+		res = root
+		while postpath and not res.isLeaf:
+			name = postpath.pop(0)
+			request.prepath.append(name)
+			res = res.getChildWithDefault(name, request)
+		return res
+	return walk
+
+
+@benchmark
+def betterresource_walk_depth3(fx):
+	root, segments = _makeDeepTree(3)
+	return _walker(root, segments + [''])
+
+
+@benchmark
+def betterresource_walk_depth10(fx):
+	root, segments = _makeDeepTree(10)
+	return _walker(root, segments + [''])
+
+
+@benchmark
+def cookie_getSet_existing(fx):
+	installer = CookieInstaller(os.urandom, '__', '_s')
+	request = http.Request(DummyChannel(), None)
+	request.received_cookies['__'] = 'A' * 22 + '=='
+	return lambda: installer.getSet(request)
+
+
+def _newCookieSetter(secureRandom):
+	"""
+	Time issuing a new cookie on one request that is reused, like
+	bench_cookies.py, so that building a L{DummyChannel} (a site and a
+	clock) isn't timed.
+	"""
+	installer = CookieInstaller(secureRandom, '__', '_s')
+	request = http.Request(DummyChannel(), None)
+	cookies = request.cookies
+	def f():
+		del cookies[:]
+		installer.getSet(request)
+	return f
+
+
+@benchmark
+def cookie_getSet_new(fx):
+	return _newCookieSetter(os.urandom)
+
+
+@benchmark
+def cookie_getSet_new_pool(fx):
+	return _newCookieSetter(RandomPool())
+
+
+@benchmark
+def csrf_makeToken(fx):
+	stopper = CsrfStopper('secret string of a realistic length, 32+ bytes')
+	return lambda: stopper.makeToken('0123456789abcdef')
+
+
+@benchmark
+def csrf_checkToken(fx):
+	stopper = CsrfStopper('secret string of a realistic length, 32+ bytes')
+	token = stopper.makeToken('0123456789abcdef')
+	return lambda: stopper.checkToken('0123456789abcdef', token)
+
+
+
+def timeCall(f, targetTime, repeat):
+	"""
+	@return: the best seconds per call of C{f}, over C{repeat} batches
+		that each take about C{targetTime} seconds.
+	"""
+	loops = 1
+	while True:
+		start = time.time()
+		for i in xrange(loops):
+			f()
+		elapsed = time.time() - start
+		if elapsed >= targetTime / 10.0:
+			break
+		loops *= 10
+	loops = max(1, int(loops * targetTime / max(elapsed, 1e-9)))
+
+	best = None
+	for r in xrange(repeat):
+		start = time.time()
+		for i in xrange(loops):
+			f()
+		perCall = (time.time() - start) / loops
+		if best is None or perCall < best:
+			best = perCall
+	return best, loops
+
+
+def runBenchmarks(names, targetTime, repeat):
+	fx = Fixture()
+	results = {}
+	try:
+		for name in names:
+			perCall, loops = timeCall(BENCHMARKS[name](fx), targetTime, repeat)
+			results[name] = {
+				'secondsPerCall': perCall,
+				'callsPerSecond': 1 / perCall,
+				'loops': loops,
+			}
+	finally:
+		fx.close()
+	return results
+
+
+def compare(results, baseline, threshold):
+	"""
+	Print a comparison of C{results} against C{baseline}.
+
+	@return: a C{list} of the names of benchmarks that were slower than
+		the baseline by more than C{threshold} percent.
+	"""
+	regressions = []
+	print '%-32s %12s %12s %8s' % ('benchmark', 'baseline', 'now', 'change')
+	for name in sorted(results):
+		now = results[name]['secondsPerCall']
+		if name not in baseline:
+			print '%-32s %12s %12.3gs %8s' % (name, '-', now, 'new')
+			continue
+		before = baseline[name]['secondsPerCall']
+		change = (now - before) / before * 100
+		flag = ''
+		if change > threshold:
+			regressions.append(name)
+			flag = '  SLOWER'
+		print '%-32s %11.3gs %11.3gs %+7.1f%%%s' % (
+			name, before, now, change, flag)
+	return regressions
+
+
+def main():
+	parser = optparse.OptionParser(usage=__doc__.strip().split('\n\n')[1])
+	parser.add_option('--time', type='float', default=0.2,
+		help='approximate seconds per batch [default: %default]')
+	parser.add_option('--repeat', type='int', default=5,
+		help='number of batches [default: %default]')
+	parser.add_option('--json', action='store_true',
+		help='print the results as JSON')
+	parser.add_option('--compare', metavar='BASELINE.json',
+		help='compare against results saved with --json')
+	parser.add_option('--threshold', type='float', default=10,
+		help='percent slowdown that counts as a regression [default: %default]')
+	parser.add_option('--list', action='store_true',
+		help='list the benchmarks and exit')
+	options, args = parser.parse_args()
+
+	names = sorted(BENCHMARKS)
+	if options.list:
+		print '\n'.join(names)
+		return 0
+	if args:
+		names = [n for n in names if any(a in n for a in args)]
+
+	results = runBenchmarks(names, options.time, options.repeat)
+	if options.json:
+		print json.dumps(results, indent=1, sort_keys=True)
+	elif options.compare:
+		with open(options.compare) as f:
+			baseline = json.load(f)
+		if compare(results, baseline, options.threshold):
+			return 1
+	else:
+		for name in names:
+			r = results[name]
+			print '%-32s %11.3gs %12d/s' % (
+				name, r['secondsPerCall'], r['callsPerSecond'])
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,230 @@
+"""
+An access log writer that batches lines in memory and writes them from a
+background thread, so that a slow disk never blocks the reactor.
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.web.http import datetimeToLogString
+
+_postImportVars = vars().keys()
+
+
+class CachedTimestamp(object):
+	"""
+	Formats the current time at most once per second.
+	"""
+	__slots__ = ('_clock', '_formatTime', '_second', '_formatted')
+
+	def __init__(self, clock, formatTime):
+		"""
+		@param clock: an L{IReactorTime} provider.
+
+		@param formatTime: a 1-arg callable that takes an C{int} number of
+			seconds since the epoch and returns a C{str}.
+		"""
+		self._clock = clock
+		self._formatTime = formatTime
+		self._second = None
+		self._formatted = None
+
+
+	def __call__(self):
+		second = int(self._clock.seconds())
+		if second != self._second:
+			self._formatted = self._formatTime(second)
+			self._second = second
+		return self._formatted
+
+
+
+def _escape(s):
+	# Like HTTPFactory._escape: a Python repr, but always escaped as if the
+	# surrounding quotes were "".
+	r = repr(s)
+	if r[0] == "'":
+		return r[1:-1].replace('"', '\\"').replace("\\'", "'")
+	return r[1:-1]
+
+
+def _formatISOTime(seconds):
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def _formatCombinedLine(timestamp, request):
+	return '%s - - %s "%s %s %s" %d %s "%s" "%s"\n' % (
+		request.getClientIP(),
+		timestamp,
+		_escape(request.method),
+		_escape(request.uri),
+		_escape(request.clientproto),
+		request.code,
+		request.sentLength or "-",
+		_escape(request.getHeader("referer") or "-"),
+		_escape(request.getHeader("user-agent") or "-"))
+
+
+def _formatCompactLine(timestamp, request):
+	return '%s %s %s %s %d %s\n' % (
+		timestamp,
+		request.getClientIP(),
+		_escape(request.method),
+		_escape(request.uri),
+		request.code,
+		request.sentLength or "-")
+
+
+
+class LogFormat(object):
+	"""
+	An access log line format.
+	"""
+	__slots__ = ('formatTime', 'formatLine')
+
+	def __init__(self, formatTime, formatLine):
+		"""
+		@param formatTime: a 1-arg callable that takes an C{int} number of
+			seconds since the epoch and returns a C{str}.  It is called at
+			most once per second.
+
+		@param formatLine: a 2-arg callable that takes the C{str} returned
+			by C{formatTime} and a L{server.Request}, and returns a
+			C{str} line, including the trailing newline.
+		"""
+		self.formatTime = formatTime
+		self.formatLine = formatLine
+
+
+	def __repr__(self):
+		return '<%s formatLine=%r>' % (
+			self.__class__.__name__, self.formatLine)
+
+
+
+# The same format that twisted.web.http.HTTPFactory.log writes.
+COMBINED = LogFormat(datetimeToLogString, _formatCombinedLine)
+
+# "2013-01-02T03:04:05Z 127.0.0.1 GET /path 200 1234"
+COMPACT = LogFormat(_formatISOTime, _formatCompactLine)
+
+
+_STOP = object()
+
+
+class BufferedLogWriter(object):
+	"""
+	A write-only file-like object that buffers written lines and passes
+	them in batches to a background thread, which writes them to the
+	underlying file.
+
+	The buffer is flushed when it reaches C{bufferSize} bytes, every
+	C{flushInterval} seconds, and on L{close}.  If the background thread
+	falls more than C{maxPendingBatches} batches behind (for example,
+	because the disk is stalled), new batches are dropped instead of
+	blocking the reactor, and counted in C{droppedLines}.
+	"""
+
+	def __init__(self, f, clock, bufferSize=64 * 1024, flushInterval=1,
+	maxPendingBatches=64, threaded=True):
+		"""
+		@param f: the file to write to.  L{BufferedLogWriter} owns it and
+			closes it in L{close}.
+
+		@param clock: an L{IReactorTime} provider, used for periodic
+			flushing.
+
+		@param threaded: if C{False}, write batches synchronously in the
+			calling thread.  Used by tests.
+		"""
+		self._file = f
+		self._bufferSize = bufferSize
+		self._buffer = []
+		self._buffered = 0
+		self._maxPendingBatches = maxPendingBatches
+		self.droppedLines = 0
+		self.closed = False
+
+		self._flushCall = task.LoopingCall(self.flush)
+		self._flushCall.clock = clock
+		self._flushCall.start(flushInterval, now=False)
+
+		self._queue = None
+		self._thread = None
+		if threaded:
+			self._queue = Queue.Queue()
+			self._thread = threading.Thread(
+				target=self._writeLoop, name='BufferedLogWriter')
+			self._thread.daemon = True
+			self._thread.start()
+
+
+	def write(self, line):
+		self._buffer.append(line)
+		self._buffered += len(line)
+		if self._buffered >= self._bufferSize:
+			self.flush()
+
+
+	def flush(self):
+		"""
+		Pass the buffered lines to the writer.  This does not wait for them
+		to be written.
+		"""
+		if not self._buffer:
+			return
+		lines = self._buffer
+		self._buffer = []
+		self._buffered = 0
+		if self._queue is None:
+			self._writeBatch(lines)
+		elif self._queue.qsize() >= self._maxPendingBatches:
+			self.droppedLines += len(lines)
+		else:
+			self._queue.put(lines)
+
+
+	def _writeBatch(self, lines):
+		try:
+			self._file.write(''.join(lines))
+			self._file.flush()
+		except (IOError, OSError):
+			log.err(None, "Failed to write %d access log lines" % (len(lines),))
+
+
+	def _writeLoop(self):
+		get = self._queue.get
+		while True:
+			lines = get()
+			if lines is _STOP:
+				break
+			self._writeBatch(lines)
+
+
+	def close(self):
+		"""
+		Flush, wait for the background thread to write everything, and close
+		the file.
+		"""
+		if self.closed:
+			return
+		self.closed = True
+		self._flushCall.stop()
+		self.flush()
+		if self._thread is not None:
+			self._queue.put(_STOP)
+			self._thread.join()
+		self._file.close()
+		if self.droppedLines:
+			log.msg("Dropped %d access log lines because the disk was too "
+				"slow" % (self.droppedLines,))
+
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
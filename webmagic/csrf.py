@@ -7,19 +7,36 @@ import sys
 import base64
 import hashlib
 import hmac
+import struct
 
 from zope.interface import implements, Interface
 
+try:
+	# Python >= 2.7.7
+	from hmac import compare_digest as _compareDigest
+except ImportError:
+	_compareDigest = None
+
 _postImportVars = vars().keys()
 
 
+def _pureConstantTimeCompare(s1, s2):
+	if len(s1) != len(s2):
+		return False
+	result = 0
+	for x, y in zip(s1, s2):
+		result |= ord(x) ^ ord(y)
+	return result == 0
+
+
 def constantTimeCompare(s1, s2):
 	"""
 	Compare C{s1} and C{s2} for equality, but always take the same amount
 	of time when both strings are of the same length.  This is intended to stop
 	U{timing attacks<http://rdist.root.org/2009/05/28/timing-attack-in-google-keyczar-library/>}.
 
-	This implementation should do what keyczar does:
+	This uses L{hmac.compare_digest} if it is available, else a pure-Python
+	implementation that should do what keyczar does:
 
 	http://code.google.com/p/keyczar/source/browse/trunk/python/src/keyczar/keys.py?r=471#352
 	http://rdist.root.org/2010/01/07/timing-independent-array-comparison/
@@ -42,12 +59,9 @@ def constantTimeCompare(s1, s2):
 	if isinstance(s2, unicode):
 		raise TypeError("Second object %r was unicode; expected str" % (s2,))
 
-	if len(s1) != len(s2):
-		return False
-	result = 0
-	for x, y in zip(s1, s2):
-		result |= ord(x) ^ ord(y)
-	return result == 0
+	if _compareDigest is not None:
+		return _compareDigest(s1, s2)
+	return _pureConstantTimeCompare(s1, s2)
 
 
 # Web browsers are annoying and send the user's cookie to the website
@@ -101,6 +115,17 @@ class RejectToken(Exception):
 
 
 
+def _truncatedHMAC(mac, what):
+	"""
+	Return the first 128 bits of the HMAC of C{what}, using a copy of
+	C{mac}, an HMAC object that has the key but no message yet.
+	"""
+	mac = mac.copy()
+	mac.update(what)
+	return mac.digest()[:16]
+
+
+
 class CsrfStopper(object):
 	"""
 	An implementation of L{ICsrfStopper} that uses a secret and hmac-sha256
@@ -115,17 +140,18 @@ class CsrfStopper(object):
 	writing the token out to the JavaScript in your HTML might be okay.
 	"""
 	implements(ICsrfStopper)
-	__slots__ = ('_secretString')
+	__slots__ = ('_mac',)
 
 	version = '\x00\x00' # one constant for now
 
 	def __init__(self, secretString):
-		self._secretString = secretString
+		# The HMAC with the key already mixed in; copying it is cheaper
+		# than calling hmac.new for every token.
+		self._mac = hmac.new(secretString, digestmod=hashlib.sha256)
 
 
 	def _hash(self, what):
-		# Take the first 128 bits from the 256 bits
-		return hmac.new(self._secretString, what, hashlib.sha256).digest()[:16]
+		return _truncatedHMAC(self._mac, what)
 
 
 	def makeToken(self, uuid):
@@ -136,6 +162,20 @@ class CsrfStopper(object):
 		return base64.urlsafe_b64encode(digest)
 
 
+	def makeTokens(self, uuids):
+		"""
+		Like L{makeToken}, but for many uuids at once.
+
+		@param uuids: an iterable of C{str}s.
+
+		@return: a C{list} of tokens, in the same order as C{uuids}.
+		"""
+		mac = self._mac
+		version = self.version
+		encode = base64.urlsafe_b64encode
+		return [encode(version + _truncatedHMAC(mac, uuid)) for uuid in uuids]
+
+
 	def checkToken(self, uuidStr, token):
 		"""
 		See L{ICsrfStopper.isTokenValid}
@@ -151,6 +191,128 @@ class CsrfStopper(object):
 
 
 
+class KeyringCsrfStopper(object):
+	"""
+	An implementation of L{ICsrfStopper} like L{CsrfStopper}, but with
+	several secrets, each identified by a version number that is embedded
+	in the first two bytes of the token.  New tokens are made with the
+	current version's secret, and tokens made with any secret still in the
+	keyring are accepted, so secrets can be rotated without rejecting
+	outstanding tokens:
+
+		1.	Add the new secret with L{addKey}.
+		2.	Make it current with L{setCurrentVersion}.
+		3.	When the tokens made with the old secret are no longer needed,
+			remove it with L{removeKey}.
+
+	Tokens made by a L{CsrfStopper} have version 0, so a
+	L{KeyringCsrfStopper} with the same secret as version 0 accepts them.
+	"""
+	implements(ICsrfStopper)
+	__slots__ = ('_macs', '_currentPrefix', '_currentMac')
+
+	def __init__(self, secrets, currentVersion):
+		"""
+		@param secrets: a C{dict} mapping versions (C{int}s in
+			0..65535) to secrets (C{str}s).
+
+		@param currentVersion: the version whose secret is used to make
+			new tokens.
+		"""
+		# 2-byte version prefix -> HMAC with the key already mixed in
+		self._macs = {}
+		self._currentPrefix = None
+		for version, secret in secrets.iteritems():
+			self.addKey(version, secret)
+		self.setCurrentVersion(currentVersion)
+
+
+	def _versionToPrefix(self, version):
+		if not 0 <= version <= 0xFFFF:
+			raise ValueError("Version must be in 0..65535, not %r" % (version,))
+		return struct.pack('>H', version)
+
+
+	def addKey(self, version, secret):
+		"""
+		Add a secret to the keyring, or replace the secret for C{version}.
+		"""
+		prefix = self._versionToPrefix(version)
+		self._macs[prefix] = mac = hmac.new(secret, digestmod=hashlib.sha256)
+		if prefix == self._currentPrefix:
+			self._currentMac = mac
+
+
+	def removeKey(self, version):
+		"""
+		Remove a secret from the keyring.  Tokens made with it are no
+		longer accepted.  The current version cannot be removed.
+		"""
+		prefix = self._versionToPrefix(version)
+		if prefix == self._currentPrefix:
+			raise ValueError("Cannot remove the current version %r" % (version,))
+		del self._macs[prefix]
+
+
+	def setCurrentVersion(self, version):
+		"""
+		Make new tokens with the secret for C{version}, which must already
+		be in the keyring.
+		"""
+		prefix = self._versionToPrefix(version)
+		if prefix not in self._macs:
+			raise KeyError("No secret for version %r" % (version,))
+		self._currentPrefix = prefix
+		self._currentMac = self._macs[prefix]
+
+
+	def getVersions(self):
+		"""
+		@return: a sorted C{list} of the versions in the keyring.
+		"""
+		return sorted(struct.unpack('>H', prefix)[0] for prefix in self._macs)
+
+
+	def makeToken(self, uuid):
+		"""
+		See L{ICsrfStopper.makeToken}
+		"""
+		return base64.urlsafe_b64encode(
+			self._currentPrefix + _truncatedHMAC(self._currentMac, uuid))
+
+
+	def makeTokens(self, uuids):
+		"""
+		Like L{makeToken}, but for many uuids at once.
+
+		@param uuids: an iterable of C{str}s.
+
+		@return: a C{list} of tokens, in the same order as C{uuids}.
+		"""
+		prefix = self._currentPrefix
+		mac = self._currentMac
+		encode = base64.urlsafe_b64encode
+		return [encode(prefix + _truncatedHMAC(mac, uuid)) for uuid in uuids]
+
+
+	def checkToken(self, uuidStr, token):
+		"""
+		See L{ICsrfStopper.isTokenValid}
+		"""
+		assert isinstance(uuidStr, str)
+		try:
+			decoded = base64.urlsafe_b64decode(token)
+		except TypeError:
+			raise RejectToken()
+
+		mac = self._macs.get(decoded[:2])
+		if mac is None:
+			raise RejectToken()
+		if not constantTimeCompare(decoded[2:], _truncatedHMAC(mac, uuidStr)):
+			raise RejectToken()
+
+
+
 try: from refbinder.api import bindRecursive
 except ImportError: pass
 else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -58,7 +58,7 @@ def fixUrls(fileCache, request, content):
 			pass
 		else:
 			# Note: in a .css file, the href of the url(...) is relative to the .css file.
-			staticResource = getResourceForHref(request, href)
+			staticResource = getResourceForHref(request, href, fileCache)
 			breaker = getBreakerForResource(fileCache, staticResource)
 			if breaker is not None:
 				references.append(ReferencedFile(staticResource.path, breaker))
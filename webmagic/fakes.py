@@ -6,7 +6,7 @@ import sys
 
 from zope.interface import implements
 
-from twisted.internet import address, interfaces, task
+from twisted.internet import address, defer, interfaces, task
 
 from twisted.web import server, resource
 from twisted.web import http, http_headers
@@ -116,6 +116,13 @@ class DummyTCPTransport(StringTransport):
 	producer = None
 	streaming = None
 
+	# Like abstract.FileDescriptor, these hold the bytes that were written
+	# but not yet sent.  Nothing is ever sent; tests may set dataBuffer to
+	# simulate a client that is slow to read.
+	dataBuffer = ''
+	offset = 0
+	_tempDataLen = 0
+
 	def __init__(self, *args, **kwargs):
 		self.aborted = False
 		self.noDelayEnabled = None
@@ -189,6 +196,31 @@ class DummyTCPTransport(StringTransport):
 
 
 
+class DummyListeningPort(object):
+	"""
+	A fake listening port that remembers whether it is reading (accepting
+	connections) and listening.
+	"""
+	def __init__(self):
+		self.reading = True
+		self.listening = True
+
+
+	def startReading(self):
+		self.reading = True
+
+
+	def stopReading(self):
+		self.reading = False
+
+
+	def stopListening(self):
+		self.reading = False
+		self.listening = False
+		return defer.succeed(None)
+
+
+
 # copy/paste from twisted.web.test.test_web, but added a setTcpNoDelay
 class DummyChannel(object):
 	requestIsDone = False
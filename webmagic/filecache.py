@@ -1,23 +1,93 @@
 import os
 import sys
+import errno
+import heapq
+
+from twisted.internet import task
+from twisted.python import log
+
+try:
+	# Python 2 has no os.scandir; this is its backport.
+	from scandir import scandir as _scandir
+except ImportError:
+	_scandir = None
 
 _postImportVars = vars().keys()
 
 
 class _Fingerprint(object):
-	__slots__ = ('checkedAt', 'fingerprint')
+	__slots__ = ('checkedAt', 'fingerprint', 'error')
 
-	def __init__(self, checkedAt, fingerprint):
+	def __init__(self, checkedAt, fingerprint, error=None):
 		self.checkedAt = checkedAt
 		self.fingerprint = fingerprint
+		# The exception raised by the fingerprint callable if the file
+		# is missing, else None.
+		self.error = error
 
 
 
-def defaultFingerprint(filename):
-	s = os.stat(filename)
+class _NewContent(object):
+	"""
+	Content that a L{FileCacheRefresher} re-read, which the next
+	L{FileCache.getContent} call returns with C{maybeNew=True}.
+	"""
+	__slots__ = ('content',)
+
+	def __init__(self, content):
+		self.content = content
+
+
+
+def isMissingError(e):
+	"""
+	@return: a C{bool}, whether exception C{e} means that a file does not
+		exist.
+	"""
+	return isinstance(e, EnvironmentError) and \
+		e.errno in (errno.ENOENT, errno.ENOTDIR)
+
+
+def _statFingerprint(s):
 	return s.st_ino, s.st_size, s.st_mtime, s.st_ctime
 
 
+def defaultFingerprint(filename):
+	return _statFingerprint(os.stat(filename))
+
+
+def defaultDirectoryFingerprint(directory, names):
+	"""
+	Fingerprint the files C{names} in C{directory}, in one pass over the
+	directory if the C{scandir} module is installed.
+
+	@return: a C{dict} of name -> fingerprint (the same as
+		L{defaultFingerprint}'s) for each of C{names} that exists.
+	"""
+	fingerprints = {}
+	if _scandir is not None:
+		try:
+			for entry in _scandir(directory or os.curdir):
+				if entry.name in names:
+					try:
+						fingerprints[entry.name] = _statFingerprint(entry.stat())
+					except EnvironmentError, e:
+						if not isMissingError(e):
+							raise
+		except EnvironmentError, e:
+			if not isMissingError(e):
+				raise
+	else:
+		for name in names:
+			try:
+				fingerprints[name] = _statFingerprint(
+					os.stat(os.path.join(directory, name)))
+			except EnvironmentError, e:
+				if not isMissingError(e):
+					raise
+	return fingerprints
+
+
 def defaultGetContent(filename):
 	f = open(filename, 'rb')
 	try:
@@ -34,19 +104,34 @@ class FileCache(object):
 		it peforms a stat, and if (mod time, creat time, inode, size) are
 		different from last time, re-reads the file.
 
-	-	It never forgets files.
+	-	It never forgets files, unless you call L{invalidate},
+		L{invalidatePrefix}, or L{clearCache}.
+
+	-	It remembers missing files like any other: for N seconds, asking
+		for a file that was missing raises the same exception again,
+		without a stat.
 
 	-	It never automatically updates the cache when you're not
-		calling it.
+		calling it, unless a L{FileCacheRefresher} is running.
+
+	-	With a C{directoryFingerprintCallable}, it rechecks all the cached
+		files in a directory at once, so that a burst of requests for
+		files in one directory costs one recheck instead of one each.
+
+	Every time it drops or replaces cached content, it increments its
+	generation (see L{getGeneration}) and calls the change listeners for
+	the affected file (see L{addChangeListener}).
 	"""
 
 	__slots__ = ('_getTimeCallable', '_recheckDelay', '_fingerprintCallable',
-		'_getContentCallable', '_clearCacheListeners', '_fingerprintCache',
-		'_contentCache')
+		'_getContentCallable', '_clearCacheListeners', '_changeListeners',
+		'_generation', '_fingerprintCache', '_contentCache',
+		'_directoryFingerprintCallable', '_directories', '_refresher')
 
 	def __init__(self, getTimeCallable, recheckDelay,
 	fingerprintCallable=defaultFingerprint,
-	getContentCallable=defaultGetContent):
+	getContentCallable=defaultGetContent,
+	directoryFingerprintCallable=None):
 		"""
 		C{getTimeCallable} is a 0-arg callable that returns the current
 			time as a C{float|int|long} in seconds.  This can be any
@@ -62,12 +147,24 @@ class FileCache(object):
 
 		C{getContentCallable} is a callable that takes a filename and
 			returns the content of the file as a C{str}.
+
+		C{directoryFingerprintCallable}, if not C{None}, is a callable
+			that takes a directory and a collection of names in it, and
+			returns a C{dict} of name -> fingerprint for the names that
+			exist, with the same fingerprints as C{fingerprintCallable}.
+			Use L{defaultDirectoryFingerprint} with the default
+			C{fingerprintCallable}.
 		"""
 		self._getTimeCallable = getTimeCallable
 		self._recheckDelay = recheckDelay
 		self._fingerprintCallable = fingerprintCallable
 		self._getContentCallable = getContentCallable
+		self._directoryFingerprintCallable = directoryFingerprintCallable
+		self._refresher = None
 		self._clearCacheListeners = []
+		# filename -> list of callables
+		self._changeListeners = {}
+		self._generation = 0
 		self.clearCache()
 
 
@@ -90,15 +187,103 @@ class FileCache(object):
 		self._clearCacheListeners.remove(callable)
 
 
+	def addChangeListener(self, filename, callable):
+		"""
+		Register callable C{callable} to be called with C{filename} every
+		time the cached content for C{filename} is dropped or replaced:
+		when the file is found to have changed, and when it is invalidated
+		by L{invalidate}, L{invalidatePrefix}, or L{clearCache}.
+		"""
+		self._changeListeners.setdefault(filename, []).append(callable)
+
+
+	def removeChangeListener(self, filename, callable):
+		"""
+		Unregister callable C{callable}, which will no longer be called
+		when C{filename} changes.
+		"""
+		listeners = self._changeListeners[filename]
+		listeners.remove(callable)
+		if not listeners:
+			del self._changeListeners[filename]
+
+
+	def getGeneration(self):
+		"""
+		@return: an C{int} that is incremented every time any cached
+			content is dropped or replaced.  If it has not changed, nothing
+			this cache returned has gone stale (as far as it knows).
+		"""
+		return self._generation
+
+
+	def _changed(self, filenames):
+		self._generation += 1
+		for filename in filenames:
+			# Copy to prevent re-entrancy problems.
+			listeners = self._changeListeners.get(filename, ())[:]
+			for callable in listeners:
+				callable(filename)
+
+
 	def clearCache(self):
 		# No need for securedict because FileCache is designed to store
 		# a limited set of resources not controlled by the user.
 		self._fingerprintCache = {}
+		# filename -> {transform: content}
 		self._contentCache = {}
+		# directory -> {name: filename}, for directoryFingerprintCallable
+		self._directories = {}
+		self._generation += 1
 		# Copy to prevent re-entrancy problems.
 		listeners = self._clearCacheListeners[:]
 		for callable in listeners:
 			callable()
+		for filename in self._changeListeners.keys():
+			for callable in self._changeListeners.get(filename, ())[:]:
+				callable(filename)
+
+
+	def _forget(self, filename):
+		found = self._fingerprintCache.pop(filename, None) is not None
+		if found and self._directoryFingerprintCallable is not None:
+			directory, name = os.path.split(filename)
+			files = self._directories[directory]
+			del files[name]
+			if not files:
+				del self._directories[directory]
+		return self._contentCache.pop(filename, None) is not None or found
+
+
+	def invalidate(self, filename):
+		"""
+		Forget C{filename}, so that the next L{getContent} call for it
+		stats and reads it again.
+
+		@return: a C{bool}, whether anything was cached for C{filename}.
+		"""
+		if not self._forget(filename):
+			return False
+		self._changed([filename])
+		return True
+
+
+	def invalidatePrefix(self, directory):
+		"""
+		Forget every file in C{directory} (a C{str} or C{unicode}
+		path, with or without a trailing separator) and its
+		subdirectories.
+
+		@return: the number of files that were forgotten.
+		"""
+		prefix = directory.rstrip(os.sep) + os.sep
+		filenames = [f for f in set(self._fingerprintCache) | set(self._contentCache)
+			if f.startswith(prefix)]
+		for filename in filenames:
+			self._forget(filename)
+		if filenames:
+			self._changed(filenames)
+		return len(filenames)
 
 
 	def _reallyGetContent(self, filename, transform, tryCache):
@@ -107,18 +292,177 @@ class FileCache(object):
 		"""
 		if tryCache:
 			try:
-				content = self._contentCache[(transform, filename)]
-				return content, False
+				contents = self._contentCache[filename]
+				content = contents[transform]
 			except KeyError:
 				pass
+			else:
+				if content.__class__ is not _NewContent:
+					return content, False
+				content = contents[transform] = content.content
+				return content, True
 
 		content = self._getContentCallable(filename)
 		if transform is not None:
 			content = transform(content)
-		self._contentCache[(transform, filename)] = content
+		self._contentCache.setdefault(filename, {})[transform] = content
 		return content, True
 
 
+	def _fingerprint(self, filename):
+		"""
+		@return: (fingerprint, error), where error is the exception raised
+			if C{filename} is missing, else C{None}.
+		"""
+		try:
+			return self._fingerprintCallable(filename), None
+		except EnvironmentError, e:
+			if not isMissingError(e):
+				raise
+			return None, e
+
+
+	def _update(self, filename, cachedFingerprint, fingerprint, error):
+		"""
+		@return: a C{bool}, whether the file changed.
+		"""
+		if error is not None and cachedFingerprint.error is not None:
+			return False
+		if error is None and cachedFingerprint.error is None and \
+		fingerprint == cachedFingerprint.fingerprint:
+			return False
+		cachedFingerprint.fingerprint = fingerprint
+		cachedFingerprint.error = error
+		self._contentCache.pop(filename, None)
+		return True
+
+
+	def _recheckDirectory(self, directory, timeNow):
+		"""
+		Recheck every cached file in C{directory}.  The caller must call
+		L{_changed} with the files that changed.
+
+		@return: a C{list} of the filenames that changed.
+		"""
+		files = self._directories[directory]
+		fingerprints = self._directoryFingerprintCallable(directory, files)
+		changed = []
+		for name, filename in files.iteritems():
+			cachedFingerprint = self._fingerprintCache[filename]
+			cachedFingerprint.checkedAt = timeNow
+			if name in fingerprints:
+				fingerprint, error = fingerprints[name], None
+			else:
+				fingerprint = None
+				error = cachedFingerprint.error or OSError(
+					errno.ENOENT, os.strerror(errno.ENOENT), filename)
+			if self._update(filename, cachedFingerprint, fingerprint, error):
+				changed.append(filename)
+		return changed
+
+
+	def _refresh(self, filename, timeNow):
+		"""
+		Recheck C{filename} now (with the other files in its directory, if
+		there is a C{directoryFingerprintCallable}), and re-read the
+		content of the files that changed.  Change listeners are called
+		after the content is re-read, so they may invalidate files or get
+		their new content.
+
+		@return: a C{list} of (filename, changed) for each file that was
+			rechecked.
+		"""
+		if filename not in self._fingerprintCache:
+			return []
+		if self._directoryFingerprintCallable is not None:
+			directory = os.path.split(filename)[0]
+			checked = self._directories[directory].values()
+		else:
+			checked = [filename]
+		transforms = dict((f, self._contentCache.get(f, {}).keys()) for f in checked)
+
+		if self._directoryFingerprintCallable is not None:
+			changed = self._recheckDirectory(directory, timeNow)
+		else:
+			cachedFingerprint = self._fingerprintCache[filename]
+			fingerprint, error = self._fingerprint(filename)
+			cachedFingerprint.checkedAt = timeNow
+			changed = []
+			if self._update(filename, cachedFingerprint, fingerprint, error):
+				changed.append(filename)
+
+		for f in changed:
+			cachedFingerprint = self._fingerprintCache.get(f)
+			if not transforms[f] or cachedFingerprint is None or \
+			cachedFingerprint.error is not None:
+				continue
+			try:
+				raw = self._getContentCallable(f)
+			except EnvironmentError:
+				# getContent will read it (and raise) when it's asked for.
+				continue
+			contents = self._contentCache.setdefault(f, {})
+			for transform in transforms[f]:
+				content = raw if transform is None else transform(raw)
+				contents[transform] = _NewContent(content)
+		if changed:
+			self._changed(changed)
+		return [(f, f in changed) for f in checked]
+
+
+	def checkFingerprint(self, filename):
+		"""
+		Stat C{filename} if it hasn't been stat'ed in the last
+		C{recheckDelay} seconds.
+
+		@return: a C{bool}, whether the file may have changed since it was
+			last checked (always C{True} for a file that was not cached).
+
+		Raises the exception that the fingerprint callable raised if the
+		file is missing (an C{OSError} or C{IOError} with C{ENOENT} or
+		C{ENOTDIR}), or if it could not be stat'ed for some other reason.
+		Only the first kind is cached.
+		"""
+		cachedFingerprint = self._fingerprintCache.get(filename)
+		if cachedFingerprint is None:
+			timeNow = self._getTimeCallable()
+			fingerprint, error = self._fingerprint(filename)
+			self._fingerprintCache[filename] = _Fingerprint(
+				timeNow, fingerprint, error)
+			if self._directoryFingerprintCallable is not None:
+				directory, name = os.path.split(filename)
+				self._directories.setdefault(directory, {})[name] = filename
+			if self._refresher is not None:
+				self._refresher._added(filename, timeNow)
+			if error is not None:
+				raise error
+			return True
+
+		if self._recheckDelay == -1 or self._refresher is not None:
+			changed = False
+		else:
+			timeNow = self._getTimeCallable()
+			if cachedFingerprint.checkedAt > timeNow - self._recheckDelay:
+				changed = False
+			elif self._directoryFingerprintCallable is not None:
+				changedFiles = self._recheckDirectory(
+					os.path.split(filename)[0], timeNow)
+				changed = filename in changedFiles
+				if changedFiles:
+					self._changed(changedFiles)
+			else:
+				fingerprint, error = self._fingerprint(filename)
+				cachedFingerprint.checkedAt = timeNow
+				changed = self._update(
+					filename, cachedFingerprint, fingerprint, error)
+				if changed:
+					self._changed([filename])
+
+		if cachedFingerprint.error is not None:
+			raise cachedFingerprint.error
+		return changed
+
+
 	def getContent(self, filename, transform=None):
 		"""
 		C{filename} is a C{str} or C{unicode} representing a file name.
@@ -134,25 +478,171 @@ class FileCache(object):
 
 		Returns (content, maybeNew) or raises an exception.
 		"""
+		# Inlined fast path of checkFingerprint for a fresh, present file.
 		cachedFingerprint = self._fingerprintCache.get(filename)
-		if cachedFingerprint:
-			if self._recheckDelay == -1:
-				return self._reallyGetContent(filename, transform, True)
+		if cachedFingerprint is not None and cachedFingerprint.error is None and \
+		(self._recheckDelay == -1 or self._refresher is not None or
+		cachedFingerprint.checkedAt >
+		self._getTimeCallable() - self._recheckDelay):
+			return self._reallyGetContent(filename, transform, True)
 
-			timeNow = self._getTimeCallable()
-			if cachedFingerprint.checkedAt > timeNow - self._recheckDelay:
-				return self._reallyGetContent(filename, transform, True)
+		maybeNew = self.checkFingerprint(filename)
+		return self._reallyGetContent(filename, transform, not maybeNew)
 
-			fingerprint = self._fingerprintCallable(filename)
-			if fingerprint == cachedFingerprint.fingerprint:
-				cachedFingerprint.checkedAt = timeNow
-				return self._reallyGetContent(filename, transform, True)
-		else:
-			timeNow = self._getTimeCallable()
-			fingerprint = self._fingerprintCallable(filename)
-			self._fingerprintCache[filename] = _Fingerprint(timeNow, fingerprint)
 
-		return self._reallyGetContent(filename, transform, False)
+
+class FileCacheRefresher(object):
+	"""
+	Rechecks the files in a L{FileCache} in the background, so that
+	L{FileCache.getContent} never stats or reads a file that it has
+	already cached.  Changed files are re-read (and re-transformed) here,
+	and the next C{getContent} call returns them with C{maybeNew=True}.
+
+	Each file has its own recheck interval.  It starts at C{minInterval},
+	doubles (up to C{maxInterval}) every time the file is found unchanged,
+	and goes back to C{minInterval} when the file changes, so that files
+	that rarely change are checked less often.
+
+	At most C{maxChecksPerTick} files are rechecked every C{tickInterval}
+	seconds; the files already cached when the refresher starts are
+	spread evenly over the first C{minInterval} seconds.
+	"""
+
+	def __init__(self, fileCache, minInterval=None, maxInterval=None,
+	tickInterval=1, maxChecksPerTick=100, clock=None):
+		"""
+		@param fileCache: a L{FileCache}.
+
+		@param minInterval: the shortest recheck interval, in seconds (of
+			C{fileCache}'s clock).  Defaults to its C{recheckDelay}.
+
+		@param maxInterval: the longest recheck interval, in seconds.
+			Defaults to 16 times C{minInterval}.
+
+		@param tickInterval: how often to look for files to recheck, in
+			seconds.
+
+		@param maxChecksPerTick: the maximum number of rechecks (or
+			directory passes) per tick.
+
+		@param clock: an L{IReactorTime} provider that runs the ticks, or
+			C{None} to use the global reactor.
+		"""
+		if minInterval is None:
+			minInterval = fileCache._recheckDelay
+		if maxInterval is None:
+			maxInterval = minInterval * 16
+		assert 0 < minInterval <= maxInterval, (minInterval, maxInterval)
+		assert maxChecksPerTick > 0, maxChecksPerTick
+		if clock is None:
+			from twisted.internet import reactor as clock
+		self._fileCache = fileCache
+		self._getTime = fileCache._getTimeCallable
+		self._minInterval = minInterval
+		self._maxInterval = maxInterval
+		self._tickInterval = tickInterval
+		self._maxChecksPerTick = maxChecksPerTick
+		self._clock = clock
+		# filename -> (due, interval)
+		self._schedule = {}
+		# heap of (due, filename); entries that don't match _schedule are
+		# stale and skipped.
+		self._heap = []
+		self._call = None
+		self.rechecks = 0
+		self.changes = 0
+
+
+	def __repr__(self):
+		return '<%s files=%d rechecks=%d changes=%d>' % (
+			self.__class__.__name__, len(self._schedule),
+			self.rechecks, self.changes)
+
+
+	def start(self):
+		"""
+		Start rechecking files.  Until L{stop} is called, C{getContent}
+		does not recheck files itself.
+		"""
+		assert self._fileCache._refresher is None, self._fileCache._refresher
+		self._fileCache._refresher = self
+		filenames = sorted(self._fileCache._fingerprintCache)
+		timeNow = self._getTime()
+		for i, filename in enumerate(filenames):
+			self._reschedule(filename,
+				timeNow + self._minInterval * (i + 1) / float(len(filenames)),
+				self._minInterval)
+		self._call = task.LoopingCall(self._tick)
+		self._call.clock = self._clock
+		self._call.start(self._tickInterval, now=False)
+
+
+	def stop(self):
+		"""
+		Stop rechecking files.  C{getContent} goes back to rechecking
+		files every C{recheckDelay} seconds.
+		"""
+		self._fileCache._refresher = None
+		self._call.stop()
+		self._call = None
+		self._schedule = {}
+		self._heap = []
+
+
+	def _reschedule(self, filename, due, interval):
+		self._schedule[filename] = (due, interval)
+		heapq.heappush(self._heap, (due, filename))
+
+
+	def _added(self, filename, timeNow):
+		self._reschedule(filename, timeNow + self._minInterval, self._minInterval)
+
+
+	def getInterval(self, filename):
+		"""
+		@return: the current recheck interval for C{filename}, or C{None}
+			if it is not scheduled.
+		"""
+		entry = self._schedule.get(filename)
+		return None if entry is None else entry[1]
+
+
+	def _tick(self):
+		timeNow = self._getTime()
+		fingerprints = self._fileCache._fingerprintCache
+		heap = self._heap
+		checks = 0
+		while heap and heap[0][0] <= timeNow and checks < self._maxChecksPerTick:
+			due, filename = heapq.heappop(heap)
+			entry = self._schedule.get(filename)
+			if entry is None or entry[0] != due:
+				continue
+			if filename not in fingerprints:
+				# Invalidated, or the cache was cleared.
+				del self._schedule[filename]
+				continue
+			checks += 1
+			try:
+				results = self._fileCache._refresh(filename, timeNow)
+			except Exception:
+				log.err(None, "%r: error rechecking %r" % (self, filename))
+				results = [(filename, False)]
+			# A change listener may have cleared the cache.
+			fingerprints = self._fileCache._fingerprintCache
+			for f, changed in results:
+				self.rechecks += 1
+				if changed:
+					self.changes += 1
+				if f not in fingerprints:
+					# A change listener invalidated it.
+					self._schedule.pop(f, None)
+					continue
+				if changed:
+					interval = self._minInterval
+				else:
+					interval = self._schedule.get(f, (None, self._minInterval))[1]
+					interval = min(interval * 2, self._maxInterval)
+				self._reschedule(f, timeNow + interval, interval)
 
 
 
@@ -5,9 +5,12 @@ from zope.interface import Interface
 from urllib import unquote
 from urlparse import urljoin
 
-from webmagic.fakes import DummyRequest
 from webmagic.transforms import md5hexdigest
+from webmagic.filecache import isMissingError
 
+from twisted.python.components import Componentized
+from twisted.internet.address import IPv4Address
+from twisted.web.http_headers import Headers
 from twisted.web.resource import getChildForRequest
 try:
 	# Twisted >= 9.0
@@ -28,47 +31,194 @@ class ICacheBreaker(Interface):
 		"""
 
 
-def makeRequestForPath(site, path):
+class _LookupChannel(object):
+	"""
+	The channel of a L{_LookupRequest}.  There is one per site, shared by
+	all lookups on that site.
+	"""
+	__slots__ = ('site',)
+
+	def __init__(self, site):
+		self.site = site
+
+
+
+class _LookupSession(Componentized):
+	"""
+	The session of a L{_LookupRequest}.  It is not stored in any site and
+	never expires.
+	"""
+	uid = None
+
+	def touch(self):
+		pass
+
+
+	def notifyOnExpire(self, callback):
+		pass
+
+
+	def expire(self):
+		pass
+
+
+
+class _LookupRequest(object):
+	"""
+	A request used only to walk a site's resource tree with
+	L{getChildForRequest}.  It has the attributes that resources commonly
+	look at in C{getChild}, but it cannot be rendered.  Like the
+	L{DummyRequest} that was used before, it has empty request headers,
+	accepts (and never sends) response headers, cookies, redirects and
+	response codes, and gives out a session that is not stored anywhere.
+
+	If it has a C{fileCache}, resources may use it to skip files they
+	already know are missing (see L{webmagic.untwist.BetterFile.getChild}).
+	Only paths chosen by the site's authors are looked up this way, so the
+	file cache can't be filled by clients.
+	"""
+	method = 'GET'
+	clientproto = 'HTTP/1.1'
+	code = 200
+	session = None
+	_requestHeaders = None
+	_responseHeaders = None
+
+	def __init__(self, channel, path, postpath, fileCache):
+		self.channel = channel
+		self.fileCache = fileCache
+		self.path = path
+		self.uri = path
+		self.prepath = []
+		self.postpath = postpath
+		self.sitepath = []
+		self.args = {}
+		self.received_cookies = {}
+
+
+	def __repr__(self):
+		return '<%s %r prepath=%r postpath=%r>' % (
+			self.__class__.__name__, self.path, self.prepath, self.postpath)
+
+
+	@property
+	def requestHeaders(self):
+		# Made on first use, because most lookups never need one.
+		if self._requestHeaders is None:
+			self._requestHeaders = Headers()
+		return self._requestHeaders
+
+
+	def getHeader(self, name):
+		if self._requestHeaders is None:
+			return None
+		values = self._requestHeaders.getRawHeaders(name)
+		if values is None:
+			return None
+		return values[-1]
+
+
+	def getCookie(self, name):
+		return None
+
+
+	def isSecure(self):
+		return False
+
+
+	def getClientIP(self):
+		return None
+
+
+	def getHost(self):
+		return IPv4Address('TCP', '127.0.0.1', 80)
+
+
+	def getSession(self, sessionInterface=None):
+		if self.session is None:
+			self.session = _LookupSession()
+		if sessionInterface is not None:
+			return self.session.getComponent(sessionInterface)
+		return self.session
+
+
+	@property
+	def responseHeaders(self):
+		if self._responseHeaders is None:
+			self._responseHeaders = Headers()
+		return self._responseHeaders
+
+
+	def setHeader(self, name, value):
+		self.responseHeaders.setRawHeaders(name, [value])
+
+
+	def addCookie(self, k, v, *args, **kwargs):
+		pass
+
+
+	def setResponseCode(self, code, message=None):
+		self.code = code
+
+
+	def redirect(self, url):
+		self.setResponseCode(302)
+		self.setHeader('location', url)
+
+
+
+def _getLookupChannel(site):
+	channel = getattr(site, '_lookupChannel', None)
+	if channel is None:
+		channel = site._lookupChannel = _LookupChannel(site)
+	return channel
+
+
+def makeRequestForPath(site, path, fileCache=None):
 	"""
 	@param site: a L{server.Site}.
 	@param path: a C{str} URL-encoded path that starts with C{"/"}.
+	@param fileCache: a L{filecache.FileCache} that resources may use to
+		check for missing files, or C{None}.
 
-	@return: a request that requests C{path}.
+	@return: a request that requests C{path}.  It is good only for finding
+		a resource with L{getChildForRequest}.  Unlike the
+		L{webmagic.fakes.DummyRequest} that this used to return, it cannot
+		be rendered: it has no C{write}, C{finish} or C{notifyFinish}.
 	"""
 	# Unquote URL with the same function that twisted.web.server uses.
 	postpath = unquote(path).split('/')
 	postpath.pop(0)
-	dummyRequest = DummyRequest(postpath)
-	dummyRequest.path = path
-	dummyRequest.channel.site = site
-	return dummyRequest
+	return _LookupRequest(_getLookupChannel(site), path, postpath, fileCache)
 
 
-def getResourceForPath(site, path):
+def getResourceForPath(site, path, fileCache=None):
 	"""
 	@param site: a L{server.Site}.
 	@param path: a C{str} URL-encoded path that starts with C{"/"}.
+	@param fileCache: see L{makeRequestForPath}.
 
 	@return: a resource from C{site}'s resource tree that corresponds
 		to C{path}.
 	"""
 	rootResource = site.resource
-	dummyRequest = makeRequestForPath(site, path)
+	dummyRequest = makeRequestForPath(site, path, fileCache)
 	return getChildForRequest(rootResource, dummyRequest)
 
 
-def getResourceForHref(request, href):
+def getResourceForHref(request, href, fileCache=None):
 	"""
 	@param request: a L{Request} for the resource that contains C{href}.
 	@param href: a C{str} URL-encoded href, either relative or starting with
 		C{"/"}.
+	@param fileCache: see L{makeRequestForPath}.
 
 	@return: a resource from C{site}'s resource tree that corresponds
 		to C{href}.
 	"""
 	joinedPath = urljoin(request.path, href)
 	site = request.channel.site
-	return getResourceForPath(site, joinedPath)
+	return getResourceForPath(site, joinedPath, fileCache)
 
 
 def getBreakerForResource(fileCache, resource):
@@ -79,7 +229,8 @@ def getBreakerForResource(fileCache, resource):
 		L{ICacheBreaker}.
 
 	@return: a C{str} representing the md5sum hexdigest of the contents of
-		C{resource}, or C{None} if C{resource} is an L{ErrorPage}.
+		C{resource}, or C{None} if C{resource} is an L{ErrorPage} or its
+		file is missing.
 
 	Warning: the contents of C{resource}'s file will be cached, and items
 	may stay in this cache forever.  Don't use this on dynamically-
@@ -93,9 +244,14 @@ def getBreakerForResource(fileCache, resource):
 	if getCacheBreaker:
 		breaker = getCacheBreaker()
 	else:
-		breaker, maybeNew = fileCache.getContent(
-			resource.path,
-			transform=md5hexdigest)
+		try:
+			breaker, maybeNew = fileCache.getContent(
+				resource.path,
+				transform=md5hexdigest)
+		except EnvironmentError, e:
+			if not isMissingError(e):
+				raise
+			return None
 	# TODO: Because some (terrible) proxies cache based on the
 	# non-query portion of the URL, it would be nice to append
 	# /cachebreaker/ instead of ?cachebreaker.  This would require
@@ -110,7 +266,8 @@ def getBreakerForHref(fileCache, request, href):
 	@return: a C{str}, (md5sum hexdigest of resource at href, or
 		C{None} if resource not found).
 	"""
-	return getBreakerForResource(fileCache, getResourceForHref(request, href))
+	return getBreakerForResource(
+		fileCache, getResourceForHref(request, href, fileCache))
 
 
 def makeLinkWithBreaker(href, breakerOrNone):
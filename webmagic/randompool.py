@@ -0,0 +1,72 @@
+"""
+A pool of secure random bytes, for handing out many small random strings
+(like session identifiers) without a system call for each one.
+"""
+
+import os
+import sys
+
+_postImportVars = vars().keys()
+
+
+class RandomPool(object):
+	"""
+	A 1-argument (# of bytes) callable that returns random bytes, like
+	L{os.urandom}, but reads them from C{source} C{blockSize} bytes at a
+	time.  An instance can be passed as the C{secureRandom} of a
+	L{webmagic.untwist.CookieInstaller}.
+
+	Every byte is returned at most once.  The pool is discarded when it is
+	used in a process other than the one that filled it, so a forked child
+	never returns the same bytes as its parent.
+
+	Not thread-safe.
+	"""
+	__slots__ = ('_source', '_blockSize', '_block', '_offset', '_pid')
+
+	def __init__(self, source=os.urandom, blockSize=4096):
+		"""
+		@param source: a 1-argument (# of bytes) callable that returns a
+			string of # secure random bytes.
+
+		@param blockSize: how many bytes to read from C{source} at a time.
+		"""
+		assert blockSize > 0, blockSize
+		self._source = source
+		self._blockSize = blockSize
+		self._block = ''
+		self._offset = 0
+		self._pid = None
+
+
+	def __call__(self, nbytes):
+		pid = os.getpid()
+		if pid != self._pid:
+			# Never use bytes that were read before a fork.
+			self._block = ''
+			self._offset = 0
+			self._pid = pid
+
+		offset = self._offset
+		end = offset + nbytes
+		if end <= len(self._block):
+			self._offset = end
+			return self._block[offset:end]
+
+		if nbytes > self._blockSize:
+			return self._source(nbytes)
+		self._block = self._source(self._blockSize)
+		self._offset = nbytes
+		return self._block[:nbytes]
+
+
+	def __repr__(self):
+		return '<%s source=%r blockSize=%r available=%r>' % (
+			self.__class__.__name__, self._source, self._blockSize,
+			len(self._block) - self._offset)
+
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -0,0 +1,432 @@
+"""
+An L{ICsrfStopper} that asks a token server over the network, so that
+several web servers can share one token secret (and keyring) without each
+having a copy, and the server that serves it.
+
+Calls made in the same reactor iteration (or within C{batchDelay} seconds)
+are sent together, as one JSON line, and answered with one JSON line, so a
+page that checks or makes many tokens costs one round-trip.  Batches are
+pipelined over a small pool of persistent connections.
+
+The wire format, one JSON object per line::
+
+	-> {"id": 1, "calls": [["make", "<base64 uuid>"],
+		["check", "<base64 uuid>", "<token>"]]}
+	<- {"id": 1, "results": ["<token>", true]}
+
+A "check" result is C{true} if the token is valid and C{false} if it was
+rejected.  A call that failed on the server has a result of
+C{{"error": "<message>"}}.
+"""
+
+import sys
+import json
+import base64
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import defer, protocol
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+from webmagic.csrf import ICsrfStopper, RejectToken
+
+_postImportVars = vars().keys()
+
+
+class RemoteCsrfError(Exception):
+	"""
+	A call to a remote token server failed for a reason other than the
+	token being rejected.
+	"""
+
+
+
+class RemoteCsrfTimeout(RemoteCsrfError):
+	"""
+	A call to a remote token server was not answered in time.
+	"""
+
+
+
+class _Batch(object):
+	__slots__ = ('id', 'calls', 'timeoutCall', 'protocol')
+
+	def __init__(self, batchId, calls):
+		self.id = batchId
+		# list of (method, args, Deferred)
+		self.calls = calls
+		self.timeoutCall = None
+		self.protocol = None
+
+
+	def fail(self, exc):
+		for method, args, d in self.calls:
+			d.errback(exc)
+
+
+	def resolve(self, results):
+		if len(results) != len(self.calls):
+			self.fail(RemoteCsrfError(
+				"Expected %d results, got %d" % (len(self.calls), len(results))))
+			return
+		for (method, args, d), result in zip(self.calls, results):
+			if isinstance(result, dict):
+				d.errback(RemoteCsrfError(result.get('error')))
+			elif method == 'make':
+				d.callback(str(result))
+			elif result is True:
+				d.callback(None)
+			else:
+				d.errback(RejectToken())
+
+
+
+class _CsrfClientProtocol(LineReceiver):
+	delimiter = '\n'
+	MAX_LENGTH = 16 * 1024 * 1024
+
+	stopper = None
+
+	def connectionMade(self):
+		# batch id -> _Batch
+		self.outstanding = {}
+		self.lost = defer.Deferred()
+
+
+	def sendBatch(self, batch):
+		batch.protocol = self
+		self.outstanding[batch.id] = batch
+		calls = []
+		for method, args, d in batch.calls:
+			if method == 'make':
+				calls.append(['make', base64.b64encode(args[0])])
+			else:
+				calls.append(['check', base64.b64encode(args[0]), args[1]])
+		self.sendLine(json.dumps({'id': batch.id, 'calls': calls}))
+
+
+	def lineReceived(self, line):
+		try:
+			response = json.loads(line)
+			batchId = response['id']
+			results = response['results']
+		except (ValueError, KeyError, TypeError):
+			log.msg("%r: bad response from token server: %r" % (self, line[:200]))
+			self.transport.loseConnection()
+			return
+		self.stopper._batchAnswered(self, batchId, results)
+
+
+	def lineLengthExceeded(self, line):
+		log.msg("%r: response from token server too long" % (self,))
+		self.transport.loseConnection()
+
+
+	def connectionLost(self, reason):
+		outstanding = self.outstanding
+		self.outstanding = {}
+		if self.stopper is not None:
+			self.stopper._protocolLost(self, outstanding.values(), reason)
+		self.lost.callback(None)
+
+
+
+class _CsrfClientFactory(protocol.Factory):
+	protocol = _CsrfClientProtocol
+
+
+
+class RemoteCsrfStopper(object):
+	"""
+	An L{ICsrfStopper} whose methods return L{Deferred}s that fire with the
+	answer of a remote token server (see L{CsrfTokenServerFactory}).
+
+	If the server does not answer a call within C{timeout} seconds, the
+	call fails with L{RemoteCsrfTimeout}, and the connection it was sent on
+	is closed.  If the connection is lost or can't be made, calls fail with
+	L{RemoteCsrfError}.  A rejected token fails with L{RejectToken}, like
+	any L{ICsrfStopper}.
+	"""
+	implements(ICsrfStopper)
+
+	def __init__(self, endpoint, poolSize=2, timeout=5, batchDelay=0,
+	maxBatchSize=500, clock=None):
+		"""
+		@param endpoint: an L{IStreamClientEndpoint} for the token server.
+
+		@param poolSize: the maximum number of connections to open.  A new
+			connection is opened only when all open connections are waiting
+			for an answer.
+
+		@param timeout: how long to wait for an answer, in seconds, counted
+			from when the call is made.
+
+		@param batchDelay: how long to wait for more calls before sending a
+			batch, in seconds.  With 0, the calls made in one reactor
+			iteration are sent together.
+
+		@param maxBatchSize: the maximum number of calls in one batch.
+
+		@param clock: an L{IReactorTime} provider, or C{None} to use the
+			global reactor.
+		"""
+		assert poolSize > 0, poolSize
+		assert maxBatchSize > 0, maxBatchSize
+		if clock is None:
+			from twisted.internet import reactor as clock
+		self._endpoint = endpoint
+		self._poolSize = poolSize
+		self._timeout = timeout
+		self._batchDelay = batchDelay
+		self._maxBatchSize = maxBatchSize
+		self._clock = clock
+		self._factory = _CsrfClientFactory()
+		# list of (method, args, Deferred) waiting to be batched
+		self._queue = []
+		self._flushCall = None
+		# _Batches waiting for a connection
+		self._unsent = deque()
+		self._connections = []
+		self._connecting = 0
+		self._nextId = 1
+		self._closed = False
+
+
+	def __repr__(self):
+		return '<%s endpoint=%r connections=%d>' % (
+			self.__class__.__name__, self._endpoint, len(self._connections))
+
+
+	def _call(self, method, args):
+		if self._closed:
+			return defer.fail(RemoteCsrfError("%r is closed" % (self,)))
+		d = defer.Deferred()
+		self._queue.append((method, args, d))
+		if self._flushCall is None:
+			self._flushCall = self._clock.callLater(
+				self._batchDelay, self._flush)
+		return d
+
+
+	def makeToken(self, uuid):
+		"""
+		See L{ICsrfStopper.makeToken}
+		"""
+		assert isinstance(uuid, str)
+		return self._call('make', (uuid,))
+
+
+	def checkToken(self, uuidStr, token):
+		"""
+		See L{ICsrfStopper.checkToken}
+		"""
+		assert isinstance(uuidStr, str)
+		try:
+			# A valid token is base64, so it's ASCII.
+			token.decode('ascii')
+		except (AttributeError, UnicodeError):
+			return defer.fail(RejectToken())
+		return self._call('check', (uuidStr, token))
+
+
+	def _flush(self):
+		self._flushCall = None
+		queue = self._queue
+		self._queue = []
+		size = self._maxBatchSize
+		for start in xrange(0, len(queue), size):
+			batch = _Batch(self._nextId, queue[start:start + size])
+			self._nextId += 1
+			batch.timeoutCall = self._clock.callLater(
+				self._timeout, self._timedOut, batch)
+			self._unsent.append(batch)
+		self._sendUnsent()
+
+
+	def _pickConnection(self):
+		best = None
+		for proto in self._connections:
+			if best is None or len(proto.outstanding) < len(best.outstanding):
+				best = proto
+		if (best is None or best.outstanding) and not self._connecting and \
+		len(self._connections) < self._poolSize:
+			self._connect()
+		return best
+
+
+	def _sendUnsent(self):
+		while self._unsent:
+			proto = self._pickConnection()
+			if proto is None:
+				return
+			proto.sendBatch(self._unsent.popleft())
+
+
+	def _connect(self):
+		self._connecting += 1
+		d = self._endpoint.connect(self._factory)
+		d.addCallbacks(self._connected, self._connectFailed)
+		d.addErrback(log.err)
+
+
+	def _connected(self, proto):
+		self._connecting -= 1
+		if self._closed:
+			proto.transport.loseConnection()
+			return
+		proto.stopper = self
+		self._connections.append(proto)
+		self._sendUnsent()
+
+
+	def _connectFailed(self, reason):
+		self._connecting -= 1
+		if self._connections or self._connecting:
+			return
+		unsent = self._unsent
+		self._unsent = deque()
+		for batch in unsent:
+			self._finishBatch(batch)
+			batch.fail(RemoteCsrfError(
+				"Could not connect to token server: %s" % (
+					reason.getErrorMessage(),)))
+
+
+	def _finishBatch(self, batch):
+		if batch.timeoutCall is not None:
+			batch.timeoutCall.cancel()
+			batch.timeoutCall = None
+
+
+	def _batchAnswered(self, proto, batchId, results):
+		batch = proto.outstanding.pop(batchId, None)
+		if batch is None:
+			# It timed out.
+			return
+		self._finishBatch(batch)
+		batch.resolve(results)
+
+
+	def _timedOut(self, batch):
+		batch.timeoutCall = None
+		proto = batch.protocol
+		if proto is None:
+			self._unsent.remove(batch)
+		else:
+			del proto.outstanding[batch.id]
+			# The server is stuck or gone; don't send anything else to it.
+			transport = proto.transport
+			if hasattr(transport, 'abortConnection'):
+				transport.abortConnection()
+			else:
+				transport.loseConnection()
+		batch.fail(RemoteCsrfTimeout(
+			"Token server did not answer in %r seconds" % (self._timeout,)))
+
+
+	def _protocolLost(self, proto, batches, reason):
+		self._connections.remove(proto)
+		for batch in batches:
+			self._finishBatch(batch)
+			batch.fail(RemoteCsrfError(
+				"Lost connection to token server: %s" % (
+					reason.getErrorMessage(),)))
+		# Batches waiting for a connection need a new one.
+		if self._unsent and not self._closed:
+			self._sendUnsent()
+
+
+	def close(self):
+		"""
+		Close all connections.  Calls that have not been answered fail
+		with L{RemoteCsrfError}.
+
+		@return: a L{Deferred} that fires when all connections are closed.
+		"""
+		self._closed = True
+		if self._flushCall is not None:
+			self._flushCall.cancel()
+			self._flushCall = None
+		closedError = RemoteCsrfError("%r was closed" % (self,))
+		for method, args, d in self._queue:
+			d.errback(closedError)
+		self._queue = []
+		unsent = self._unsent
+		self._unsent = deque()
+		for batch in unsent:
+			self._finishBatch(batch)
+			batch.fail(closedError)
+		lost = []
+		for proto in self._connections:
+			lost.append(proto.lost)
+			proto.transport.loseConnection()
+		return defer.DeferredList(lost)
+
+
+
+class _CsrfServerProtocol(LineReceiver):
+	delimiter = '\n'
+	MAX_LENGTH = 16 * 1024 * 1024
+
+	def lineReceived(self, line):
+		try:
+			request = json.loads(line)
+			batchId = request['id']
+			calls = [self._call(call) for call in request['calls']]
+		except (ValueError, KeyError, TypeError, IndexError):
+			log.msg("%r: bad request: %r" % (self, line[:200]))
+			self.transport.loseConnection()
+			return
+		d = defer.gatherResults(calls)
+		d.addCallback(lambda results: self.sendLine(
+			json.dumps({'id': batchId, 'results': results})))
+		d.addErrback(log.err)
+
+
+	def _call(self, call):
+		stopper = self.factory.stopper
+		method = call[0]
+		uuid = base64.b64decode(call[1])
+		if method == 'make':
+			d = defer.maybeDeferred(stopper.makeToken, uuid)
+			d.addErrback(self._error)
+		elif method == 'check':
+			d = defer.maybeDeferred(stopper.checkToken, uuid, str(call[2]))
+			d.addCallbacks(lambda _: True, self._checkFailed)
+		else:
+			raise ValueError("Unknown method %r" % (method,))
+		return d
+
+
+	def _checkFailed(self, failure):
+		if failure.check(RejectToken):
+			return False
+		return self._error(failure)
+
+
+	def _error(self, failure):
+		log.err(failure, "Error in token server call")
+		return {'error': failure.getErrorMessage()}
+
+
+
+class CsrfTokenServerFactory(protocol.ServerFactory):
+	"""
+	Serves an L{ICsrfStopper} (usually a L{webmagic.csrf.CsrfStopper} or
+	L{webmagic.csrf.KeyringCsrfStopper}) to L{RemoteCsrfStopper}s.
+
+	There is no authentication, so listen only on an interface that
+	untrusted clients can't reach.
+	"""
+	protocol = _CsrfServerProtocol
+
+	def __init__(self, stopper):
+		self.stopper = stopper
+
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -43,6 +43,25 @@ def checkHeaderValue(value):
 			"headers" % (value,))
 
 
+def _checkHeaderValues(values):
+	"""
+	Like calling L{checkHeaderValue} on each item in C{values}, but when
+	all of them are valid (the common case), check them all with a single
+	scan of their concatenation.  Only if that finds a problem are they
+	checked one by one, to raise the same exception L{checkHeaderValue}
+	would.
+	"""
+	try:
+		joined = ''.join(values)
+	except TypeError:
+		joined = None
+	# Joining a unicode object makes a unicode object.  Joining can't make
+	# a CR or LF that wasn't in one of the values.
+	if joined.__class__ is not str or '\n' in joined or '\r' in joined:
+		for value in values:
+			checkHeaderValue(value)
+
+
 def setRawHeadersSafely(headers, name, values):
 	"""
 	Sets the raw representation of the given header.
@@ -65,11 +84,41 @@ def setRawHeadersSafely(headers, name, values):
 	if not isinstance(values, list):
 		raise TypeError("Header entry %r should be list but found "
 			"instance of %r instead" % (name, type(values)))
-	for value in values:
-		checkHeaderValue(value)
+	_checkHeaderValues(values)
 	headers.setRawHeaders(name, values)
 
 
+def setManyRawHeadersSafely(headers, mapping):
+	"""
+	Like calling L{setRawHeadersSafely} for each item in C{mapping}, but
+	all values are checked (with one scan, if they are all valid) before
+	any header is set, so if an exception is raised, C{headers} is not
+	modified.
+
+	@type mapping: C{dict}
+	@param mapping: Maps header names to C{list}s of header values.
+
+	@raise TypeError: If any value in C{mapping} is not a C{list}, or if
+		any item in those lists is not a C{str}.
+
+	@raise ValueError: If any header value is not a valid HTTP header
+		value (i.e. splits into multiple message headers).
+
+	@return: C{None}
+	"""
+	items = mapping.items()
+	allValues = []
+	for name, values in items:
+		if not isinstance(values, list):
+			raise TypeError("Header entry %r should be list but found "
+				"instance of %r instead" % (name, type(values)))
+		allValues.extend(values)
+	_checkHeaderValues(allValues)
+	setRawHeaders = headers.setRawHeaders
+	for name, values in items:
+		setRawHeaders(name, values)
+
+
 def addRawHeaderSafely(headers, name, value):
 	"""
 	Add a new raw value for the given header.
@@ -5,6 +5,7 @@ Special resources used for testing browser behavior
 from twisted.web import resource, server
 
 from webmagic.untwist import setNoCacheNoStoreHeaders
+from webmagic.timingwheel import TimingWheel
 
 
 def stringToWaitTime(s):
@@ -29,16 +30,37 @@ def requestToWaitTime(request):
 	return waitTime
 
 
+def _call(f):
+	f()
+
+
+
 class WaitResource(resource.Resource):
 	"""
 	A resource that waits for the number of seconds specified in the body.
 	This is used for a Chrome bug test page hosted on http://ludios.net/
+
+	All waiting requests share one L{TimingWheel}, so there is at most one
+	pending call on C{clock} no matter how many requests are waiting, and
+	a request whose client disconnects is unscheduled in O(1).  Responses
+	may be up to 2 * C{granularity} seconds late, except that responses
+	with a wait of 0 are sent immediately.
 	"""
 	isLeaf = True
 
-	def __init__(self, clock):
+	def __init__(self, clock, granularity=1):
 		resource.Resource.__init__(self)
 		self._clock = clock
+		self._wheel = TimingWheel(clock, granularity, _call)
+
+
+	def _finishLater(self, request, waitTime, writeAndFinish):
+		if waitTime == 0:
+			writeAndFinish()
+			return
+		self._wheel.schedule(writeAndFinish, waitTime)
+		d = request.notifyFinish()
+		d.addErrback(lambda _: self._wheel.cancel(writeAndFinish))
 
 
 	def render_GET(self, request):
@@ -60,11 +82,7 @@ class WaitResource(resource.Resource):
 			request.write(blankGif)
 			request.finish()
 
-		dc = self._clock.callLater(waitTime, writeAndFinish)
-
-		d = request.notifyFinish()
-		d.addErrback(lambda _: dc.cancel())
-
+		self._finishLater(request, waitTime, writeAndFinish)
 		return server.NOT_DONE_YET
 
 
@@ -82,9 +100,5 @@ class WaitResource(resource.Resource):
 			request.write("// Done after %d seconds." % (waitTime,))
 			request.finish()
 
-		dc = self._clock.callLater(waitTime, writeAndFinish)
-
-		d = request.notifyFinish()
-		d.addErrback(lambda _: dc.cancel())
-
+		self._finishLater(request, waitTime, writeAndFinish)
 		return server.NOT_DONE_YET
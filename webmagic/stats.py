@@ -0,0 +1,258 @@
+"""
+Cheap counters and histograms for keeping statistics about a server, for
+use instead of logging every event.
+"""
+
+import sys
+from bisect import bisect_left
+
+_postImportVars = vars().keys()
+
+
+class Histogram(object):
+	"""
+	A histogram with fixed bucket boundaries.  Like Prometheus histograms,
+	bucket C{i} counts observations that are <= C{bounds[i]}, but unlike
+	Prometheus histograms, the counts are not cumulative.  Observations
+	greater than the last bound are counted in an extra overflow bucket.
+	"""
+	__slots__ = ('bounds', 'counts', 'count', 'sum')
+
+	def __init__(self, bounds):
+		"""
+		@param bounds: a sorted sequence of bucket upper bounds.
+		"""
+		assert list(bounds) == sorted(bounds), bounds
+		self.bounds = tuple(bounds)
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.sum = 0
+
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+
+
+	def reset(self):
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.sum = 0
+
+
+	def getCumulative(self):
+		"""
+		@return: a C{list} of (upper bound, cumulative count) C{tuple}s, the
+			last of which has an upper bound of C{float('inf')}.
+		"""
+		out = []
+		total = 0
+		for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+			total += n
+			out.append((bound, total))
+		return out
+
+
+	def asDict(self):
+		"""
+		@return: a JSON-serializable C{dict}.  C{counts} has one more item
+			than C{bounds}, for the overflow bucket.
+		"""
+		return {
+			'bounds': list(self.bounds),
+			'counts': self.counts[:],
+			'count': self.count,
+			'sum': self.sum,
+		}
+
+
+	def __repr__(self):
+		return '<%s count=%r sum=%r counts=%r>' % (
+			self.__class__.__name__, self.count, self.sum, self.counts)
+
+
+
+# Connection lifetimes, in seconds
+LIFETIME_BOUNDS = (0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+REQUESTS_PER_CONNECTION_BOUNDS = (0, 1, 2, 5, 10, 20, 50, 100, 1000)
+
+
+class ConnectionStats(object):
+	"""
+	Aggregated statistics about the connections to a server.
+	"""
+	__slots__ = ('opened', 'closed', 'peak', 'lifetimes',
+		'requestsPerConnection')
+
+	def __init__(self):
+		self.opened = 0
+		self.closed = 0
+		self.peak = 0
+		self.lifetimes = Histogram(LIFETIME_BOUNDS)
+		self.requestsPerConnection = Histogram(REQUESTS_PER_CONNECTION_BOUNDS)
+
+
+	@property
+	def current(self):
+		return self.opened - self.closed
+
+
+	def connectionOpened(self):
+		self.opened += 1
+		current = self.opened - self.closed
+		if current > self.peak:
+			self.peak = current
+
+
+	def connectionClosed(self, lifetime, requests):
+		"""
+		@param lifetime: how long the connection was open, in seconds.
+		@param requests: the number of requests received on the connection.
+		"""
+		self.closed += 1
+		self.lifetimes.observe(lifetime)
+		self.requestsPerConnection.observe(requests)
+
+
+	def asDict(self):
+		return {
+			'opened': self.opened,
+			'closed': self.closed,
+			'current': self.current,
+			'peak': self.peak,
+			'lifetimes': self.lifetimes.asDict(),
+			'requestsPerConnection': self.requestsPerConnection.asDict(),
+		}
+
+
+	def __repr__(self):
+		return '<%s opened=%r closed=%r current=%r peak=%r>' % (
+			self.__class__.__name__,
+			self.opened, self.closed, self.current, self.peak)
+
+
+
+# Request latencies, in seconds
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+	1, 2.5, 5, 10, 30)
+
+
+def _escapeLabelValue(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatBound(bound):
+	if bound == float('inf'):
+		return '+Inf'
+	return repr(float(bound))
+
+
+def formatPrometheusHistograms(name, help, label, histograms):
+	"""
+	Format some L{Histogram}s in the Prometheus text exposition format.
+
+	@param name: the metric name, without the C{_bucket}/C{_sum}/C{_count}
+		suffixes.
+
+	@param help: a one-line description of the metric.
+
+	@param label: the name of the label that distinguishes the histograms.
+
+	@param histograms: a C{dict} mapping label values (C{str}s) to
+		L{Histogram}s.
+
+	@return: a C{list} of lines, without newlines.
+	"""
+	lines = ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % (name,)]
+	for value in sorted(histograms):
+		h = histograms[value]
+		labels = '%s="%s"' % (label, _escapeLabelValue(value))
+		for bound, count in h.getCumulative():
+			lines.append('%s_bucket{%s,le="%s"} %d' % (
+				name, labels, _formatBound(bound), count))
+		lines.append('%s_sum{%s} %r' % (name, labels, float(h.sum)))
+		lines.append('%s_count{%s} %d' % (name, labels, h.count))
+	return lines
+
+
+class RequestMetrics(object):
+	"""
+	Per-resource-class request latency histograms.  An instance can be
+	passed as the C{requestObserver} of a L{webmagic.untwist.BetterSite}.
+
+	Requests are keyed by the fully-qualified name of the class of the
+	resource that rendered them.
+	"""
+	__slots__ = ('bounds', 'durations', 'firstBytes', 'aborted')
+
+	def __init__(self, bounds=LATENCY_BOUNDS):
+		self.bounds = bounds
+		# resource class name -> Histogram of seconds from receiving the
+		# request to finishing the response
+		self.durations = {}
+		# resource class name -> Histogram of seconds from receiving the
+		# request to writing the first byte of the response
+		self.firstBytes = {}
+		# resource class name -> number of requests whose connection was
+		# lost before the response was finished
+		self.aborted = {}
+
+
+	def __call__(self, timings):
+		"""
+		Record a finished (or aborted) request.
+
+		@param timings: a L{webmagic.untwist.RequestTimings}.
+		"""
+		key = timings.resource
+		if timings.aborted:
+			self.aborted[key] = self.aborted.get(key, 0) + 1
+			return
+		durations = self.durations.get(key)
+		if durations is None:
+			durations = self.durations[key] = Histogram(self.bounds)
+			self.firstBytes[key] = Histogram(self.bounds)
+		durations.observe(timings.finished - timings.received)
+		self.firstBytes[key].observe(timings.firstByte - timings.received)
+
+
+	def reset(self):
+		self.durations.clear()
+		self.firstBytes.clear()
+		self.aborted.clear()
+
+
+	def asPrometheusText(self):
+		"""
+		@return: a C{str}, the metrics in the Prometheus text exposition
+			format.
+		"""
+		lines = formatPrometheusHistograms(
+			'webmagic_request_duration_seconds',
+			'Time from receiving a request to finishing its response.',
+			'resource', self.durations)
+		lines.extend(formatPrometheusHistograms(
+			'webmagic_request_first_byte_seconds',
+			'Time from receiving a request to writing its first byte.',
+			'resource', self.firstBytes))
+		name = 'webmagic_requests_aborted_total'
+		lines.append('# HELP %s Requests whose connection was lost before '
+			'the response was finished.' % (name,))
+		lines.append('# TYPE %s counter' % (name,))
+		for key in sorted(self.aborted):
+			lines.append('%s{resource="%s"} %d' % (
+				name, _escapeLabelValue(key), self.aborted[key]))
+		return '\n'.join(lines) + '\n'
+
+
+	def __repr__(self):
+		return '<%s resources=%r>' % (
+			self.__class__.__name__, sorted(self.durations))
+
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
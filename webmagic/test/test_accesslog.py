@@ -0,0 +1,201 @@
+import threading
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.web.http import datetimeToLogString
+
+from webmagic.fakes import DummyRequest, DummyTCPTransport
+from webmagic.untwist import BetterSite, BetterResource
+from webmagic.accesslog import (
+	CachedTimestamp, BufferedLogWriter, COMBINED, COMPACT)
+
+
+class RecordingFile(object):
+
+	def __init__(self):
+		self.writes = []
+		self.flushes = 0
+		self.closed = False
+
+
+	def write(self, data):
+		self.writes.append(data)
+
+
+	def flush(self):
+		self.flushes += 1
+
+
+	def close(self):
+		self.closed = True
+
+
+
+class CachedTimestampTests(unittest.TestCase):
+
+	def test_formatsOncePerSecond(self):
+		clock = Clock()
+		calls = []
+		def formatTime(seconds):
+			calls.append(seconds)
+			return str(seconds)
+		timestamp = CachedTimestamp(clock, formatTime)
+		clock.advance(5.2)
+		self.assertEqual('5', timestamp())
+		clock.advance(0.7)
+		self.assertEqual('5', timestamp())
+		clock.advance(0.1)
+		self.assertEqual('6', timestamp())
+		self.assertEqual([5, 6], calls)
+
+
+
+class LogFormatTests(unittest.TestCase):
+
+	def _makeRequest(self):
+		request = DummyRequest(['x'])
+		request.method = 'GET'
+		request.uri = '/x?"y"'
+		request.clientproto = 'HTTP/1.1'
+		request.code = 200
+		request.sentLength = 12
+		request.headers['user-agent'] = 'UA'
+		request.getClientIP = lambda: '10.0.0.1'
+		return request
+
+
+	def test_combined(self):
+		self.assertEqual(
+			'10.0.0.1 - - [01/Jan/1970:00:00:00 +0000] '
+			'"GET /x?\\"y\\" HTTP/1.1" 200 12 "-" "UA"\n',
+			COMBINED.formatLine(
+				COMBINED.formatTime(0), self._makeRequest()))
+
+
+	def test_compact(self):
+		self.assertEqual(
+			'1970-01-01T00:00:01Z 10.0.0.1 GET /x?\\"y\\" 200 12\n',
+			COMPACT.formatLine(COMPACT.formatTime(1), self._makeRequest()))
+
+
+
+class BufferedLogWriterTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.file = RecordingFile()
+
+
+	def _makeWriter(self, **kwargs):
+		writer = BufferedLogWriter(
+			self.file, self.clock, threaded=False, **kwargs)
+		self.addCleanup(writer.close)
+		return writer
+
+
+	def test_flushOnSize(self):
+		writer = self._makeWriter(bufferSize=10)
+		writer.write('abcd\n')
+		self.assertEqual([], self.file.writes)
+		writer.write('efgh\n')
+		self.assertEqual(['abcd\nefgh\n'], self.file.writes)
+		self.assertEqual(1, self.file.flushes)
+
+
+	def test_flushOnInterval(self):
+		writer = self._makeWriter(flushInterval=2)
+		writer.write('a\n')
+		self.clock.advance(1)
+		self.assertEqual([], self.file.writes)
+		self.clock.advance(1)
+		self.assertEqual(['a\n'], self.file.writes)
+		# Nothing is written when nothing is buffered.
+		self.clock.advance(2)
+		self.assertEqual(['a\n'], self.file.writes)
+
+
+	def test_close(self):
+		writer = BufferedLogWriter(self.file, self.clock, threaded=False)
+		writer.write('a\n')
+		writer.close()
+		self.assertEqual(['a\n'], self.file.writes)
+		self.assertTrue(self.file.closed)
+		self.assertEqual([], self.clock.getDelayedCalls())
+		# A second close does nothing.
+		writer.close()
+
+
+	def test_threaded(self):
+		writer = BufferedLogWriter(self.file, self.clock, bufferSize=4)
+		for i in xrange(100):
+			writer.write('%02d\n' % (i,))
+		writer.close()
+		self.assertEqual(
+			''.join('%02d\n' % (i,) for i in xrange(100)),
+			''.join(self.file.writes))
+		self.assertTrue(self.file.closed)
+
+
+	def test_dropsWhenWriterFallsBehind(self):
+		entered = threading.Event()
+		unblock = threading.Event()
+		def write(data):
+			entered.set()
+			unblock.wait()
+			self.file.writes.append(data)
+		self.file.write = write
+
+		writer = BufferedLogWriter(
+			self.file, self.clock, bufferSize=1, maxPendingBatches=2)
+		writer.write('a\n')
+		entered.wait()
+		# The writer thread is stuck writing 'a'.
+		writer.write('b\n')
+		writer.write('c\n')
+		writer.write('d\n')
+		self.assertEqual(1, writer.droppedLines)
+		unblock.set()
+		writer.close()
+		self.assertEqual(['a\n', 'b\n', 'c\n'], self.file.writes)
+
+
+
+class BetterSiteLogTests(unittest.TestCase):
+
+	def _request(self, site):
+		channel = site.buildProtocol(None)
+		channel.makeConnection(DummyTCPTransport())
+		channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		channel.connectionLost(None)
+
+
+	def test_bufferedLog(self):
+		clock = Clock()
+		path = self.mktemp()
+		site = BetterSite(BetterResource(), logPath=path, clock=clock,
+			logFormat=COMPACT, logBufferSize=1024)
+		site.startFactory()
+		self.assertTrue(isinstance(site.logFile, BufferedLogWriter))
+		try:
+			self._request(site)
+			self._request(site)
+		finally:
+			site.stopFactory()
+		lines = open(path).read().splitlines()
+		self.assertEqual(2, len(lines))
+		self.assertTrue(lines[0].startswith('1970-01-01T00:00:00Z '), lines)
+		self.assertTrue(' 192.168.1.1 GET / 404 ' in lines[0], lines)
+
+
+	def test_unbufferedLog(self):
+		path = self.mktemp()
+		site = BetterSite(BetterResource(), logPath=path, clock=Clock())
+		site.startFactory()
+		try:
+			self._request(site)
+			self.assertFalse(isinstance(site.logFile, BufferedLogWriter))
+			self.assertEqual(1, len(open(path).read().splitlines()))
+		finally:
+			site.stopFactory()
+		self.assertTrue(
+			datetimeToLogString(0) in open(path).read())
@@ -1,9 +1,71 @@
+import hmac
 import base64
+import hashlib
 
 from zope.interface import verify
 from twisted.trial import unittest
 
-from webmagic.csrf import ICsrfStopper, CsrfStopper, RejectToken
+from webmagic import csrf
+from webmagic.csrf import (
+	ICsrfStopper, CsrfStopper, KeyringCsrfStopper, RejectToken,
+	constantTimeCompare)
+
+
+
+class _ConstantTimeCompareTests(object):
+
+	def test_equal(self):
+		self.assertTrue(constantTimeCompare('', ''))
+		self.assertTrue(constantTimeCompare('abc', 'abc'))
+		self.assertTrue(constantTimeCompare('\x00\xff', '\x00\xff'))
+
+
+	def test_notEqual(self):
+		self.assertFalse(constantTimeCompare('abc', 'abd'))
+		self.assertFalse(constantTimeCompare('abc', 'ab'))
+		self.assertFalse(constantTimeCompare('', 'a'))
+
+
+	def test_unicodeRaisesTypeError(self):
+		self.assertRaises(TypeError, lambda: constantTimeCompare(u'a', 'a'))
+		self.assertRaises(TypeError, lambda: constantTimeCompare('a', u'a'))
+		self.assertRaises(TypeError, lambda: constantTimeCompare(u'a', u'a'))
+
+
+
+class NativeConstantTimeCompareTests(
+_ConstantTimeCompareTests, unittest.TestCase):
+
+	if csrf._compareDigest is None:
+		skip = "hmac.compare_digest is not available"
+
+
+	def test_usesCompareDigest(self):
+		calls = []
+		def compareDigest(s1, s2):
+			calls.append((s1, s2))
+			return True
+		self.patch(csrf, '_compareDigest', compareDigest)
+		self.assertTrue(constantTimeCompare('a', 'b'))
+		self.assertEqual([('a', 'b')], calls)
+
+
+
+class PureConstantTimeCompareTests(
+_ConstantTimeCompareTests, unittest.TestCase):
+
+	def setUp(self):
+		self.patch(csrf, '_compareDigest', None)
+
+
+	def test_usesPureFallback(self):
+		calls = []
+		def pureCompare(s1, s2):
+			calls.append((s1, s2))
+			return True
+		self.patch(csrf, '_pureConstantTimeCompare', pureCompare)
+		self.assertTrue(constantTimeCompare('a', 'b'))
+		self.assertEqual([('a', 'b')], calls)
 
 
 
@@ -62,6 +124,27 @@ class CsrfStopperTests(unittest.TestCase):
 		self.assertEqual(144, len(decoded) * 8)
 
 
+	def test_makeTokenIsTruncatedHMAC(self):
+		"""
+		Tokens are the version followed by the first 128 bits of the
+		HMAC-SHA256 of the uuid, so tokens made before the key state was
+		precomputed are still valid.
+		"""
+		c = CsrfStopper("secret string")
+		expected = '\x00\x00' + hmac.new(
+			"secret string", "id", hashlib.sha256).digest()[:16]
+		self.assertEqual(base64.urlsafe_b64encode(expected), c.makeToken("id"))
+		# The precomputed state is not modified by making a token.
+		self.assertEqual(c.makeToken("id"), c.makeToken("id"))
+
+
+	def test_makeTokens(self):
+		c = CsrfStopper("secret string")
+		uuids = ["id", "id 2", "", "id"]
+		self.assertEqual([c.makeToken(i) for i in uuids], c.makeTokens(uuids))
+		self.assertEqual([], c.makeTokens([]))
+
+
 	def test_checkTokenWorks(self):
 		c = CsrfStopper("secret string")
 		i = "id"
@@ -105,3 +188,77 @@ class CsrfStopperTests(unittest.TestCase):
 		##self.assertRaises(RejectToken, lambda: c.checkToken(i, token + '='))
 		##self.assertRaises(RejectToken, lambda: c.checkToken(i, token + '=='))
 		##self.assertRaises(RejectToken, lambda: c.checkToken(i, token + '==='))
+
+
+
+class KeyringCsrfStopperTests(unittest.TestCase):
+
+	def test_implements(self):
+		verify.verifyObject(
+			ICsrfStopper, KeyringCsrfStopper({1: "secret string"}, 1))
+
+
+	def test_tokenEmbedsVersion(self):
+		c = KeyringCsrfStopper({0: "old", 258: "new"}, 258)
+		decoded = base64.urlsafe_b64decode(c.makeToken("id"))
+		self.assertEqual(18, len(decoded))
+		self.assertEqual('\x01\x02', decoded[:2])
+
+
+	def test_compatibleWithCsrfStopper(self):
+		old = CsrfStopper("secret string")
+		c = KeyringCsrfStopper({0: "secret string"}, 0)
+		self.assertEqual(old.makeToken("id"), c.makeToken("id"))
+		c.checkToken("id", old.makeToken("id"))
+
+
+	def test_rotation(self):
+		c = KeyringCsrfStopper({1: "old"}, 1)
+		oldToken = c.makeToken("id")
+
+		c.addKey(2, "new")
+		c.setCurrentVersion(2)
+		newToken = c.makeToken("id")
+		self.assertNotEqual(oldToken, newToken)
+		c.checkToken("id", oldToken)
+		c.checkToken("id", newToken)
+		self.assertEqual([1, 2], c.getVersions())
+
+		c.removeKey(1)
+		self.assertRaises(RejectToken, lambda: c.checkToken("id", oldToken))
+		c.checkToken("id", newToken)
+
+
+	def test_replaceCurrentKey(self):
+		c = KeyringCsrfStopper({1: "old"}, 1)
+		oldToken = c.makeToken("id")
+		c.addKey(1, "new")
+		self.assertNotEqual(oldToken, c.makeToken("id"))
+		self.assertRaises(RejectToken, lambda: c.checkToken("id", oldToken))
+
+
+	def test_checkTokenRejects(self):
+		c = KeyringCsrfStopper({1: "secret string"}, 1)
+		token = c.makeToken("id")
+		self.assertRaises(RejectToken, lambda: c.checkToken("id 2", token))
+		self.assertRaises(RejectToken, lambda: c.checkToken("id", 'x' + token))
+		self.assertRaises(RejectToken, lambda: c.checkToken("id", ''))
+		# Unknown version, correct HMAC for another version
+		wrong = base64.urlsafe_b64encode(
+			'\x00\x07' + base64.urlsafe_b64decode(token)[2:])
+		self.assertRaises(RejectToken, lambda: c.checkToken("id", wrong))
+
+
+	def test_makeTokens(self):
+		c = KeyringCsrfStopper({1: "secret string"}, 1)
+		uuids = ["id", "id 2"]
+		self.assertEqual([c.makeToken(i) for i in uuids], c.makeTokens(uuids))
+
+
+	def test_badVersions(self):
+		self.assertRaises(ValueError, lambda: KeyringCsrfStopper({-1: "s"}, -1))
+		self.assertRaises(ValueError,
+			lambda: KeyringCsrfStopper({65536: "s"}, 65536))
+		self.assertRaises(KeyError, lambda: KeyringCsrfStopper({1: "s"}, 2))
+		c = KeyringCsrfStopper({1: "s"}, 1)
+		self.assertRaises(ValueError, lambda: c.removeKey(1))
@@ -1,3 +1,6 @@
+import os
+import errno
+
 from twisted.trial import unittest
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
@@ -132,3 +135,499 @@ class FileCacheTests(unittest.TestCase):
 		fc.clearCache()
 		self.assertEqual(2, a.calls)
 		self.assertEqual(2, b.calls)
+
+
+
+class InvalidationTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.fingerprints = {}
+		self.reads = []
+		def getContent(filename):
+			self.reads.append(filename)
+			return filename
+		self.fc = filecache.FileCache(
+			lambda: self.clock.seconds(), 10,
+			lambda filename: self.fingerprints.get(filename, 1),
+			getContent)
+
+
+	def test_invalidate(self):
+		self.fc.getContent('/a/one')
+		self.fc.getContent('/a/one', transform=len)
+		self.fc.getContent('/a/two')
+		self.assertEqual(True, self.fc.invalidate('/a/one'))
+		self.assertEqual(False, self.fc.invalidate('/a/one'))
+		self.assertEqual(False, self.fc.invalidate('/a/three'))
+		self.assertEqual(('/a/one', True), self.fc.getContent('/a/one'))
+		self.assertEqual((6, True), self.fc.getContent('/a/one', transform=len))
+		self.assertEqual(('/a/two', False), self.fc.getContent('/a/two'))
+
+
+	def test_invalidatePrefix(self):
+		for f in ['/a/one', '/a/b/two', '/ab/three', '/a']:
+			self.fc.getContent(f)
+		self.reads = []
+		self.assertEqual(2, self.fc.invalidatePrefix('/a/'))
+		self.assertEqual(0, self.fc.invalidatePrefix('/a'))
+		for f in ['/a/one', '/a/b/two', '/ab/three', '/a']:
+			self.fc.getContent(f)
+		self.assertEqual(['/a/one', '/a/b/two'], self.reads)
+
+
+	def test_generation(self):
+		g = self.fc.getGeneration()
+		self.fc.getContent('/a/one')
+		self.fc.getContent('/a/two')
+		self.assertEqual(g, self.fc.getGeneration())
+		self.fc.invalidate('/a/nope')
+		self.assertEqual(g, self.fc.getGeneration())
+		self.fc.invalidate('/a/one')
+		self.assertEqual(g + 1, self.fc.getGeneration())
+		self.fc.invalidatePrefix('/a')
+		self.assertEqual(g + 2, self.fc.getGeneration())
+		self.fc.clearCache()
+		self.assertEqual(g + 3, self.fc.getGeneration())
+
+		self.fc.getContent('/a/one')
+		self.clock.advance(10)
+		self.fc.getContent('/a/one')
+		self.assertEqual(g + 3, self.fc.getGeneration())
+		self.fingerprints['/a/one'] = 2
+		self.clock.advance(10)
+		self.fc.getContent('/a/one')
+		self.assertEqual(g + 4, self.fc.getGeneration())
+
+
+	def test_changedFileReadOnce(self):
+		"""
+		After a file changes, it is read once, and then served from the
+		cache again.
+		"""
+		self.fc.getContent('/a/one')
+		self.fingerprints['/a/one'] = 2
+		self.clock.advance(10)
+		self.assertEqual(('/a/one', True), self.fc.getContent('/a/one'))
+		self.assertEqual(('/a/one', False), self.fc.getContent('/a/one'))
+		self.clock.advance(10)
+		self.assertEqual(('/a/one', False), self.fc.getContent('/a/one'))
+		self.assertEqual(['/a/one', '/a/one'], self.reads)
+
+
+	def test_changeListeners(self):
+		calls = []
+		self.fc.addChangeListener('/a/one', calls.append)
+		self.fc.addChangeListener('/a/two', calls.append)
+		self.fc.getContent('/a/one')
+		self.fc.getContent('/a/two')
+
+		self.fc.invalidate('/a/one')
+		self.assertEqual(['/a/one'], calls)
+
+		self.fc.invalidatePrefix('/a')
+		self.assertEqual(['/a/one', '/a/two'], calls)
+
+		self.fc.getContent('/a/two')
+		self.fingerprints['/a/two'] = 2
+		self.clock.advance(10)
+		self.fc.getContent('/a/two')
+		self.assertEqual(['/a/one', '/a/two', '/a/two'], calls)
+
+		self.fc.removeChangeListener('/a/two', calls.append)
+		self.fc.clearCache()
+		self.assertEqual(['/a/one', '/a/two', '/a/two', '/a/one'], calls)
+
+
+
+class MissingFileTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.stats = []
+		self.fc = filecache.FileCache(
+			lambda: self.clock.seconds(), 10, self._fingerprint)
+		self.filename = self.mktemp()
+
+
+	def _fingerprint(self, filename):
+		self.stats.append(filename)
+		return filecache.defaultFingerprint(filename)
+
+
+	def test_missingCached(self):
+		e1 = self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.assertTrue(filecache.isMissingError(e1))
+		FilePath(self.filename).setContent('aaaa')
+		e2 = self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.assertIdentical(e1, e2)
+		self.assertEqual(1, len(self.stats))
+
+		self.clock.advance(10)
+		self.assertEqual(('aaaa', True), self.fc.getContent(self.filename))
+		self.assertEqual(2, len(self.stats))
+
+
+	def test_stillMissing(self):
+		self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.clock.advance(10)
+		g = self.fc.getGeneration()
+		self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.assertEqual(2, len(self.stats))
+		self.assertEqual(g, self.fc.getGeneration())
+
+
+	def test_deleted(self):
+		calls = []
+		self.fc.addChangeListener(self.filename, calls.append)
+		FilePath(self.filename).setContent('aaaa')
+		self.fc.getContent(self.filename)
+		FilePath(self.filename).remove()
+		self.clock.advance(10)
+		g = self.fc.getGeneration()
+		self.assertRaises(OSError, self.fc.getContent, self.filename)
+		self.assertEqual(g + 1, self.fc.getGeneration())
+		self.assertEqual([self.filename], calls)
+
+
+	def test_invalidate(self):
+		self.assertRaises(OSError, self.fc.getContent, self.filename)
+		FilePath(self.filename).setContent('aaaa')
+		self.assertEqual(True, self.fc.invalidate(self.filename))
+		self.assertEqual(('aaaa', True), self.fc.getContent(self.filename))
+
+
+	def test_notDirectory(self):
+		FilePath(self.filename).setContent('aaaa')
+		child = FilePath(self.filename).child('x').path
+		self.assertRaises(OSError, self.fc.getContent, child)
+		self.assertRaises(OSError, self.fc.getContent, child)
+		self.assertEqual(1, len(self.stats))
+
+
+	def test_otherErrorsNotCached(self):
+		def fingerprint(filename):
+			self.stats.append(filename)
+			raise OSError(errno.EACCES, "Permission denied")
+		fc = filecache.FileCache(lambda: self.clock.seconds(), 10, fingerprint)
+		self.assertRaises(OSError, fc.getContent, 'x')
+		self.assertRaises(OSError, fc.getContent, 'x')
+		self.assertEqual(['x', 'x'], self.stats)
+
+
+
+class FakeDirEntry(object):
+
+	def __init__(self, directory, name, stats):
+		self.name = name
+		self._path = os.path.join(directory, name)
+		self._stats = stats
+
+
+	def stat(self):
+		self._stats.append(self._path)
+		return os.stat(self._path)
+
+
+
+class DirectoryFingerprintTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.dir = FilePath(self.mktemp())
+		self.dir.makedirs()
+		for name in ['a', 'b', 'c']:
+			self.dir.child(name).setContent(name)
+		self.passes = []
+		self.fc = filecache.FileCache(lambda: self.clock.seconds(), 10,
+			directoryFingerprintCallable=self._directoryFingerprint)
+
+
+	def _directoryFingerprint(self, directory, names):
+		self.passes.append((directory, sorted(names)))
+		return filecache.defaultDirectoryFingerprint(directory, names)
+
+
+	def test_onePassPerDirectory(self):
+		for name in ['a', 'b', 'c']:
+			self.fc.getContent(self.dir.child(name).path)
+		self.clock.advance(10)
+		self.dir.child('b').setContent('bb')
+		self.assertEqual(('a', False), self.fc.getContent(self.dir.child('a').path))
+		self.assertEqual([(self.dir.path, ['a', 'b', 'c'])], self.passes)
+		# The others were rechecked in the same pass.
+		self.assertEqual(('bb', True), self.fc.getContent(self.dir.child('b').path))
+		self.assertEqual(('c', False), self.fc.getContent(self.dir.child('c').path))
+		self.assertEqual(1, len(self.passes))
+
+
+	def test_changesReported(self):
+		calls = []
+		b = self.dir.child('b').path
+		self.fc.addChangeListener(b, calls.append)
+		self.fc.getContent(self.dir.child('a').path)
+		self.fc.getContent(b)
+		self.dir.child('b').remove()
+		self.clock.advance(10)
+		g = self.fc.getGeneration()
+		self.fc.getContent(self.dir.child('a').path)
+		self.assertEqual([b], calls)
+		self.assertEqual(g + 1, self.fc.getGeneration())
+		e = self.assertRaises(OSError, self.fc.getContent, b)
+		self.assertTrue(filecache.isMissingError(e))
+
+		self.dir.child('b').setContent('new')
+		self.clock.advance(10)
+		self.assertEqual(('new', True), self.fc.getContent(b))
+
+
+	def test_invalidate(self):
+		a = self.dir.child('a').path
+		self.fc.getContent(a)
+		self.fc.getContent(self.dir.child('b').path)
+		self.fc.invalidate(a)
+		self.clock.advance(10)
+		self.fc.getContent(self.dir.child('b').path)
+		self.assertEqual([(self.dir.path, ['b'])], self.passes)
+		self.fc.invalidatePrefix(self.dir.path)
+		self.fc.getContent(a)
+		self.clock.advance(10)
+		self.fc.getContent(a)
+		self.assertEqual((self.dir.path, ['a']), self.passes[-1])
+
+
+	def test_defaultDirectoryFingerprint(self):
+		names = ['a', 'c', 'missing']
+		expected = dict((name, filecache.defaultFingerprint(
+			self.dir.child(name).path)) for name in ['a', 'c'])
+		self.assertEqual(expected,
+			filecache.defaultDirectoryFingerprint(self.dir.path, names))
+		self.assertEqual({},
+			filecache.defaultDirectoryFingerprint(self.dir.path + 'x', names))
+
+
+	def test_defaultDirectoryFingerprintScandir(self):
+		stats = []
+		def scandir(directory):
+			return [FakeDirEntry(directory, name, stats)
+				for name in os.listdir(directory)]
+		self.patch(filecache, '_scandir', scandir)
+		self.test_defaultDirectoryFingerprint()
+		# Only the names asked for were stat'ed.
+		self.assertEqual(
+			sorted(self.dir.child(name).path for name in ['a', 'c']),
+			sorted(stats))
+
+
+
+class FileCacheRefresherTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.fingerprints = {}
+		self.stats = []
+		self.reads = []
+		def fingerprint(filename):
+			self.stats.append(filename)
+			value = self.fingerprints.get(filename, 1)
+			if value is None:
+				raise OSError(errno.ENOENT, "No such file", filename)
+			return value
+		def getContent(filename):
+			self.reads.append(filename)
+			return '%s:%s' % (filename, self.fingerprints.get(filename, 1))
+		self.fc = filecache.FileCache(
+			self.clock.seconds, 10, fingerprint, getContent)
+		self.refresher = filecache.FileCacheRefresher(
+			self.fc, maxInterval=40, clock=self.clock)
+
+
+	def tearDown(self):
+		if self.refresher._call is not None:
+			self.refresher.stop()
+
+
+	def test_getContentNeverRechecks(self):
+		self.fc.getContent('a')
+		self.refresher.start()
+		self.fc.getContent('b')
+		self.stats = []
+		self.reads = []
+		# The refresher hasn't run, so getContent must not stat.
+		self.clock.advance(0.5)
+		self.fc.getContent('a')
+		self.fc.getContent('b')
+		self.assertEqual([], self.stats)
+		self.assertEqual([], self.reads)
+
+
+	def test_refreshesAndRereads(self):
+		self.fc.getContent('a')
+		self.fc.getContent('a', transform=len)
+		self.refresher.start()
+		self.reads = []
+		self.fingerprints['a'] = 2
+		self.clock.pump([1] * 10)
+		# Read once for both transforms.
+		self.assertEqual(['a'], self.reads)
+		self.reads = []
+		g = self.fc.getGeneration()
+		self.assertEqual(('a:2', True), self.fc.getContent('a'))
+		self.assertEqual(('a:2', False), self.fc.getContent('a'))
+		self.assertEqual((3, True), self.fc.getContent('a', transform=len))
+		self.assertEqual([], self.reads)
+		self.assertEqual(g, self.fc.getGeneration())
+		self.assertEqual(1, self.refresher.changes)
+
+
+	def test_adaptiveInterval(self):
+		self.fc.getContent('a')
+		self.refresher.start()
+		self.assertEqual(10, self.refresher.getInterval('a'))
+		self.clock.pump([1] * 10)
+		self.assertEqual(20, self.refresher.getInterval('a'))
+		self.clock.pump([1] * 20)
+		self.assertEqual(40, self.refresher.getInterval('a'))
+		self.clock.pump([1] * 40)
+		self.assertEqual(40, self.refresher.getInterval('a'))
+		self.assertEqual(3, self.refresher.rechecks)
+
+		self.fingerprints['a'] = 2
+		self.clock.pump([1] * 40)
+		self.assertEqual(10, self.refresher.getInterval('a'))
+
+
+	def test_spreadsInitialChecks(self):
+		for i in xrange(10):
+			self.fc.getContent(str(i))
+		self.refresher.start()
+		self.stats = []
+		checksPerTick = []
+		for i in xrange(10):
+			self.clock.advance(1)
+			checksPerTick.append(len(self.stats))
+			self.stats = []
+		self.assertEqual([1] * 10, checksPerTick)
+
+
+	def test_maxChecksPerTick(self):
+		self.refresher = filecache.FileCacheRefresher(
+			self.fc, maxChecksPerTick=2, clock=self.clock)
+		self.refresher.start()
+		for i in xrange(5):
+			self.fc.getContent(str(i))
+		self.stats = []
+		self.clock.pump([1] * 9)
+		self.assertEqual(0, len(self.stats))
+		self.clock.advance(1)
+		self.assertEqual(2, len(self.stats))
+		self.clock.advance(1)
+		self.assertEqual(4, len(self.stats))
+		self.clock.advance(1)
+		self.assertEqual(5, len(self.stats))
+
+
+	def test_missingFiles(self):
+		self.fingerprints['a'] = None
+		self.assertRaises(OSError, self.fc.getContent, 'a')
+		self.refresher.start()
+		self.fingerprints['a'] = 3
+		self.assertRaises(OSError, self.fc.getContent, 'a')
+		self.clock.pump([1] * 10)
+		self.assertEqual(('a:3', True), self.fc.getContent('a'))
+
+		self.fingerprints['a'] = None
+		self.clock.pump([1] * 10)
+		self.assertRaises(OSError, self.fc.getContent, 'a')
+
+
+	def test_invalidatedFilesDropped(self):
+		self.fc.getContent('a')
+		self.refresher.start()
+		self.fc.invalidate('a')
+		self.clock.pump([1] * 10)
+		self.assertEqual(None, self.refresher.getInterval('a'))
+		self.fc.getContent('a')
+		self.assertEqual(10, self.refresher.getInterval('a'))
+
+
+	def test_stop(self):
+		self.fc.getContent('a')
+		self.refresher.start()
+		self.refresher.stop()
+		self.assertEqual([], self.clock.getDelayedCalls())
+		self.stats = []
+		self.clock.advance(10)
+		self.fc.getContent('a')
+		self.assertEqual(['a'], self.stats)
+
+
+	def test_errorsLogged(self):
+		self.fc.getContent('a')
+		self.refresher.start()
+		def fingerprint(filename):
+			raise OSError(errno.EACCES, "Permission denied")
+		self.fc._fingerprintCallable = fingerprint
+		self.clock.pump([1] * 10)
+		self.assertEqual(1, len(self.flushLoggedErrors(OSError)))
+		self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+
+	def test_directoryPasses(self):
+		directory = FilePath(self.mktemp())
+		directory.makedirs()
+		passes = []
+		def directoryFingerprint(directory, names):
+			passes.append(sorted(names))
+			return filecache.defaultDirectoryFingerprint(directory, names)
+		fc = filecache.FileCache(self.clock.seconds, 10,
+			directoryFingerprintCallable=directoryFingerprint)
+		for name in ['a', 'b']:
+			directory.child(name).setContent(name)
+			fc.getContent(directory.child(name).path)
+		refresher = filecache.FileCacheRefresher(fc, clock=self.clock)
+		refresher.start()
+		self.addCleanup(refresher.stop)
+		directory.child('b').setContent('bb')
+		self.clock.pump([1] * 10)
+		# The first file's pass also rechecked the second.
+		self.assertEqual([['a', 'b']], passes)
+		self.assertEqual(20, refresher.getInterval(directory.child('a').path))
+		self.assertEqual(10, refresher.getInterval(directory.child('b').path))
+		self.assertEqual(('bb', True), fc.getContent(directory.child('b').path))
+
+
+	def test_listenerInvalidatesAndReads(self):
+		"""
+		A change listener called by the refresher may invalidate files in
+		the batch being refreshed, and gets the new content of the file
+		that changed.
+		"""
+		directory = FilePath(self.mktemp())
+		directory.makedirs()
+		a, b = directory.child('a').path, directory.child('b').path
+		fc = filecache.FileCache(self.clock.seconds, 10,
+			directoryFingerprintCallable=filecache.defaultDirectoryFingerprint)
+		for child in [directory.child('a'), directory.child('b')]:
+			child.setContent('old')
+			fc.getContent(child.path)
+		seen = []
+		def listener(filename):
+			fc.invalidate(a)
+			fc.invalidate(b)
+			seen.append(fc.getContent(a))
+		fc.addChangeListener(a, listener)
+		refresher = filecache.FileCacheRefresher(fc, clock=self.clock)
+		refresher.start()
+		self.addCleanup(refresher.stop)
+		directory.child('a').setContent('new content')
+		directory.child('b').setContent('new content')
+		self.clock.pump([1] * 10)
+		self.assertEqual([], self.flushLoggedErrors())
+		# invalidate(a) calls the listener again, from inside the first call.
+		self.assertEqual(
+			[('new content', True), ('new content', False)], seen)
+		self.assertEqual(('new content', False), fc.getContent(a))
+		self.assertEqual(2, refresher.changes)
+		self.assertEqual(None, refresher.getInterval(b))
@@ -0,0 +1,165 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.web import server, resource
+from twisted.web.resource import getChildForRequest
+
+from webmagic.filecache import FileCache, defaultFingerprint
+from webmagic.transforms import md5hexdigest
+from webmagic.untwist import BetterResource, BetterFile, HelpfulNoResource
+from webmagic.pathmanip import (
+	makeRequestForPath, getResourceForPath, getCacheBrokenHref)
+
+
+class Leaf(resource.Resource):
+	isLeaf = True
+
+
+
+class GetResourceForPathTests(unittest.TestCase):
+
+	def setUp(self):
+		self.root = BetterResource()
+		self.child = BetterResource()
+		self.leaf = Leaf()
+		self.root.putChild('child', self.child)
+		self.child.putChild('', self.child)
+		self.child.putChild('leaf', self.leaf)
+		self.site = server.Site(self.root)
+
+
+	def test_finds(self):
+		self.assertIdentical(self.leaf, getResourceForPath(self.site, '/child/leaf'))
+		self.assertIdentical(self.child, getResourceForPath(self.site, '/child/'))
+
+
+	def test_unquotes(self):
+		self.assertIdentical(self.leaf, getResourceForPath(self.site, '/chil%64/leaf'))
+
+
+	def test_notFound(self):
+		self.assertIsInstance(
+			getResourceForPath(self.site, '/child/nope'), HelpfulNoResource)
+
+
+	def test_redirect(self):
+		resource = getResourceForPath(self.site, '/child')
+		self.assertEqual('/child/', resource._location)
+
+
+	def test_requestAttributes(self):
+		request = makeRequestForPath(self.site, '/chil%64/leaf')
+		self.assertEqual('/chil%64/leaf', request.path)
+		self.assertEqual('/chil%64/leaf', request.uri)
+		self.assertEqual(['child', 'leaf'], request.postpath)
+		self.assertEqual([], request.prepath)
+		self.assertIdentical(self.site, request.channel.site)
+		self.assertEqual(None, request.getHeader('host'))
+		self.assertEqual(False, request.isSecure())
+
+
+	def test_requestHeaders(self):
+		"""
+		A C{getChild} that reads C{requestHeaders} (like Twisted's virtual
+		host resources do) works, and sees no headers.
+		"""
+		leaf = self.leaf
+		seen = []
+		class HeaderChild(resource.Resource):
+			def getChild(self, path, request):
+				seen.append(request.requestHeaders.getRawHeaders('host'))
+				seen.append(request.getHost().port)
+				return leaf
+		self.root.putChild('headers', HeaderChild())
+		self.assertIdentical(
+			leaf, getResourceForPath(self.site, '/headers/leaf'))
+		self.assertEqual([None, 80], seen)
+
+		request = makeRequestForPath(self.site, '/')
+		request.requestHeaders.setRawHeaders('host', ['example.com'])
+		self.assertEqual('example.com', request.getHeader('host'))
+
+
+	def test_responseMethods(self):
+		"""
+		A C{getChild} that uses the session or sets response headers (as
+		it could on the L{DummyRequest} that lookups used to make) works.
+		"""
+		leaf = self.leaf
+		class SessionChild(resource.Resource):
+			def getChild(self, path, request):
+				request.getSession().touch()
+				request.setHeader('x-seen', path)
+				request.responseHeaders.setRawHeaders('x-more', ['1'])
+				request.addCookie('name', 'value', path='/')
+				request.setResponseCode(200)
+				return leaf
+		self.root.putChild('session', SessionChild())
+
+		request = makeRequestForPath(self.site, '/session/leaf')
+		self.assertIdentical(leaf, getChildForRequest(self.root, request))
+		self.assertEqual(['leaf'],
+			request.responseHeaders.getRawHeaders('x-seen'))
+		self.assertIdentical(request.getSession(), request.getSession())
+		self.assertIdentical(
+			leaf, getResourceForPath(self.site, '/session/leaf'))
+
+
+	def test_channelShared(self):
+		"""
+		All lookups on a site share one channel, instead of building a
+		fake L{server.Site} each.
+		"""
+		r1 = makeRequestForPath(self.site, '/child/')
+		r2 = makeRequestForPath(self.site, '/child/leaf')
+		self.assertIdentical(r1.channel, r2.channel)
+		other = server.Site(self.root)
+		self.assertIdentical(other, makeRequestForPath(other, '/').channel.site)
+
+
+
+class MissingFileTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.stats = []
+		def fingerprint(filename):
+			self.stats.append(filename)
+			return defaultFingerprint(filename)
+		self.fileCache = FileCache(lambda: self.clock.seconds(), 10, fingerprint)
+		self.dir = FilePath(self.mktemp())
+		self.dir.makedirs()
+		root = BetterResource()
+		root.putChild('static', BetterFile(self.dir.path))
+		self.site = server.Site(root)
+		self.request = makeRequestForPath(self.site, '/page')
+
+
+	def test_missingFileRemembered(self):
+		"""
+		A missing file is looked up on disk once per C{recheckDelay}, not
+		on every call.
+		"""
+		href = '/static/missing.png'
+		self.assertEqual('/static/missing.png?cb=not-found',
+			getCacheBrokenHref(self.fileCache, self.request, href))
+		self.assertEqual(1, len(self.stats))
+		self.dir.child('missing.png').setContent('png')
+		self.assertEqual('/static/missing.png?cb=not-found',
+			getCacheBrokenHref(self.fileCache, self.request, href))
+		self.assertEqual(1, len(self.stats))
+
+		self.clock.advance(10)
+		self.assertEqual('/static/missing.png?cb=' + md5hexdigest('png'),
+			getCacheBrokenHref(self.fileCache, self.request, href))
+
+
+	def test_clientRequestsNotCached(self):
+		"""
+		Ordinary requests for missing files don't add entries to a file
+		cache.
+		"""
+		self.assertIsInstance(
+			getResourceForPath(self.site, '/static/missing.png'),
+			resource.ErrorPage)
+		self.assertEqual([], self.stats)
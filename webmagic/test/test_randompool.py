@@ -0,0 +1,64 @@
+import os
+
+from twisted.trial import unittest
+
+from webmagic.randompool import RandomPool
+
+
+class CountingSource(object):
+
+	def __init__(self):
+		self.calls = []
+		self._next = 0
+
+
+	def __call__(self, nbytes):
+		self.calls.append(nbytes)
+		# Unicode, so that every "byte" is distinct.
+		out = u''.join(unichr(self._next + i) for i in xrange(nbytes))
+		self._next += nbytes
+		return out
+
+
+
+class RandomPoolTests(unittest.TestCase):
+
+	def setUp(self):
+		self.source = CountingSource()
+		self.pool = RandomPool(self.source, blockSize=64)
+
+
+	def test_slicesBlocks(self):
+		out = [self.pool(16) for i in xrange(4)]
+		self.assertEqual([64], self.source.calls)
+		self.assertEqual(''.join(chr(i) for i in xrange(64)), ''.join(out))
+
+
+	def test_neverReusesBytes(self):
+		out = ''.join(self.pool(n) for n in [10, 30, 20, 16, 1, 64, 65])
+		self.assertEqual(len(out), len(set(out)))
+		self.assertEqual(206, len(out))
+
+
+	def test_largeRequestsBypassPool(self):
+		self.pool(16)
+		self.assertEqual(100, len(self.pool(100)))
+		self.assertEqual([64, 100], self.source.calls)
+		# The rest of the block is still used.
+		self.pool(48)
+		self.assertEqual([64, 100], self.source.calls)
+
+
+	def test_resetAfterFork(self):
+		self.pool(16)
+		realGetpid = os.getpid
+		self.patch(os, 'getpid', lambda: realGetpid() + 1)
+		self.assertEqual(chr(64), self.pool(16)[0])
+		self.assertEqual([64, 64], self.source.calls)
+
+
+	def test_urandom(self):
+		pool = RandomPool()
+		values = set(pool(16) for i in xrange(1000))
+		self.assertEqual(1000, len(values))
+		self.assertEqual(set([16]), set(len(v) for v in values))
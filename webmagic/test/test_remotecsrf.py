@@ -0,0 +1,179 @@
+from zope.interface import verify
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+
+from webmagic.csrf import ICsrfStopper, CsrfStopper, RejectToken
+from webmagic.remotecsrf import (
+	RemoteCsrfStopper, CsrfTokenServerFactory, RemoteCsrfError,
+	RemoteCsrfTimeout)
+
+
+class CountingStopper(object):
+	"""
+	A L{CsrfStopper} that counts calls, and can be made to hang.
+	"""
+
+	def __init__(self):
+		self._stopper = CsrfStopper("secret string")
+		self.calls = 0
+		self.hang = False
+		self.hanging = []
+
+
+	def _maybeHang(self, result):
+		self.calls += 1
+		if self.hang:
+			d = defer.Deferred()
+			self.hanging.append(d)
+			return d
+		return result
+
+
+	def makeToken(self, uuid):
+		if uuid == 'explode':
+			raise ValueError("boom")
+		return self._maybeHang(self._stopper.makeToken(uuid))
+
+
+	def checkToken(self, uuidStr, token):
+		self._stopper.checkToken(uuidStr, token)
+		return self._maybeHang(None)
+
+
+
+class RemoteCsrfStopperTests(unittest.TestCase):
+
+	def setUp(self):
+		self.local = CsrfStopper("secret string")
+		self.stopper = CountingStopper()
+		self.serverFactory = CsrfTokenServerFactory(self.stopper)
+		self.serverProtocols = []
+		buildProtocol = self.serverFactory.buildProtocol
+		def recordingBuildProtocol(addr):
+			p = buildProtocol(addr)
+			self.serverProtocols.append(p)
+			return p
+		self.serverFactory.buildProtocol = recordingBuildProtocol
+		self.port = reactor.listenTCP(
+			0, self.serverFactory, interface='127.0.0.1')
+		self.addCleanup(self.port.stopListening)
+
+
+	def _makeRemote(self, **kwargs):
+		endpoint = TCP4ClientEndpoint(
+			reactor, '127.0.0.1', self.port.getHost().port)
+		remote = RemoteCsrfStopper(endpoint, **kwargs)
+		self.addCleanup(self._close, remote)
+		return remote
+
+
+	def _close(self, remote):
+		d = remote.close()
+		# Wait for the server side of the connections to close, too.
+		for p in self.serverProtocols:
+			if p.transport.connected:
+				lost = defer.Deferred()
+				connectionLost = p.connectionLost
+				def notify(reason, connectionLost=connectionLost, lost=lost):
+					connectionLost(reason)
+					lost.callback(None)
+				p.connectionLost = notify
+				d.addCallback(lambda _, lost=lost: lost)
+		return d
+
+
+	def test_implements(self):
+		verify.verifyObject(ICsrfStopper, self._makeRemote())
+
+
+	@defer.inlineCallbacks
+	def test_makeAndCheck(self):
+		remote = self._makeRemote()
+		token = yield remote.makeToken("id")
+		self.assertEqual(self.local.makeToken("id"), token)
+		yield remote.checkToken("id", token)
+		yield self.assertFailure(remote.checkToken("id 2", token), RejectToken)
+		yield self.assertFailure(remote.checkToken("id", u'\xff'), RejectToken)
+
+
+	@defer.inlineCallbacks
+	def test_batching(self):
+		"""
+		Calls made in the same reactor iteration are sent in batches of up
+		to C{maxBatchSize}, pipelined on one connection.
+		"""
+		remote = self._makeRemote(poolSize=1, maxBatchSize=30)
+		uuids = ['id%d' % (i,) for i in xrange(100)]
+		tokens = yield defer.gatherResults([remote.makeToken(u) for u in uuids])
+		self.assertEqual(self.local.makeTokens(uuids), tokens)
+		self.assertEqual(1, len(self.serverProtocols))
+		self.assertEqual(4, remote._nextId - 1)
+
+		results = yield defer.DeferredList(
+			[remote.checkToken(u, t) for u, t in zip(uuids, tokens)] +
+			[remote.checkToken('id0', tokens[1])], consumeErrors=True)
+		self.assertEqual([True] * 100 + [False], [ok for ok, _ in results])
+		results[-1][1].trap(RejectToken)
+
+
+	@defer.inlineCallbacks
+	def test_serverError(self):
+		remote = self._makeRemote()
+		d1 = remote.makeToken("explode")
+		d2 = remote.makeToken("id")
+		yield self.assertFailure(d1, RemoteCsrfError)
+		self.assertEqual(self.local.makeToken("id"), (yield d2))
+		self.flushLoggedErrors(ValueError)
+
+
+	@defer.inlineCallbacks
+	def test_pool(self):
+		"""
+		A second connection is opened while the first is waiting for an
+		answer, but no more than C{poolSize}.
+		"""
+		remote = self._makeRemote(poolSize=2)
+		yield remote.makeToken("warm-up")
+		self.stopper.hang = True
+		pending = []
+		for i in xrange(3):
+			pending.append(remote.makeToken("id%d" % (i,)))
+			# Let each batch go out before making the next.
+			yield task.deferLater(reactor, 0.05, lambda: None)
+		self.assertEqual(2, len(self.serverProtocols))
+		for d in self.stopper.hanging:
+			d.callback(self.local.makeToken("x"))
+		tokens = yield defer.gatherResults(pending)
+		self.assertEqual([self.local.makeToken("x")] * 3, tokens)
+
+
+	@defer.inlineCallbacks
+	def test_timeout(self):
+		remote = self._makeRemote(timeout=0.1)
+		self.stopper.hang = True
+		yield self.assertFailure(remote.makeToken("id"), RemoteCsrfTimeout)
+		# The connection was closed; a new one is opened for the next call.
+		self.stopper.hang = False
+		self.assertEqual(self.local.makeToken("id"), (yield remote.makeToken("id")))
+		self.assertEqual(2, len(self.serverProtocols))
+
+
+	@defer.inlineCallbacks
+	def test_connectionRefused(self):
+		port = self.port.getHost().port
+		yield self.port.stopListening()
+		remote = RemoteCsrfStopper(
+			TCP4ClientEndpoint(reactor, '127.0.0.1', port))
+		yield self.assertFailure(remote.makeToken("id"), RemoteCsrfError)
+
+
+	@defer.inlineCallbacks
+	def test_close(self):
+		remote = self._makeRemote()
+		yield remote.makeToken("id")
+		d = remote.makeToken("id")
+		yield remote.close()
+		yield self.assertFailure(d, RemoteCsrfError)
+		yield self.assertFailure(remote.makeToken("id"), RemoteCsrfError)
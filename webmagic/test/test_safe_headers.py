@@ -0,0 +1,71 @@
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+from webmagic.safe_headers import (
+	isValidHeaderValue, setRawHeadersSafely, setManyRawHeadersSafely,
+	addRawHeaderSafely)
+
+
+class SafeHeadersTests(unittest.TestCase):
+
+	def test_isValidHeaderValue(self):
+		self.assertTrue(isValidHeaderValue('text/html; charset=UTF-8'))
+		self.assertFalse(isValidHeaderValue('a\nb'))
+		self.assertFalse(isValidHeaderValue('a\rb'))
+
+
+	def test_setRawHeadersSafely(self):
+		h = Headers()
+		setRawHeadersSafely(h, 'link', ['</a.css>', '</b.js>'])
+		self.assertEqual(['</a.css>', '</b.js>'], h.getRawHeaders('link'))
+
+
+	def test_setRawHeadersSafelyRejects(self):
+		h = Headers()
+		self.assertRaises(TypeError,
+			lambda: setRawHeadersSafely(h, 'x', 'not a list'))
+		self.assertRaises(TypeError,
+			lambda: setRawHeadersSafely(h, 'x', ['ok', u'unicode']))
+		self.assertRaises(TypeError,
+			lambda: setRawHeadersSafely(h, 'x', ['ok', 3]))
+		e = self.assertRaises(ValueError,
+			lambda: setRawHeadersSafely(h, 'x', ['ok', 'a\r\nb', 'ok']))
+		# The bad value is named.
+		self.assertTrue("'a\\r\\nb'" in str(e), str(e))
+		self.assertFalse(h.hasHeader('x'))
+
+
+	def test_addRawHeaderSafely(self):
+		h = Headers()
+		addRawHeaderSafely(h, 'set-cookie', 'a=1')
+		addRawHeaderSafely(h, 'set-cookie', 'b=2')
+		self.assertEqual(['a=1', 'b=2'], h.getRawHeaders('set-cookie'))
+		self.assertRaises(ValueError,
+			lambda: addRawHeaderSafely(h, 'set-cookie', 'c=3\n'))
+
+
+	def test_setManyRawHeadersSafely(self):
+		h = Headers()
+		setManyRawHeadersSafely(h, {
+			'content-security-policy': ["default-src 'self'"],
+			'set-cookie': ['a=1', 'b=2'],
+			'x-empty': [],
+		})
+		self.assertEqual(["default-src 'self'"],
+			h.getRawHeaders('content-security-policy'))
+		self.assertEqual(['a=1', 'b=2'], h.getRawHeaders('set-cookie'))
+		self.assertEqual([], h.getRawHeaders('x-empty'))
+
+
+	def test_setManyRawHeadersSafelyIsAtomic(self):
+		"""
+		If any value is invalid, no header is set.
+		"""
+		h = Headers()
+		for mapping, exc in [
+			({'a': ['1'], 'b': ['2\n']}, ValueError),
+			({'a': ['1'], 'b': [u'2']}, TypeError),
+			({'a': ['1'], 'b': '2'}, TypeError),
+		]:
+			self.assertRaises(exc, lambda: setManyRawHeadersSafely(h, mapping))
+			self.assertEqual([], list(h.getAllRawHeaders()))
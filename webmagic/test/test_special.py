@@ -0,0 +1,65 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.python import failure
+
+from webmagic.fakes import DummyRequest
+from webmagic.special import WaitResource
+
+
+class WaitResourceTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.resource = WaitResource(self.clock)
+
+
+	def _render(self, wait, method='GET'):
+		request = DummyRequest([])
+		request.method = method
+		request.args = {'wait': [str(wait)]}
+		self.resource.render(request)
+		return request
+
+
+	def test_waits(self):
+		request = self._render(3)
+		self.clock.pump([1] * 3)
+		self.assertFalse(request.finished)
+		self.clock.pump([1] * 2)
+		self.assertTrue(request.finished)
+		self.assertTrue(''.join(request.written).startswith('GIF89a'))
+
+
+	def test_noWait(self):
+		"""
+		With wait=0, the response is sent immediately, not on the next
+		tick of the timing wheel.
+		"""
+		for method in ('GET', 'POST'):
+			request = self._render(0, method)
+			self.assertTrue(request.finished)
+			self.assertTrue(request.written)
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+
+	def test_post(self):
+		request = self._render(2, 'POST')
+		self.clock.pump([1] * 4)
+		self.assertEqual("// Done after 2 seconds.", ''.join(request.written))
+
+
+	def test_oneDelayedCallForManyRequests(self):
+		requests = [self._render(i % 30) for i in xrange(1000)]
+		self.assertEqual(1, len(self.clock.getDelayedCalls()))
+		self.clock.pump([1] * 32)
+		self.assertEqual([True] * 1000, [r.finished for r in requests])
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+
+	def test_disconnectCancels(self):
+		request = self._render(10)
+		request.processingFailed(failure.Failure(Exception("gone")))
+		self.assertEqual(0, len(self.resource._wheel))
+		self.assertEqual([], self.clock.getDelayedCalls())
+		self.clock.pump([1] * 12)
+		self.assertEqual([], request.written)
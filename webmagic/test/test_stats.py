@@ -0,0 +1,137 @@
+from twisted.trial import unittest
+
+from webmagic.stats import (
+	Histogram, ConnectionStats, RequestMetrics, formatPrometheusHistograms)
+
+
+class HistogramTests(unittest.TestCase):
+
+	def test_observe(self):
+		h = Histogram([1, 5, 10])
+		for v in [0, 1, 2, 5, 6, 11, 100]:
+			h.observe(v)
+		self.assertEqual([2, 2, 1, 2], h.counts)
+		self.assertEqual(7, h.count)
+		self.assertEqual(125, h.sum)
+
+
+	def test_getCumulative(self):
+		h = Histogram([1, 5])
+		h.observe(1)
+		h.observe(3)
+		h.observe(30)
+		self.assertEqual(
+			[(1, 1), (5, 2), (float('inf'), 3)], h.getCumulative())
+
+
+	def test_reset(self):
+		h = Histogram([1])
+		h.observe(3)
+		h.reset()
+		self.assertEqual([0, 0], h.counts)
+		self.assertEqual(0, h.count)
+		self.assertEqual(0, h.sum)
+
+
+	def test_asDict(self):
+		h = Histogram([1, 5])
+		h.observe(2)
+		self.assertEqual(
+			{'bounds': [1, 5], 'counts': [0, 1, 0], 'count': 1, 'sum': 2},
+			h.asDict())
+
+
+	def test_unsortedBounds(self):
+		self.assertRaises(AssertionError, lambda: Histogram([5, 1]))
+
+
+
+class ConnectionStatsTests(unittest.TestCase):
+
+	def test_counts(self):
+		cs = ConnectionStats()
+		cs.connectionOpened()
+		cs.connectionOpened()
+		cs.connectionClosed(3.0, 2)
+		cs.connectionOpened()
+		self.assertEqual(3, cs.opened)
+		self.assertEqual(1, cs.closed)
+		self.assertEqual(2, cs.current)
+		self.assertEqual(2, cs.peak)
+		self.assertEqual(1, cs.lifetimes.count)
+		self.assertEqual(3.0, cs.lifetimes.sum)
+		self.assertEqual(2, cs.requestsPerConnection.sum)
+
+
+	def test_repr(self):
+		cs = ConnectionStats()
+		cs.connectionOpened()
+		self.assertEqual(
+			'<ConnectionStats opened=1 closed=0 current=1 peak=1>', repr(cs))
+
+
+
+class _Timings(object):
+
+	def __init__(self, resource, received, firstByte, finished, aborted=False):
+		self.resource = resource
+		self.received = received
+		self.firstByte = firstByte
+		self.finished = finished
+		self.aborted = aborted
+
+
+
+class PrometheusTests(unittest.TestCase):
+
+	def test_formatHistograms(self):
+		h = Histogram([0.5, 1])
+		h.observe(0.25)
+		h.observe(2)
+		self.assertEqual([
+			'# HELP t_seconds Some times.',
+			'# TYPE t_seconds histogram',
+			't_seconds_bucket{k="a\\"b",le="0.5"} 1',
+			't_seconds_bucket{k="a\\"b",le="1.0"} 1',
+			't_seconds_bucket{k="a\\"b",le="+Inf"} 2',
+			't_seconds_sum{k="a\\"b"} 2.25',
+			't_seconds_count{k="a\\"b"} 2',
+		], formatPrometheusHistograms('t_seconds', 'Some times.', 'k',
+			{'a"b': h}))
+
+
+
+class RequestMetricsTests(unittest.TestCase):
+
+	def test_observe(self):
+		m = RequestMetrics(bounds=[1, 10])
+		m(_Timings('a.A', 0, 0.5, 2))
+		m(_Timings('a.A', 10, 10, 30))
+		m(_Timings('b.B', 0, 0, 0))
+		m(_Timings('b.B', 0, None, 5, aborted=True))
+		self.assertEqual([0, 1, 1], m.durations['a.A'].counts)
+		self.assertEqual([2, 0, 0], m.firstBytes['a.A'].counts)
+		self.assertEqual(1, m.durations['b.B'].count)
+		self.assertEqual({'b.B': 1}, m.aborted)
+
+
+	def test_asPrometheusText(self):
+		m = RequestMetrics(bounds=[1])
+		m(_Timings('a.A', 0, 0.5, 2))
+		m(_Timings('a.A', 0, None, 5, aborted=True))
+		lines = m.asPrometheusText().split('\n')
+		self.assertEqual('', lines[-1])
+		self.assertTrue('webmagic_request_duration_seconds_count'
+			'{resource="a.A"} 1' in lines, lines)
+		self.assertTrue('webmagic_request_first_byte_seconds_bucket'
+			'{resource="a.A",le="1.0"} 1' in lines, lines)
+		self.assertTrue(
+			'webmagic_requests_aborted_total{resource="a.A"} 1' in lines, lines)
+
+
+	def test_reset(self):
+		m = RequestMetrics()
+		m(_Timings('a.A', 0, 0, 1))
+		m.reset()
+		self.assertEqual({}, m.durations)
+		self.assertEqual({}, m.firstBytes)
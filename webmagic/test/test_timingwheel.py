@@ -0,0 +1,114 @@
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from webmagic.timingwheel import TimingWheel
+
+
+class TimingWheelTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.expired = []
+		self.wheel = TimingWheel(self.clock, 1, self.expired.append)
+
+
+	def test_expiresNotEarly(self):
+		self.wheel.schedule('a', 3)
+		self.clock.advance(2.9)
+		self.assertEqual([], self.expired)
+		self.assertTrue('a' in self.wheel)
+		self.clock.advance(1.1)
+		self.assertEqual(['a'], self.expired)
+		self.assertFalse('a' in self.wheel)
+		self.assertEqual(0, len(self.wheel))
+
+
+	def test_expiresWithinTwoSlots(self):
+		self.clock.advance(0.5)
+		self.wheel.schedule('a', 3)
+		self.clock.pump([1] * 3)
+		self.assertEqual([], self.expired)
+		self.clock.pump([1])
+		self.assertEqual(['a'], self.expired)
+
+
+	def test_reschedule(self):
+		self.wheel.schedule('a', 2)
+		self.clock.advance(1)
+		self.wheel.schedule('a', 2)
+		self.clock.pump([1, 1])
+		self.assertEqual([], self.expired)
+		self.clock.advance(1)
+		self.assertEqual(['a'], self.expired)
+
+
+	def test_cancel(self):
+		self.wheel.schedule('a', 1)
+		self.wheel.schedule('b', 1)
+		self.wheel.cancel('a')
+		# Cancelling a key that isn't scheduled does nothing.
+		self.wheel.cancel('c')
+		self.clock.pump([1, 1])
+		self.assertEqual(['b'], self.expired)
+
+
+	def test_noCallsWhenEmpty(self):
+		"""
+		No call is left on the clock when nothing is scheduled.
+		"""
+		self.assertEqual([], self.clock.getDelayedCalls())
+		self.wheel.schedule('a', 10)
+		self.assertEqual(1, len(self.clock.getDelayedCalls()))
+		self.wheel.cancel('a')
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+		self.wheel.schedule('b', 1)
+		self.clock.pump([1, 1])
+		self.assertEqual(['b'], self.expired)
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+
+	def test_oneCallForManyKeys(self):
+		for i in xrange(1000):
+			self.wheel.schedule(i, i % 20)
+		self.assertEqual(1, len(self.clock.getDelayedCalls()))
+		self.clock.pump([1] * 21)
+		self.assertEqual(range(1000), sorted(self.expired))
+
+
+	def test_clockJump(self):
+		self.wheel.schedule('a', 5)
+		self.wheel.schedule('b', 500000)
+		self.clock.advance(1000)
+		self.assertEqual(['a'], self.expired)
+		self.assertTrue('b' in self.wheel)
+
+
+	def test_rescheduleFromExpired(self):
+		"""
+		A key rescheduled from its C{expired} callback expires again later.
+		"""
+		def expired(key):
+			self.expired.append(key)
+			if len(self.expired) < 3:
+				wheel.schedule(key, 0)
+		wheel = TimingWheel(self.clock, 1, expired)
+		wheel.schedule('a', 0)
+		self.clock.pump([1] * 5)
+		self.assertEqual(['a', 'a', 'a'], self.expired)
+
+
+	def test_cancelFromExpired(self):
+		"""
+		A key cancelled by an earlier C{expired} callback in the same sweep
+		does not expire.
+		"""
+		def expired(key):
+			self.expired.append(key)
+			wheel.cancel('a' if key == 'b' else 'b')
+		wheel = TimingWheel(self.clock, 1, expired)
+		wheel.schedule('a', 1)
+		wheel.schedule('b', 1)
+		self.clock.pump([1, 1])
+		self.assertEqual(1, len(self.expired))
+		self.assertEqual(0, len(wheel))
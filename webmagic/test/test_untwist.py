@@ -1,23 +1,37 @@
 from __future__ import with_statement
 
+import os
 import re
+import sys
+import cgi
+import json
 import base64
 import hashlib
+import subprocess
 
 from twisted.trial import unittest
 
 from twisted.python.filepath import FilePath
 from twisted.internet.defer import succeed
+from twisted.internet import address, task
 from twisted.internet.task import Clock
 from twisted.web import http, server, resource
+from twisted.python import failure, log
+from twisted.protocols import policies
+from twisted.test.proto_helpers import StringTransport
 
 from webmagic.filecache import FileCache
-from webmagic.fakes import DummyChannel, DummyRequest, DummyTCPTransport
+from webmagic.fakes import (
+	DummyChannel, DummyRequest, DummyTCPTransport, DummyListeningPort)
 from webmagic.untwist import (
 	CookieInstaller, BetterResource, RedirectingResource, HelpfulNoResource,
 	_CSSCacheEntry, BetterFile, ResponseCacheOptions,
-	setCachingHeadersOnRequest, BetterSite
+	setCachingHeadersOnRequest, BetterSite, compileRoutes,
+	ConnectionTrackingSite, ConnectionLimits, DisplayConnections,
+	MetricsResource, SlowClientLimits, _unmeasurableTransports
 )
+from webmagic.special import WaitResource
+from webmagic.stats import RequestMetrics
 
 
 class CookieInstallerTests(unittest.TestCase):
@@ -418,6 +432,99 @@ class BetterResourceTests(unittest.TestCase):
 
 
 
+class CompiledRoutesTests(unittest.TestCase):
+	"""
+	Tests for L{BetterSite}'s compileRoutes option.  The compiled site must
+	resolve every path exactly like a site that walks the tree.
+	"""
+	def _makeTree(self):
+		r = NonLeaf()
+		r.putChild('', Leaf())
+		r.putChild('leaf', Leaf())
+		r.putChild('index', NonLeafWithIndexChild())
+		r.putChild('nested', NonLeafWithNonLeafIndexChild())
+		r.putChild('noindex', NonLeafWithChildChild())
+		r.putChild('plainleaf', LeafPlainResource())
+		r.putChild('plain', NonLeafPlainResource())
+		r.putChild('dynamic', DynamicBetterResource())
+		return r
+
+
+	def _resolve(self, site, postpath):
+		req = DummyRequest(postpath[:])
+		req.uri = '/' + '/'.join(postpath)
+		res = site.getResourceFor(req)
+		location = getattr(res, '_location', None)
+		return res.__class__, location, req.prepath, req.postpath
+
+
+	def _assertSameResolution(self, root, postpaths):
+		walking = BetterSite(root)
+		compiled = BetterSite(root, compileRoutes=True)
+		for postpath in postpaths:
+			self.assertEqual(
+				self._resolve(walking, postpath),
+				self._resolve(compiled, postpath), postpath)
+
+
+	def test_sameAsWalking(self):
+		postpaths = [
+			[''], ['', ''], ['leaf'], ['leaf', ''], ['leaf', '', ''],
+			['leaf', 'crud'], ['index'], ['index', ''], ['index', '', ''],
+			['nested'], ['nested', ''], ['nested', '', ''],
+			['noindex'], ['noindex', ''], ['noindex', 'child'],
+			['noindex', 'child', ''], ['plainleaf'], ['plainleaf', ''],
+			['plainleaf', 'crud'], ['plain'], ['plain', ''],
+			['dynamic'], ['dynamic', 'anything'], ['missing'],
+			['missing', 'deeper'],
+		]
+		self._assertSameResolution(self._makeTree(), postpaths)
+
+
+	def test_compiledEntries(self):
+		routes = compileRoutes(self._makeTree())
+		self.assertTrue(('leaf', '') in routes)
+		self.assertTrue(('noindex', 'child', '') in routes)
+		# Not a BetterResource, so nothing below it is compiled.
+		self.assertFalse(('plain', '') in routes)
+		# Paths that aren't in children are never compiled.
+		self.assertFalse(('missing',) in routes)
+
+
+	def test_leafRootNotCompiled(self):
+		self.assertEqual({}, compileRoutes(Leaf()))
+
+
+	def test_cycleDoesNotRecurseForever(self):
+		r = NonLeaf()
+		r.putChild('self', r)
+		r.putChild('', Leaf())
+		routes = compileRoutes(r)
+		self.assertTrue(('self',) in routes)
+		self._assertSameResolution(r, [['self'], ['self', ''], ['self', 'self']])
+
+
+	def test_rebuiltAfterPutChild(self):
+		r = NonLeaf()
+		site = BetterSite(r, compileRoutes=True)
+		self.assertEqual(HelpfulNoResource, self._resolve(site, ['hello', ''])[0])
+
+		sub = NonLeaf()
+		r.putChild('hello', sub)
+		sub.putChild('', Leaf())
+		self.assertEqual(Leaf, self._resolve(site, ['hello', ''])[0])
+		self.assertEqual(
+			RedirectingResource, self._resolve(site, ['hello'])[0])
+
+
+	def test_rebuiltAfterResourceReplaced(self):
+		site = BetterSite(NonLeafWithChildChild(), compileRoutes=True)
+		self.assertEqual(Leaf, self._resolve(site, ['child', ''])[0])
+		site.resource = NonLeafWithIndexChild()
+		self.assertEqual(HelpfulNoResource, self._resolve(site, ['child', ''])[0])
+
+
+
 class CSSCacheEntryTests(unittest.TestCase):
 
 	def test_repr(self):
@@ -627,12 +734,63 @@ i { background-image: url(/sub/sub%%20sub/three.png?cb=%(md5three)s); }
 		return d
 
 
+	def test_cssCacheBreakerAfterInvalidate(self):
+		"""
+		L{CSSResource.getCacheBreaker} notices when the file cache has
+		invalidated the .css file.
+		"""
+		clock = Clock()
+		fc = FileCache(lambda: clock.seconds(), 60)
+		temp = FilePath(self.mktemp() + '.css')
+		temp.setContent("p { color: red; }\n")
+		bf = BetterFile(temp.parent().path, fileCache=fc, rewriteCss=True)
+
+		def getBreaker():
+			request = DummyRequest([temp.basename()])
+			return resource.getChildForRequest(bf, request).getCacheBreaker()
+
+		red = getBreaker()
+		temp.setContent("p { color: green; }\n")
+		self.assertEqual(red, getBreaker())
+		fc.invalidate(temp.path)
+		green = getBreaker()
+		self.assertNotEqual(red, green)
+		self.assertEqual(green, getBreaker())
+
+
 	def test_rewriteCssButNoFileCache(self):
 		self.assertRaises(
 			NotImplementedError,
 			lambda: BetterFile('nonexistent', rewriteCss=True))
 
 
+	def test_contentTypes(self):
+		self.assertEqual('text/javascript', BetterFile.contentTypes['.js'])
+		self.assertEqual('image/x-icon', BetterFile('nonexistent').contentTypes['.ico'])
+		self.assertIdentical(BetterFile.contentTypes, BetterFile.contentTypes)
+
+
+
+class ImportTests(unittest.TestCase):
+
+	def test_noTestModulesOrMimeTypes(self):
+		"""
+		Importing L{webmagic.untwist} does not import fakes or Twisted's
+		test modules, and does not load the mimetypes L{BetterFile} uses.
+		"""
+		code = (
+			"import sys, webmagic.untwist as u; "
+			"print sorted(m for m in sys.modules if m is not None and "
+			"('fakes' in m or '.test' in m)); "
+			"print type(u.BetterFile.__dict__['contentTypes']).__name__")
+		env = os.environ.copy()
+		env['PYTHONPATH'] = os.pathsep.join(sys.path)
+		out = subprocess.Popen(
+			[sys.executable, '-c', code], env=env,
+			stdout=subprocess.PIPE).communicate()[0]
+		self.assertEqual("[]\n_LazyClassAttribute\n", out)
+
+
 
 class TestResponseCacheOptions(unittest.TestCase):
 
@@ -754,3 +912,792 @@ class BetterSiteTests(unittest.TestCase):
 		# Lose the connection to clear HTTPChannel.timeOut, so we don't
 		# have a dirty reactor.
 		channel.connectionLost(None)
+
+
+	def _connect(self, site):
+		channel = site.buildProtocol(None)
+		transport = DummyTCPTransport()
+		channel.makeConnection(transport)
+		return channel, transport
+
+
+	def test_idleTimeout(self):
+		"""
+		An idle connection is timed out by the site's timing wheel, and
+		receiving data resets the timeout.
+		"""
+		clock = Clock()
+		bs = BetterSite(BetterResource(), timeout=10, clock=clock,
+			timeoutGranularity=1)
+		channel, transport = self._connect(bs)
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+
+		clock.advance(8)
+		channel.dataReceived('GET / HTTP/1.1\r\n')
+		clock.pump([1] * 8)
+		self.assertFalse(transport.disconnecting)
+		clock.pump([1] * 4)
+		self.assertTrue(transport.disconnecting)
+
+		channel.connectionLost(None)
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_oneDelayedCallForManyConnections(self):
+		clock = Clock()
+		bs = BetterSite(BetterResource(), clock=clock, timeoutGranularity=1)
+		channels = [self._connect(bs)[0] for i in xrange(100)]
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+		for channel in channels:
+			channel.connectionLost(None)
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+	def test_timeoutDisabledWhileServingRequest(self):
+		"""
+		While a request is being served, the idle timeout is disabled.
+		"""
+		clock = Clock()
+		bs = BetterSite(BetterResource(), timeout=10, clock=clock,
+			timeoutGranularity=1)
+		channel, transport = self._connect(bs)
+		channel.setTimeout(None)
+		clock.pump([1] * 20)
+		self.assertFalse(transport.disconnecting)
+		self.assertEqual(None, channel.setTimeout(10))
+		clock.pump([1] * 12)
+		self.assertTrue(transport.disconnecting)
+		channel.connectionLost(None)
+
+
+	def test_noTimingWheel(self):
+		"""
+		By default, connections use TimeoutMixin's per-connection delayed
+		calls.
+		"""
+		clock = Clock()
+		bs = BetterSite(BetterResource(), clock=clock)
+		self.assertIdentical(None, bs._idleWheel)
+		channel = bs.buildProtocol(None)
+		channel.callLater = clock.callLater
+		channel.makeConnection(DummyTCPTransport())
+		self.assertEqual(1, len(clock.getDelayedCalls()))
+		channel.connectionLost(None)
+		self.assertEqual([], clock.getDelayedCalls())
+
+
+
+class RequestTimingsTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.observed = []
+		self.resource = HoldingResource()
+		self.site = BetterSite(self.resource, clock=self.clock,
+			requestObserver=self.observed.append)
+		self.channel = self.site.buildProtocol(None)
+		self.channel.makeConnection(DummyTCPTransport())
+		self.addCleanup(self.channel.connectionLost, None)
+
+
+	def test_uninstrumentedSite(self):
+		"""
+		Without a requestObserver, the site uses plain L{server.Request}s.
+		"""
+		site = BetterSite(BetterResource())
+		self.assertIdentical(server.Request, site.requestFactory)
+		self.assertFalse('getResourceFor' in site.__dict__)
+
+
+	def test_timings(self):
+		self.clock.advance(10)
+		self.channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		request = self.resource.requests[0]
+		self.assertEqual([], self.observed)
+		self.clock.advance(1)
+		request.write('x')
+		self.clock.advance(2)
+		request.finish()
+
+		[timings] = self.observed
+		self.assertIdentical(request.timings, timings)
+		self.assertEqual(
+			(10, 10, 10, 11, 13),
+			(timings.received, timings.resolved, timings.renderStarted,
+				timings.firstByte, timings.finished))
+		self.assertEqual(
+			'webmagic.test.test_untwist.HoldingResource', timings.resource)
+		self.assertFalse(timings.aborted)
+
+
+	def test_finishWithoutWrite(self):
+		self.channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		self.clock.advance(3)
+		self.resource.requests[0].finish()
+		[timings] = self.observed
+		self.assertEqual(3, timings.firstByte)
+		self.assertEqual(3, timings.finished)
+
+
+	def test_aborted(self):
+		self.channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		self.clock.advance(5)
+		self.channel.connectionLost(None)
+		[timings] = self.observed
+		self.assertTrue(timings.aborted)
+		self.assertEqual(5, timings.finished)
+		self.assertEqual(None, timings.firstByte)
+
+
+	def test_incompleteRequestNotObserved(self):
+		self.channel.dataReceived('GET / HTTP/1.1\r\n')
+		self.channel.connectionLost(None)
+		self.assertEqual([], self.observed)
+
+
+	def test_metricsResource(self):
+		metrics = RequestMetrics()
+		self.site._requestObserver = metrics
+		self.channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		self.clock.advance(0.2)
+		self.resource.requests[0].finish()
+
+		request = DummyRequest([])
+		body = MetricsResource(metrics).render(request)
+		self.assertEqual(['text/plain; version=0.0.4'],
+			request.responseHeaders.getRawHeaders('content-type'))
+		self.assertTrue(
+			'webmagic_request_duration_seconds_bucket{resource='
+			'"webmagic.test.test_untwist.HoldingResource",le="0.25"} 1\n'
+			in body, body)
+
+
+
+class HoldingResource(BetterResource):
+	"""
+	A resource that keeps requests open until the test finishes them.
+	"""
+	isLeaf = True
+
+	def __init__(self):
+		BetterResource.__init__(self)
+		self.requests = []
+
+
+	def render_GET(self, request):
+		self.requests.append(request)
+		return server.NOT_DONE_YET
+
+
+
+class ConnectionTrackingSiteTests(unittest.TestCase):
+
+	def _makeSite(self, limits=None):
+		self.resource = HoldingResource()
+		self.clock = Clock()
+		site = ConnectionTrackingSite(
+			self.resource, clock=self.clock, limits=limits)
+		self.port = DummyListeningPort()
+		site.addListeningPort(self.port)
+		return site
+
+
+	def _connect(self, site):
+		channel = site.buildProtocol(None)
+		transport = DummyTCPTransport()
+		channel.makeConnection(transport)
+		self.addCleanup(lambda: channel.connectionLost(None))
+		return channel
+
+
+	def _disconnect(self, channel):
+		channel.connectionLost(None)
+		# Don't call connectionLost again during cleanup.
+		channel.connectionLost = lambda reason: None
+
+
+	def _request(self, channel):
+		channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		return self.resource.requests[-1]
+
+
+	def test_tracksConnections(self):
+		site = self._makeSite()
+		c1 = self._connect(site)
+		c2 = self._connect(site)
+		self.assertEqual(set([c1, c2]), site.connections)
+		self._disconnect(c1)
+		self.assertEqual(set([c2]), site.connections)
+
+
+	def test_connectionStats(self):
+		site = self._makeSite()
+		c1 = self._connect(site)
+		c2 = self._connect(site)
+		self._request(c1).finish()
+		self._request(c1).finish()
+		self.clock.advance(10)
+		self._disconnect(c1)
+		self.assertEqual(set([c2]), site.connections)
+
+		stats = site.connectionStats
+		self.assertEqual(2, stats.opened)
+		self.assertEqual(1, stats.closed)
+		self.assertEqual(1, stats.current)
+		self.assertEqual(2, stats.peak)
+		self.assertEqual(10, stats.lifetimes.sum)
+		self.assertEqual(2, stats.requestsPerConnection.sum)
+
+
+	def _captureLog(self):
+		messages = []
+		def observer(event):
+			messages.append(''.join(map(str, event['message'])))
+		log.addObserver(observer)
+		self.addCleanup(log.removeObserver, observer)
+		return messages
+
+
+	def test_connectionsNotLoggedByDefault(self):
+		messages = self._captureLog()
+		site = self._makeSite()
+		self._disconnect(self._connect(site))
+		self.assertEqual([], [m for m in messages if 'Connection' in m])
+
+
+	def test_logConnectionsEvery(self):
+		messages = self._captureLog()
+		site = ConnectionTrackingSite(
+			HoldingResource(), clock=Clock(), logConnectionsEvery=3)
+		channels = [self._connect(site) for i in xrange(6)]
+		for channel in channels:
+			self._disconnect(channel)
+		made = [m for m in messages if m.startswith('Connection made')]
+		lost = [m for m in messages if m.startswith('Connection lost')]
+		self.assertEqual(2, len(made))
+		self.assertEqual(2, len(lost))
+		self.assertTrue(repr(channels[2]) in made[0])
+		self.assertTrue(repr(channels[5]) in lost[1])
+
+
+	def test_tracksRequestsInFlight(self):
+		site = self._makeSite()
+		channel = self._connect(site)
+		request = self._request(channel)
+		self.assertEqual(1, site.requestsInFlight)
+		request.finish()
+		self.assertEqual(0, site.requestsInFlight)
+
+		self._request(channel)
+		self.assertEqual(1, site.requestsInFlight)
+		self._disconnect(channel)
+		self.assertEqual(0, site.requestsInFlight)
+
+
+	def test_noLimits(self):
+		site = self._makeSite()
+		for i in xrange(100):
+			self._connect(site)
+		self.assertTrue(self.port.reading)
+
+
+	def test_maxConnections(self):
+		site = self._makeSite(ConnectionLimits(
+			maxConnections=10, connectionsLowWater=5))
+		channels = [self._connect(site) for i in xrange(9)]
+		self.assertTrue(self.port.reading)
+		channels.append(self._connect(site))
+		self.assertFalse(self.port.reading)
+		self.assertTrue(site.acceptingPaused)
+
+		# A port added while paused is paused too.
+		port2 = DummyListeningPort()
+		site.addListeningPort(port2)
+		self.assertFalse(port2.reading)
+
+		for channel in channels[:4]:
+			self._disconnect(channel)
+		self.assertFalse(self.port.reading)
+		self._disconnect(channels[4])
+		self.assertTrue(self.port.reading)
+		self.assertTrue(port2.reading)
+		self.assertFalse(site.acceptingPaused)
+
+
+	def test_maxRequests(self):
+		site = self._makeSite(ConnectionLimits(maxRequests=2))
+		self.assertEqual(1, site._limits.requestsLowWater)
+		c1 = self._connect(site)
+		c2 = self._connect(site)
+		r1 = self._request(c1)
+		self.assertTrue(self.port.reading)
+		self._request(c2)
+		self.assertFalse(self.port.reading)
+		r1.finish()
+		self.assertTrue(self.port.reading)
+
+
+	def test_shedIdle(self):
+		"""
+		With shedIdle, reaching maxConnections closes the connections that
+		have been idle the longest.
+		"""
+		site = self._makeSite(ConnectionLimits(
+			maxConnections=4, connectionsLowWater=2, shedIdle=True))
+		c1 = self._connect(site)
+		c2 = self._connect(site)
+		c3 = self._connect(site)
+		self._request(c2).finish()
+		self._request(c1).finish()
+		self._request(c3).finish()
+		# c3 is busy again, so it is not idle.
+		self._request(c3)
+		self.assertEqual([c2, c1], list(site._idleConnections))
+
+		c4 = self._connect(site)
+		self.assertTrue(c2.transport.disconnecting)
+		self.assertTrue(c1.transport.disconnecting)
+		self.assertFalse(c3.transport.disconnecting)
+		self.assertFalse(c4.transport.disconnecting)
+		self.assertFalse(self.port.reading)
+
+		self._disconnect(c2)
+		self._disconnect(c1)
+		self.assertTrue(self.port.reading)
+
+
+	def test_idleNotTrackedWithoutShedIdle(self):
+		site = self._makeSite(ConnectionLimits(maxConnections=4))
+		channel = self._connect(site)
+		self._request(channel).finish()
+		self.assertEqual([], list(site._idleConnections))
+
+
+
+	def test_drain(self):
+		"""
+		Draining stops listening, closes idle connections right away, and
+		closes busy connections after their responses are done.
+		"""
+		site = self._makeSite()
+		idle = self._connect(site)
+		busy = self._connect(site)
+		request = self._request(busy)
+		progress = []
+		d = site.drain(10, progress=lambda *args: progress.append(args))
+		fired = []
+		d.addCallback(fired.append)
+
+		self.assertFalse(self.port.listening)
+		self.assertTrue(site.draining)
+		self.assertTrue(idle.transport.disconnecting)
+		self.assertFalse(busy.transport.disconnecting)
+		self.assertEqual(['close'],
+			request.responseHeaders.getRawHeaders('connection'))
+		self.assertEqual([(2, 1)], progress)
+
+		self._disconnect(idle)
+		self.clock.advance(1)
+		self.assertEqual([(2, 1), (1, 1)], progress)
+
+		request.finish()
+		self.assertTrue(busy.transport.disconnecting)
+		self.assertEqual([], fired)
+		self._disconnect(busy)
+		self.assertEqual([None], fired)
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+
+	def test_drainWhileReceivingHeaders(self):
+		"""
+		A request whose headers are still arriving when the drain starts
+		gets C{Connection: close}, and its connection is closed after the
+		response.
+		"""
+		site = self._makeSite()
+		channel = self._connect(site)
+		channel.dataReceived('GET / HTTP/1.1\r\n')
+		site.drain(10, progress=lambda *args: None)
+		channel.dataReceived('Host: example.com\r\n\r\n')
+		request = self.resource.requests[-1]
+		self.assertEqual(['close'],
+			request.responseHeaders.getRawHeaders('connection'))
+		request.finish()
+		self.assertTrue(channel.transport.disconnecting)
+		self.assertFalse(channel.transport.aborted)
+
+
+	def test_drainTimeout(self):
+		"""
+		Connections still open after the timeout are aborted.
+		"""
+		site = self._makeSite()
+		busy = self._connect(site)
+		self._request(busy)
+		d = site.drain(10, progress=lambda *args: None)
+		self.clock.pump([1] * 9)
+		self.assertFalse(busy.transport.aborted)
+		self.clock.advance(1)
+		self.assertTrue(busy.transport.aborted)
+		self._disconnect(busy)
+		return d
+
+
+	def test_drainWithNoConnections(self):
+		site = self._makeSite()
+		d = site.drain(10, progress=lambda *args: None)
+		self.assertEqual([], self.clock.getDelayedCalls())
+		return d
+
+
+	def test_drainTwice(self):
+		site = self._makeSite()
+		self._connect(site)
+		site.drain(10, progress=lambda *args: None)
+		self.assertRaises(RuntimeError, lambda: site.drain(10))
+
+
+	def test_drainDoesNotResumeAccepting(self):
+		site = self._makeSite(ConnectionLimits(maxConnections=2))
+		c1 = self._connect(site)
+		self._connect(site)
+		self.assertTrue(site.acceptingPaused)
+		site.drain(10, progress=lambda *args: None)
+		self._disconnect(c1)
+		self.assertTrue(site.acceptingPaused)
+		self.assertFalse(self.port.reading)
+
+
+	def test_newConnectionWhileDraining(self):
+		site = self._makeSite()
+		self._connect(site)
+		site.drain(10, progress=lambda *args: None)
+		late = self._connect(site)
+		self.assertTrue(late.transport.disconnecting)
+
+
+
+class SlowClientTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.resource = HoldingResource()
+
+
+	def _makeSite(self, resource=None, **kwargs):
+		return ConnectionTrackingSite(resource or self.resource,
+			clock=self.clock, slowClientLimits=SlowClientLimits(**kwargs))
+
+
+	def _connect(self, site):
+		channel = site.buildProtocol(None)
+		channel.makeConnection(DummyTCPTransport())
+		self.addCleanup(
+			lambda: channel in site.connections and channel.connectionLost(None))
+		return channel
+
+
+	def _request(self, channel):
+		channel.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		return self.resource.requests[-1]
+
+
+	def test_maxBufferedBytes(self):
+		site = self._makeSite(maxBufferedBytes=1000, checkInterval=5)
+		channel = self._connect(site)
+		request = self._request(channel)
+		request.write('x' * 1001)
+		channel.transport.dataBuffer = 'x' * 1000
+		self.clock.advance(5)
+		self.assertFalse(channel.transport.aborted)
+
+		channel.transport.dataBuffer = 'x' * 1001
+		self.clock.advance(5)
+		self.assertTrue(channel.transport.aborted)
+		self.assertEqual(1, site.slowClientsAborted)
+
+
+	def test_minTransferRate(self):
+		site = self._makeSite(minTransferRate=100, checkInterval=5)
+		fast = self._connect(site)
+		slow = self._connect(site)
+		for channel in (fast, slow):
+			self._request(channel).write('x' * 10000)
+			channel.transport.dataBuffer = 'x' * 10000
+		self.clock.advance(5)
+
+		fast.transport.dataBuffer = 'x' * 9000
+		slow.transport.dataBuffer = 'x' * 9400
+		self.clock.advance(5)
+		self.assertFalse(fast.transport.aborted)
+		self.assertFalse(slow.transport.aborted)
+
+		fast.transport.dataBuffer = 'x' * 8000
+		slow.transport.dataBuffer = 'x' * 9000
+		self.clock.advance(5)
+		self.assertFalse(fast.transport.aborted)
+		self.assertTrue(slow.transport.aborted)
+		self.assertEqual(1, site.slowClientsAborted)
+
+
+	def test_slowAfterResponseFinished(self):
+		"""
+		A client that is slow to read the end of a finished response is
+		still aborted.
+		"""
+		site = self._makeSite(minTransferRate=100, checkInterval=5)
+		channel = self._connect(site)
+		request = self._request(channel)
+		request.write('x' * 10000)
+		channel.transport.dataBuffer = 'x' * 5000
+		self.clock.advance(5)
+		request.finish()
+		self.clock.advance(5)
+		self.assertTrue(channel.transport.aborted)
+
+
+	def test_waitingForServer(self):
+		"""
+		Connections that have nothing waiting to be sent, because the server
+		has not written the response yet, are not too slow.
+		"""
+		site = self._makeSite(WaitResource(self.clock),
+			maxBufferedBytes=0, minTransferRate=1000, checkInterval=1)
+		channel = self._connect(site)
+		channel.dataReceived(
+			'GET /?wait=20 HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		self.clock.pump([1] * 21)
+		self.assertFalse(channel.transport.aborted)
+		self.assertTrue('GIF89a' in channel.transport.value())
+
+
+	def test_protocolWrapper(self):
+		"""
+		The bytes buffered below a L{policies.ProtocolWrapper} (as used for
+		HTTPS) are counted.
+		"""
+		site = self._makeSite(maxBufferedBytes=1000, checkInterval=5)
+		wrapper = policies.WrappingFactory(site).buildProtocol(None)
+		transport = DummyTCPTransport()
+		wrapper.makeConnection(transport)
+		channel = wrapper.wrappedProtocol
+		self.addCleanup(
+			lambda: channel in site.connections and wrapper.connectionLost(None))
+		self._request(channel).write('x' * 1001)
+		transport.dataBuffer = 'x' * 1001
+		self.clock.advance(5)
+		self.assertEqual(1, site.slowClientsAborted)
+
+
+	def test_unmeasurableTransport(self):
+		"""
+		Connections whose transport doesn't tell how much is buffered are
+		not checked, and the first one of each class of transport is
+		logged.
+		"""
+		self.addCleanup(
+			_unmeasurableTransports.discard, StringTransport)
+		messages = []
+		log.addObserver(messages.append)
+		self.addCleanup(log.removeObserver, messages.append)
+
+		site = self._makeSite(maxBufferedBytes=0, minTransferRate=1000,
+			checkInterval=5)
+		for i in xrange(2):
+			channel = site.buildProtocol(None)
+			channel.makeConnection(StringTransport())
+			self.addCleanup(channel.connectionLost, None)
+			self._request(channel).write('x' * 10)
+		self.clock.advance(5)
+		self.clock.advance(5)
+		self.assertEqual(0, site.slowClientsAborted)
+		logged = [m for m in messages if 'StringTransport' in
+			log.textFromEventDict(m)]
+		self.assertEqual(1, len(logged))
+
+
+	def test_checksOnlyWhileConnected(self):
+		site = self._makeSite(minTransferRate=1)
+		self.assertEqual([], self.clock.getDelayedCalls())
+		channels = [self._connect(site) for i in xrange(3)]
+		# One for the slow client checks; without a timing wheel, idle
+		# timeouts are not on the site's clock.
+		self.assertEqual(1, len(self.clock.getDelayedCalls()))
+		for channel in channels:
+			channel.connectionLost(None)
+		self.assertEqual([], self.clock.getDelayedCalls())
+
+
+
+class DisplayConnectionsTests(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.resource = HoldingResource()
+		self.site = ConnectionTrackingSite(self.resource, clock=self.clock)
+		cooperator = task.Cooperator(
+			scheduler=lambda f: self.clock.callLater(0, f))
+		self.display = DisplayConnections(cooperator)
+		self.display.batchSize = 2
+
+
+	def _connect(self, host):
+		channel = self.site.buildProtocol(None)
+		transport = DummyTCPTransport(
+			peerAddress=address.IPv4Address('TCP', host, 1234))
+		channel.makeConnection(transport)
+		self.addCleanup(
+			lambda: channel in self.site.connections and
+				channel.connectionLost(None))
+		return channel
+
+
+	def _get(self, **args):
+		request = DummyRequest([])
+		request.channel.factory = self.site
+		request.args = dict((k, [str(v)]) for k, v in args.iteritems())
+		result = self.display.render(request)
+		if result is not server.NOT_DONE_YET:
+			return request, result
+		while not request.finished:
+			self.clock.advance(0)
+		return request, ''.join(request.written)
+
+
+	def _getJSON(self, **args):
+		request, body = self._get(**args)
+		self.assertEqual(['application/json'],
+			request.responseHeaders.getRawHeaders('content-type'))
+		return json.loads(body)
+
+
+	def test_summaryAndConnections(self):
+		self._connect('10.0.0.1')
+		self.clock.advance(5)
+		c2 = self._connect('10.0.0.2')
+		c2.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+
+		out = self._getJSON()
+		self.assertEqual(2, out['summary']['connections'])
+		self.assertEqual(1, out['summary']['requestsInFlight'])
+		self.assertEqual(2, out['summary']['stats']['opened'])
+		self.assertEqual(False, out['more'])
+		conns = sorted(out['connections'], key=lambda c: c['peer'])
+		self.assertEqual([
+			{'id': 1, 'peer': '10.0.0.1:1234', 'age': 5, 'state': 'new',
+				'requests': 0, 'inFlight': 0},
+			{'id': 2, 'peer': '10.0.0.2:1234', 'age': 0, 'state': 'busy',
+				'requests': 1, 'inFlight': 1},
+		], conns)
+
+
+	def test_filters(self):
+		self._connect('10.0.0.1')
+		self.clock.advance(100)
+		idle = self._connect('10.1.0.1')
+		idle.dataReceived('GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+		self.resource.requests[-1].finish()
+		self._connect('10.1.0.2')
+
+		def peers(**args):
+			return sorted(c['peer'] for c in self._getJSON(**args)['connections'])
+
+		self.assertEqual(['10.1.0.1:1234', '10.1.0.2:1234'], peers(peer='10.1.'))
+		self.assertEqual(['10.1.0.1:1234'], peers(state='idle'))
+		self.assertEqual(['10.0.0.1:1234'], peers(minAge=50))
+		self.assertEqual(['10.1.0.1:1234', '10.1.0.2:1234'], peers(maxAge=50))
+
+
+	def test_pagination(self):
+		for i in xrange(5):
+			self._connect('10.0.0.%d' % (i,))
+		seen = []
+		for offset in (0, 2, 4):
+			out = self._getJSON(offset=offset, limit=2)
+			seen.extend(c['peer'] for c in out['connections'])
+			self.assertEqual(offset < 4, out['more'])
+		self.assertEqual(['10.0.0.%d:1234' % (i,) for i in xrange(5)], seen)
+
+
+	def test_paginationOrderIsStable(self):
+		"""
+		Pages list connections in the order they were opened, whatever the
+		order of the site's set of connections.
+		"""
+		channels = [self._connect('10.0.0.%d' % (i,)) for i in xrange(20)]
+		channels[3].connectionLost(None)
+		self.site.connections = set(reversed(list(self.site.connections)))
+		ids = []
+		for offset in (0, 7, 14):
+			out = self._getJSON(offset=offset, limit=7)
+			ids.extend(c['id'] for c in out['connections'])
+		self.assertEqual([i for i in xrange(1, 21) if i != 4], ids)
+
+
+	def test_orderAfterManyDisconnects(self):
+		"""
+		Disconnected channels are dropped from the site's connection order
+		in bulk, and the order of the rest is kept.
+		"""
+		channels = [self._connect('10.0.0.1') for i in xrange(200)]
+		for channel in channels[:190]:
+			channel.connectionLost(None)
+		self.assertTrue(len(self.site._connectionOrder) <= 2 * 10 + 64)
+		out = self._getJSON()
+		self.assertEqual(range(191, 201), [c['id'] for c in out['connections']])
+
+
+	def test_badArguments(self):
+		for args in [{'state': 'sleepy'}, {'limit': 100000}, {'offset': -1},
+		{'minAge': 'x'}, {'format': 'xml'}]:
+			request, body = self._get(**args)
+			self.assertEqual(400, request.responseCode)
+
+
+	def test_html(self):
+		channel = self._connect('10.0.0.1')
+		request, body = self._get(format='html')
+		self.assertTrue(body.startswith('<pre>'), body)
+		self.assertTrue(cgi.escape(repr(channel)) in body, body)
+
+
+	def test_clientDisconnectsDuringScan(self):
+		for i in xrange(10):
+			self._connect('10.0.0.%d' % (i,))
+		request = DummyRequest([])
+		request.channel.factory = self.site
+		self.assertEqual(server.NOT_DONE_YET, self.display.render(request))
+		request.processingFailed(failure.Failure(Exception("gone")))
+		self.clock.advance(0)
+		self.assertEqual([], request.written)
+
+
+	def test_errorFinishesRequest(self):
+		"""
+		If listing the connections fails, the error is logged and the
+		request is finished with a 500.
+		"""
+		def fail(*args):
+			raise RuntimeError("broken")
+		self.display._describe = fail
+		self._connect('10.0.0.1')
+		request, body = self._get()
+		self.assertEqual(1, request.finished)
+		self.assertEqual(500, request.responseCode)
+		self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+
+
+
+class ConnectionLimitsTests(unittest.TestCase):
+
+	def test_defaultLowWater(self):
+		limits = ConnectionLimits(maxConnections=1000, maxRequests=100)
+		self.assertEqual(900, limits.connectionsLowWater)
+		self.assertEqual(90, limits.requestsLowWater)
+
+
+	def test_repr(self):
+		limits = ConnectionLimits(maxConnections=10, connectionsLowWater=5)
+		self.assertEqual('ConnectionLimits(maxConnections=10, '
+			'maxRequests=None, connectionsLowWater=5, '
+			'requestsLowWater=None, shedIdle=False)', repr(limits))
@@ -0,0 +1,120 @@
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import client
+
+from webmagic.untwist import BetterResource, ConnectionTrackingSite
+from webmagic import workers
+from webmagic.workers import Supervisor, _SO_REUSEPORT
+
+
+class PidResource(BetterResource):
+	isLeaf = True
+
+	def render_GET(self, request):
+		return str(os.getpid())
+
+
+
+def makeSite():
+	"""
+	The site factory used by the worker processes in these tests.
+	"""
+	return ConnectionTrackingSite(PidResource())
+
+
+
+class SupervisorTests(unittest.TestCase):
+	timeout = 60
+	reusePort = False
+
+	def setUp(self):
+		self.supervisor = Supervisor(
+			'webmagic.test.test_workers.makeSite', 2, 0,
+			reusePort=self.reusePort, reportInterval=0.1, stopTimeout=5)
+		self.supervisor.start()
+		self.addCleanup(self.supervisor.stop)
+
+
+	def _waitFor(self, condition):
+		"""
+		@return: a L{Deferred} that fires when C{condition()} is true.
+		"""
+		def check():
+			if condition():
+				return
+			return task.deferLater(reactor, 0.05, check)
+		return check()
+
+
+	def _allHealthy(self):
+		reports = self.supervisor.getWorkerReports()
+		return len(reports) == 2 and all(r['healthy'] for r in reports)
+
+
+	def _get(self):
+		return client.getPage(
+			'http://127.0.0.1:%d/' % (self.supervisor.port,))
+
+
+	@defer.inlineCallbacks
+	def test_servesAndReports(self):
+		yield self._waitFor(self._allHealthy)
+		pids = set(r['pid'] for r in self.supervisor.getWorkerReports())
+		body = yield self._get()
+		self.assertTrue(int(body) in pids, (body, pids))
+
+		for r in self.supervisor.getWorkerReports():
+			self.assertEqual(r['pid'], r['report']['pid'])
+			self.assertEqual(False, r['report']['stopping'])
+			self.assertEqual(0, r['report']['requestsInFlight'])
+		self.assertEqual(0, self.supervisor.getConnectionCount())
+
+
+	@defer.inlineCallbacks
+	def test_restart(self):
+		yield self._waitFor(self._allHealthy)
+		oldPids = set(r['pid'] for r in self.supervisor.getWorkerReports())
+		yield self.supervisor.restart()
+		yield self._waitFor(self._allHealthy)
+		newPids = set(r['pid'] for r in self.supervisor.getWorkerReports())
+		self.assertEqual(2, len(newPids))
+		self.assertEqual(set(), oldPids & newPids)
+
+		body = yield self._get()
+		self.assertTrue(int(body) in newPids, (body, newPids))
+
+
+	@defer.inlineCallbacks
+	def test_replacesCrashedWorker(self):
+		yield self._waitFor(self._allHealthy)
+		victim = self.supervisor._processes[0]
+		victim.transport.signalProcess('KILL')
+		yield victim.exited
+		yield self._waitFor(self._allHealthy)
+		pids = set(r['pid'] for r in self.supervisor.getWorkerReports())
+		self.assertFalse(victim.pid in pids)
+
+
+
+class ReusePortSupervisorTests(SupervisorTests):
+	reusePort = True
+
+	if _SO_REUSEPORT is None:
+		skip = "SO_REUSEPORT is not available on this platform"
+
+
+
+class MakeSocketTests(unittest.TestCase):
+
+	def test_noReusePort(self):
+		"""
+		Asking for SO_REUSEPORT where it is not available raises
+		L{RuntimeError}.
+		"""
+		self.patch(workers, '_SO_REUSEPORT', None)
+		e = self.assertRaises(
+			RuntimeError, workers._makeSocket, '127.0.0.1', 0, True)
+		self.assertEqual(
+			"SO_REUSEPORT is not available on this platform", str(e))
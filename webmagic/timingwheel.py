@@ -0,0 +1,165 @@
+"""
+A coarse-grained timer for managing a large number of timeouts that are
+frequently reset or cancelled, such as idle timeouts on connections.
+"""
+
+import sys
+
+_postImportVars = vars().keys()
+
+
+class TimingWheel(object):
+	"""
+	Schedules expiration of many keys with one periodic call on C{clock},
+	instead of one L{IDelayedCall} per key.
+
+	Time is divided into slots of C{granularity} seconds.  Scheduling,
+	rescheduling, and cancelling a key are O(1).  Every C{granularity}
+	seconds (but only while any key is scheduled), all slots that are due
+	are swept, and C{expired(key)} is called for each key in them.
+
+	Keys never expire early, but may expire up to 2 * C{granularity}
+	seconds late.  Keys must be hashable.
+	"""
+	__slots__ = ('_clock', '_granularity', '_expired', '_buckets', '_slots',
+		'_sweptSlot', '_sweepCall')
+
+	def __init__(self, clock, granularity, expired):
+		"""
+		@param clock: an L{IReactorTime} provider.
+
+		@param granularity: a C{float|int}, the length of a slot, in seconds.
+
+		@param expired: a 1-arg callable that will be called with the key
+			when a key expires.  A key is no longer scheduled by the time
+			C{expired} is called, so it may reschedule the key.
+		"""
+		assert granularity > 0, granularity
+		self._clock = clock
+		self._granularity = granularity
+		self._expired = expired
+		# slot number -> set of keys
+		self._buckets = {}
+		# key -> slot number
+		self._slots = {}
+		self._sweptSlot = None
+		self._sweepCall = None
+
+
+	def __len__(self):
+		return len(self._slots)
+
+
+	def __contains__(self, key):
+		return key in self._slots
+
+
+	def schedule(self, key, delay):
+		"""
+		Schedule C{key} to expire in C{delay} seconds, replacing its
+		existing deadline if it is already scheduled.
+		"""
+		now = self._clock.seconds()
+		if self._sweepCall is None:
+			self._sweptSlot = int(now // self._granularity)
+			self._sweepCall = self._clock.callLater(
+				self._granularity, self._sweep)
+		self._moveTo(key, self._slots.get(key), self._slotFor(now + delay))
+
+
+	def reschedule(self, key, delay):
+		"""
+		Like L{schedule}, but do nothing if C{key} is not already scheduled.
+		"""
+		# This is called for every chunk of data a connection receives, so
+		# the common case (same slot as before) is kept inline.
+		oldSlot = self._slots.get(key)
+		if oldSlot is None:
+			return
+		slot = int((self._clock.seconds() + delay) // self._granularity) + 1
+		if slot <= self._sweptSlot:
+			slot = self._sweptSlot + 1
+		if slot != oldSlot:
+			self._moveTo(key, oldSlot, slot)
+
+
+	def _slotFor(self, deadline):
+		# The first slot that starts after `deadline`, but never a slot that
+		# has already been swept.
+		slot = int(deadline // self._granularity) + 1
+		if slot <= self._sweptSlot:
+			return self._sweptSlot + 1
+		return slot
+
+
+	def _moveTo(self, key, oldSlot, slot):
+		if oldSlot == slot:
+			return
+		if oldSlot is not None:
+			self._removeFromBucket(key, oldSlot)
+
+		self._slots[key] = slot
+		bucket = self._buckets.get(slot)
+		if bucket is None:
+			bucket = self._buckets[slot] = set()
+		bucket.add(key)
+
+
+	def cancel(self, key):
+		"""
+		Unschedule C{key}.  Does nothing if C{key} is not scheduled.
+		"""
+		slot = self._slots.pop(key, None)
+		if slot is None:
+			return
+		self._removeFromBucket(key, slot)
+		if not self._slots and self._sweepCall is not None:
+			self._sweepCall.cancel()
+			self._sweepCall = None
+
+
+	def _removeFromBucket(self, key, slot):
+		bucket = self._buckets.get(slot)
+		# The bucket is missing if it is currently being swept.
+		if bucket is not None:
+			bucket.discard(key)
+			if not bucket:
+				del self._buckets[slot]
+
+
+	def _sweep(self):
+		self._sweepCall = None
+		nowSlot = int(self._clock.seconds() // self._granularity)
+		buckets = self._buckets
+		slots = self._slots
+
+		if nowSlot - self._sweptSlot > len(buckets):
+			# The clock jumped; visiting only the occupied slots is cheaper.
+			due = sorted(s for s in buckets if s <= nowSlot)
+		else:
+			due = xrange(self._sweptSlot + 1, nowSlot + 1)
+		# Set this before calling any `expired` callbacks, so that keys they
+		# schedule land after all the slots in `due`.
+		self._sweptSlot = nowSlot
+
+		for slot in due:
+			bucket = buckets.pop(slot, None)
+			if not bucket:
+				continue
+			for key in bucket:
+				# Skip keys that were cancelled or rescheduled by an earlier
+				# `expired` callback in this sweep.
+				if slots.get(key) != slot:
+					continue
+				del slots[key]
+				self._expired(key)
+
+		if slots and self._sweepCall is None:
+			self._sweepCall = self._clock.callLater(
+				self._granularity, self._sweep)
+
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
@@ -3,11 +3,14 @@ Various features to make using twisted.web to build real websites
 a bit more sane.
 """
 
+import os
 import sys
+import json
 import binascii
 import cgi
 import time
 from functools import partial
+from collections import OrderedDict
 
 from twisted.web import resource, static, server
 try:
@@ -17,14 +20,19 @@ except ImportError:
 	from twisted.web.error import ErrorPage
 
 from twisted.web.http import HTTPChannel, datetimeToString
-from twisted.python import context, log
+from twisted.internet import defer, task
+from twisted.python import context, log, reflect
 
 from zope.interface import implements
 
 from webmagic.transforms import md5hexdigest
+from webmagic.filecache import isMissingError
 from webmagic.pathmanip import ICacheBreaker
 from webmagic.cssfixer import fixUrls
 from webmagic.safe_headers import setRawHeadersSafely
+from webmagic.timingwheel import TimingWheel
+from webmagic.stats import ConnectionStats
+from webmagic import accesslog
 
 _postImportVars = vars().keys()
 
@@ -45,7 +53,8 @@ class CookieInstaller(object):
 		"""
 		@param secureRandom: a 1-argument (# of bytes) callable that
 			returns a string of # random bytes.  You probably want to
-			pass L{os.urandom}.
+			pass L{os.urandom}, or a L{webmagic.randompool.RandomPool}
+			if many cookies are set.
 		@type secureRandom: function
 
 		@param insecureName: the cookie name for a cookie that will be sent by
@@ -244,8 +253,18 @@ class BetterResource(resource.Resource):
 	"""
 	_debugGetChild = False
 
+	# Incremented by every putChild call on any BetterResource, so that
+	# compiled route indexes (see L{BetterSite}) know when to rebuild.
+	# This is a list because refbinder may bind module globals as constants.
+	_treeGeneration = [0]
+
 	# TODO: allow customizing behavior: options addSlashes and rejectExtra.
 
+	def putChild(self, path, child):
+		resource.Resource.putChild(self, path, child)
+		BetterResource._treeGeneration[0] += 1
+
+
 	def render(self, request):
 		setDefaultHeadersOnRequest(request)
 		try:
@@ -337,6 +356,60 @@ class BetterResource(resource.Resource):
 
 
 
+_ROUTE_FOUND, _ROUTE_NOT_FOUND, _ROUTE_REDIRECT = range(3)
+
+def _isRouteCompilable(r):
+	"""
+	@return: a C{bool}, whether the children of C{r} are resolved entirely
+		by L{BetterResource.getChildWithDefault}, so that lookups in C{r}
+		can be precomputed.
+	"""
+	if not isinstance(r, BetterResource) or r._debugGetChild:
+		return False
+	return r.__class__.getChildWithDefault.im_func is \
+		BetterResource.getChildWithDefault.im_func
+
+
+def _compileRoutesInto(routes, node, prefix, ancestors):
+	for path, child in node.children.iteritems():
+		key = prefix + (path,)
+		consumed = len(key)
+		# The postpath is empty after consuming `path`.  This mirrors the
+		# redirect logic in BetterResource.getChildWithDefault; note that
+		# request.prepath[-1] is always `path` at that point.
+		if path != '' and isinstance(child, BetterResource):
+			if '' in child.children or child.isLeaf:
+				routes[key] = (_ROUTE_REDIRECT, consumed, None)
+			else:
+				routes[key] = (_ROUTE_NOT_FOUND, consumed, None)
+		else:
+			routes[key] = (_ROUTE_FOUND, consumed, child)
+
+		if child.isLeaf:
+			# A leaf is still served when the postpath is [''], and the
+			# '' is left in the postpath.
+			routes[key + ('',)] = (_ROUTE_FOUND, consumed, child)
+		elif _isRouteCompilable(child) and id(child) not in ancestors:
+			_compileRoutesInto(routes, child, key, ancestors | set([id(child)]))
+
+
+def compileRoutes(root):
+	"""
+	@param root: a L{BetterResource}, the root of a resource tree.
+
+	@return: a C{dict} mapping C{tuple}s of path segments to route entries,
+		for every path that can be resolved using only the static
+		C{children} of L{BetterResource}s in the tree.  Paths that depend
+		on a dynamic C{getChild} (or a non-L{BetterResource}'s
+		C{getChildWithDefault}) are not included.
+	"""
+	routes = {}
+	if _isRouteCompilable(root) and not root.isLeaf:
+		_compileRoutesInto(routes, root, (), set([id(root)]))
+	return routes
+
+
+
 def loadCompatibleMimeTypes():
 	# Read from Python's built-in mimetypes, but don't load any mimetypes
 	# from disk.
@@ -379,6 +452,28 @@ def loadCompatibleMimeTypes():
 	return contentTypes
 
 
+
+class _LazyClassAttribute(object):
+	"""
+	A class attribute whose value is made by calling C{factory} the first
+	time it is read, and then replaces this descriptor on the class that
+	defined it.
+	"""
+	def __init__(self, name, factory):
+		self._name = name
+		self._factory = factory
+
+
+	def __get__(self, obj, cls):
+		value = self._factory()
+		for klass in cls.__mro__:
+			if klass.__dict__.get(self._name) is self:
+				setattr(klass, self._name, value)
+				break
+		return value
+
+
+
 class ResponseCacheOptions(object):
 	__slots__ = ('cacheTime', 'httpCachePublic', 'httpsCachePublic')
 
@@ -413,9 +508,9 @@ class ResponseCacheOptions(object):
 
 
 class _CSSCacheEntry(object):
-	__slots__ = ('processed', 'digest', 'references')
+	__slots__ = ('processed', 'digest', 'references', 'generation')
 
-	def __init__(self, processed, digest, references):
+	def __init__(self, processed, digest, references, generation=None):
 		"""
 		@param processed: a C{str} containing the processed CSS file
 			with the rewritten url(...)s.
@@ -425,11 +520,15 @@ class _CSSCacheEntry(object):
 
 		@param references: a C{list} of L{ReferencedFile}s that may affect
 			the content of C{processed}.
+
+		@param generation: the L{FileCache.getGeneration} of the file cache
+			when the references were last checked.
 		"""
 		assert not isinstance(processed, unicode), type(processed)
 		self.processed = processed
 		self.digest = digest
 		self.references = references
+		self.generation = generation
 
 
 	def __repr__(self):
@@ -508,23 +607,27 @@ class CSSResource(BetterResource):
 		if not maybeNew and not self._haveUpdatedReferences():
 			try:
 				entry = self._cssCache[self._path]
+				entry.generation = self._fileCache.getGeneration()
 				return entry.processed
 			except KeyError:
 				pass
 
 		processed, references = self._process(content)
-		entry = _CSSCacheEntry(processed, md5hexdigest(processed), references)
+		entry = _CSSCacheEntry(processed, md5hexdigest(processed), references,
+			self._fileCache.getGeneration())
 		self._cssCache[self._path] = entry
 
 		return processed
 
 
 	def getCacheBreaker(self):
-		try:
-			return self._cssCache[self._path].digest
-		except KeyError:
+		# If the file cache has not dropped or replaced anything since the
+		# entry was made, the entry is still good.
+		entry = self._cssCache.get(self._path)
+		if entry is None or entry.generation != self._fileCache.getGeneration():
 			self._getProcessedCSS()
-			return self._cssCache[self._path].digest
+			entry = self._cssCache[self._path]
+		return entry.digest
 
 
 	def render_GET(self, request):
@@ -572,7 +675,8 @@ class BetterFile(static.File):
 	*	BetterFile sets cache-related HTTP headers for you.  You can change
 		the headers with the C{cacheOptions} parameter.
 	"""
-	contentTypes = loadCompatibleMimeTypes()
+	# Loaded on first use, so that importing this module is cheap.
+	contentTypes = _LazyClassAttribute('contentTypes', loadCompatibleMimeTypes)
 
 	indexNames = ["index.html"]
 
@@ -617,6 +721,19 @@ class BetterFile(static.File):
 
 
 	def getChild(self, path, request):
+		# Cachebreaker lookups (see webmagic.pathmanip) carry a file cache,
+		# which remembers missing files, so that a broken url(...) or href
+		# doesn't cost a stat every time.
+		fileCache = getattr(request, 'fileCache', None)
+		# Anything that self.child might reject is left to static.File.
+		if fileCache is not None and path not in ('', '.', '..') and \
+		os.sep not in path and not self.ignoredExts:
+			try:
+				fileCache.checkFingerprint(os.path.join(self.path, path))
+			except EnvironmentError, e:
+				if isMissingError(e):
+					return self.childNotFound
+
 		# This is a bit of a hack, but it allows the `cssRewriter`
 		# processor to grab the request (which static.File.getChild sadly
 		# does not pass into it).
@@ -646,7 +763,32 @@ class BetterFile(static.File):
 
 
 
+class _IdleKey(object):
+	"""
+	A channel's key in its site's idle L{TimingWheel}.  Channels are
+	old-style instances, and hashing one costs more than the rest of a
+	timeout reset; hashing this is cheap.
+	"""
+	__slots__ = ('channel',)
+
+	def __init__(self, channel):
+		self.channel = channel
+
+
+
+def _idleKeyExpired(key):
+	key.channel.timeoutConnection()
+
+
+
 class _BetterHTTPChannel(HTTPChannel):
+	"""
+	An L{HTTPChannel} that keeps its idle timeout in its site's shared
+	L{TimingWheel} (if the site has one) instead of in its own
+	L{IDelayedCall}.
+	"""
+	_idleKey = None
+
 	def connectionMade(self, *args, **kwargs):
 		HTTPChannel.connectionMade(self, *args, **kwargs)
 		if self.site._setNoDelayOnConnect and \
@@ -654,6 +796,122 @@ class _BetterHTTPChannel(HTTPChannel):
 			self.transport.setTcpNoDelay(True)
 
 
+	def setTimeout(self, period):
+		wheel = self.site._idleWheel
+		if wheel is None:
+			return HTTPChannel.setTimeout(self, period)
+
+		key = self._idleKey
+		if key is None:
+			key = self._idleKey = _IdleKey(self)
+		prev = self.timeOut
+		self.timeOut = period
+		if period is None:
+			wheel.cancel(key)
+		else:
+			wheel.schedule(key, period)
+		return prev
+
+
+	def resetTimeout(self):
+		wheel = self.site._idleWheel
+		if wheel is None:
+			return HTTPChannel.resetTimeout(self)
+
+		# Like TimeoutMixin, do nothing if the timeout was disabled or
+		# already hit.
+		if self.timeOut is not None:
+			wheel.reschedule(self._idleKey, self.timeOut)
+
+
+
+class RequestTimings(object):
+	"""
+	Timestamps (from the site's clock) of the stages of a request.  Any
+	stage that was not reached is C{None}.
+
+	@ivar received: when the request (including its body) was received.
+	@ivar resolved: when the resource that renders the request was found.
+	@ivar renderStarted: when the resource started rendering.
+	@ivar firstByte: when the first byte of the response was written.
+	@ivar finished: when the response was finished, or when the connection
+		was lost, if C{aborted}.
+	@ivar resource: the fully-qualified class name of the resource.
+	@ivar aborted: C{True} if the connection was lost before the response
+		was finished.
+	"""
+	__slots__ = ('received', 'resolved', 'renderStarted', 'firstByte',
+		'finished', 'resource', 'aborted')
+
+	def __init__(self, received):
+		self.received = received
+		self.resolved = None
+		self.renderStarted = None
+		self.firstByte = None
+		self.finished = None
+		self.resource = ''
+		self.aborted = False
+
+
+	def __repr__(self):
+		return '<%s resource=%r received=%r resolved=%r renderStarted=%r ' \
+			'firstByte=%r finished=%r aborted=%r>' % (
+			self.__class__.__name__, self.resource, self.received,
+			self.resolved, self.renderStarted, self.firstByte, self.finished,
+			self.aborted)
+
+
+
+class _InstrumentedRequest(server.Request):
+	"""
+	A L{server.Request} that records L{RequestTimings} and passes them to
+	its site's C{requestObserver} when it is finished or its connection
+	is lost.  Only used by sites that have a C{requestObserver}.
+	"""
+	timings = None
+
+	def requestReceived(self, command, path, version):
+		self.timings = RequestTimings(self.channel.site._clock.seconds())
+		server.Request.requestReceived(self, command, path, version)
+
+
+	def render(self, resrc):
+		timings = self.timings
+		timings.resource = reflect.qual(resrc.__class__)
+		timings.renderStarted = self.site._clock.seconds()
+		server.Request.render(self, resrc)
+
+
+	def write(self, data):
+		timings = self.timings
+		if timings is not None and timings.firstByte is None:
+			timings.firstByte = self.channel.site._clock.seconds()
+		server.Request.write(self, data)
+
+
+	def finish(self):
+		timings = self.timings
+		if timings is None or timings.finished is not None:
+			return server.Request.finish(self)
+		timings.finished = now = self.site._clock.seconds()
+		if timings.firstByte is None:
+			# finish() writes the headers if nothing was written.
+			timings.firstByte = now
+		try:
+			return server.Request.finish(self)
+		finally:
+			self.site._requestObserver(timings)
+
+
+	def connectionLost(self, reason):
+		timings = self.timings
+		if timings is not None and timings.finished is None:
+			timings.finished = self.channel.site._clock.seconds()
+			timings.aborted = True
+			self.channel.site._requestObserver(timings)
+		server.Request.connectionLost(self, reason)
+
+
 
 class BetterSite(server.Site):
 	"""
@@ -664,12 +922,155 @@ class BetterSite(server.Site):
 
 	*	Sets TCP_NODELAY on all connections (unless disabled with
 		noDelay=False).
+
+	*	Optionally (with a C{timeoutGranularity}), idle timeouts for all
+		connections are kept in one L{TimingWheel} with a resolution of
+		C{timeoutGranularity} seconds, instead of in one L{IDelayedCall}
+		per connection.  This keeps the reactor's list of delayed calls
+		short with many idle connections, but resetting a timeout is about
+		25% slower than L{IDelayedCall.reset}, so it is off by default.
+
+	*	Optionally (with compileRoutes=True) resolves requests with a single
+		lookup in a route index compiled from the static C{children} of the
+		L{BetterResource}s in the tree, instead of calling
+		C{getChildWithDefault} once per path segment.  The index is rebuilt
+		after any L{BetterResource.putChild} call.  Paths not in the index
+		are resolved the normal way.  Don't use this if you modify
+		C{.children} or C{.isLeaf} directly.
+
+	*	Optionally (with a C{requestObserver}) records when each request
+		was received, resolved, started rendering, wrote its first byte,
+		and finished, and passes these L{RequestTimings} to the observer.
+		Pass a L{webmagic.stats.RequestMetrics} to keep per-resource-class
+		latency histograms, which L{MetricsResource} can serve.  Without an
+		observer, plain L{server.Request}s are used, so there is no
+		overhead.
+
+	*	Access log lines are formatted with a C{logFormat} (by default,
+		L{accesslog.COMBINED}, the same format as L{server.Site}) using a
+		timestamp that is formatted at most once per second.  With
+		C{logBufferSize}, lines written to C{logPath} are batched and
+		written by a background thread (see L{accesslog.BufferedLogWriter})
+		instead of being written synchronously.
 	"""
 	protocol = _BetterHTTPChannel
 
-	def __init__(self, resource, logPath=None, timeout=75, noDelay=True):
+	def __init__(self, resource, logPath=None, timeout=75, noDelay=True,
+	compileRoutes=False, timeoutGranularity=None, clock=None,
+	requestObserver=None, logFormat=accesslog.COMBINED, logBufferSize=None,
+	logFlushInterval=1):
+		"""
+		@param timeoutGranularity: if not C{None}, keep idle timeouts in a
+			L{TimingWheel} with slots of this many seconds.
+
+		@param clock: an L{IReactorTime} provider used for idle timeouts
+			(with a C{timeoutGranularity}), request timings, and access log
+			timestamps.  If C{None}, the global reactor is imported and
+			used.
+
+		@param requestObserver: a 1-arg callable that will be called with
+			the L{RequestTimings} of every request, or C{None}.
+
+		@param logFormat: an L{accesslog.LogFormat}.
+
+		@param logBufferSize: if not C{None}, buffer up to this many bytes
+			of access log lines in memory, and write them (at least every
+			C{logFlushInterval} seconds) from a background thread.
+		"""
 		server.Site.__init__(self, resource, logPath, timeout)
 		self._setNoDelayOnConnect = noDelay
+		if clock is None:
+			from twisted.internet import reactor as clock
+		self._clock = clock
+		self._idleWheel = None
+		if timeoutGranularity is not None:
+			self._idleWheel = TimingWheel(
+				clock, timeoutGranularity, _idleKeyExpired)
+		self._compileRoutes = compileRoutes
+		self._routes = None
+		self._routesRoot = None
+		self._routesGeneration = None
+		self._requestObserver = requestObserver
+		self._logLine = logFormat.formatLine
+		self._logTimestamp = accesslog.CachedTimestamp(
+			clock, logFormat.formatTime)
+		self._logBufferSize = logBufferSize
+		self._logFlushInterval = logFlushInterval
+		if requestObserver is not None:
+			self.requestFactory = _InstrumentedRequest
+			# Shadow the method only on instrumented sites.
+			self.getResourceFor = self._getResourceForTimed
+
+
+	def _openLogFile(self, path):
+		if self._logBufferSize is None:
+			return server.Site._openLogFile(self, path)
+		return accesslog.BufferedLogWriter(
+			open(path, 'ab'), self._clock, self._logBufferSize,
+			self._logFlushInterval)
+
+
+	def log(self, request):
+		logFile = getattr(self, 'logFile', None)
+		if logFile is not None:
+			logFile.write(self._logLine(self._logTimestamp(), request))
+
+
+	def _getResourceForTimed(self, request):
+		res = self.__class__.getResourceFor(self, request)
+		request.timings.resolved = self._clock.seconds()
+		return res
+
+
+	def _getRoutes(self):
+		generation = BetterResource._treeGeneration[0]
+		if self._routes is None or self._routesRoot is not self.resource or \
+		self._routesGeneration != generation:
+			self._routes = compileRoutes(self.resource)
+			self._routesRoot = self.resource
+			self._routesGeneration = generation
+		return self._routes
+
+
+	def getResourceFor(self, request):
+		if not self._compileRoutes:
+			return server.Site.getResourceFor(self, request)
+
+		postpath = request.postpath
+		entry = self._getRoutes().get(tuple(postpath))
+		if entry is None:
+			return server.Site.getResourceFor(self, request)
+
+		request.site = self
+		request.sitepath = request.prepath[:]
+		kind, consumed, res = entry
+		request.prepath.extend(postpath[:consumed])
+		del postpath[:consumed]
+		if kind == _ROUTE_FOUND:
+			return res
+		elif kind == _ROUTE_NOT_FOUND:
+			return HelpfulNoResource()
+		else:
+			return RedirectingResource(301, request.uri + '/')
+
+
+
+class MetricsResource(BetterResource):
+	"""
+	Serves the histograms in a L{webmagic.stats.RequestMetrics} in the
+	Prometheus text exposition format.
+	"""
+	isLeaf = True
+
+	def __init__(self, metrics):
+		BetterResource.__init__(self)
+		self._metrics = metrics
+
+
+	def render_GET(self, request):
+		setNoCacheNoStoreHeaders(request)
+		request.setHeader('content-type', 'text/plain; version=0.0.4')
+		return self._metrics.asPrometheusText()
 
 
 
@@ -678,47 +1079,735 @@ class ConnectionTrackingHTTPChannel(_BetterHTTPChannel):
 	An L{HTTPChannel} that tells the factory about all connection
 	activity.
 	"""
+	# The number of requests on this channel that have been received but
+	# not finished.
+	_inFlight = 0
+
+	# Whether this channel is in its site's idle connections (that is, it
+	# finished a request and is waiting for another one).
+	_idle = False
+
+	# The total number of requests received on this channel.
+	_requestCount = 0
+
+	# This channel's position in the order its site's connections were
+	# opened in (starting at 1).
+	_connectionId = 0
+
+	# Whether this channel's connection and disconnection are logged.
+	_logged = False
+
+	# The number of response body bytes written by finished requests.
+	_bytesWritten = 0
+
+	# The number of bytes delivered to the client as of the last slow
+	# client check, or None if nothing was waiting to be sent then.
+	_lastDelivered = None
+
 	def __init__(self, *args, **kwargs):
 		_BetterHTTPChannel.__init__(self, *args, **kwargs)
 
 
 	def connectionMade(self, *args, **kwargs):
 		_BetterHTTPChannel.connectionMade(self, *args, **kwargs)
-		log.msg('Connection made: %r' % (self,))
-		self.factory.connections.add(self)
+		self.factory._channelConnected(self)
+		if self._logged:
+			log.msg('Connection made: %r' % (self,))
 
 
 	def connectionLost(self, *args, **kwargs):
 		_BetterHTTPChannel.connectionLost(self, *args, **kwargs)
-		log.msg('Connection lost: %r' % (self,))
-		self.factory.connections.remove(self)
+		if self._logged:
+			log.msg('Connection lost: %r' % (self,))
+		self.factory._channelDisconnected(self)
+
+
+	def dataReceived(self, data):
+		if self._idle:
+			self.factory._channelBusy(self)
+		_BetterHTTPChannel.dataReceived(self, data)
+
+
+	def allContentReceived(self):
+		# Count the request before it is processed, because it may finish
+		# before allContentReceived returns.
+		self._inFlight += 1
+		self._requestCount += 1
+		self.factory._requestStarted()
+		_BetterHTTPChannel.allContentReceived(self)
+
+
+	def checkPersistence(self, request, version):
+		# A request whose headers were still arriving when the site started
+		# draining would otherwise turn persistence back on.
+		if self.factory.draining:
+			request.responseHeaders.setRawHeaders('connection', ['close'])
+			return False
+		return _BetterHTTPChannel.checkPersistence(self, request, version)
+
+
+	def requestDone(self, request):
+		self._bytesWritten += request.sentLength
+		_BetterHTTPChannel.requestDone(self, request)
+		if self._inFlight > 0:
+			self._inFlight -= 1
+			self.factory._requestFinished()
+		if not self.requests and self.persistent and \
+		not self.transport.disconnecting:
+			self.factory._channelIdle(self)
+
+
+
+class ConnectionLimits(object):
+	__slots__ = ('maxConnections', 'connectionsLowWater', 'maxRequests',
+		'requestsLowWater', 'shedIdle')
+
+	def __init__(self, maxConnections=None, maxRequests=None,
+	connectionsLowWater=None, requestsLowWater=None, shedIdle=False):
+		"""
+		@param maxConnections: Stop accepting connections when there are
+			this many open connections, or C{None} for no limit.  A few
+			more connections than this may be accepted, because the reactor
+			accepts connections in batches.
+
+		@param maxRequests: Stop accepting connections when this many
+			requests are being served, or C{None} for no limit.
+
+		@param connectionsLowWater: Resume accepting connections when
+			there are this many (or fewer) open connections.  Defaults to
+			90% of C{maxConnections}.
+
+		@param requestsLowWater: Resume accepting connections when this
+			many (or fewer) requests are being served.  Defaults to 90% of
+			C{maxRequests}.
+
+		@param shedIdle: If true, when C{maxConnections} is reached, close
+			the connections that have been idle (between keep-alive
+			requests) the longest, to get down to C{connectionsLowWater}.
+		"""
+		if connectionsLowWater is None and maxConnections is not None:
+			connectionsLowWater = int(maxConnections * 0.9)
+		if requestsLowWater is None and maxRequests is not None:
+			requestsLowWater = int(maxRequests * 0.9)
+		assert maxConnections is None or \
+			0 <= connectionsLowWater < maxConnections, \
+			(connectionsLowWater, maxConnections)
+		assert maxRequests is None or \
+			0 <= requestsLowWater < maxRequests, \
+			(requestsLowWater, maxRequests)
+		self.maxConnections = maxConnections
+		self.connectionsLowWater = connectionsLowWater
+		self.maxRequests = maxRequests
+		self.requestsLowWater = requestsLowWater
+		self.shedIdle = shedIdle
+
+
+	def __repr__(self):
+		return '%s(maxConnections=%r, maxRequests=%r, ' \
+			'connectionsLowWater=%r, requestsLowWater=%r, shedIdle=%r)' % (
+				self.__class__.__name__,
+				self.maxConnections, self.maxRequests,
+				self.connectionsLowWater, self.requestsLowWater, self.shedIdle)
+
+
+
+class SlowClientLimits(object):
+	__slots__ = ('maxBufferedBytes', 'minTransferRate', 'checkInterval')
+
+	def __init__(self, maxBufferedBytes=None, minTransferRate=None,
+	checkInterval=5):
+		"""
+		@param maxBufferedBytes: Abort connections that have more than this
+			many bytes written but not yet sent to the client, or C{None}
+			for no limit.
+
+		@param minTransferRate: Abort connections that, while they have
+			bytes waiting to be sent, receive fewer than this many bytes per
+			second (measured over C{checkInterval} seconds), or C{None} for
+			no limit.  Connections that are waiting for the server (for
+			example, a L{special.WaitResource} that hasn't written yet) are
+			never too slow.
+
+		@param checkInterval: How often to check all connections, in
+			seconds.
+		"""
+		assert checkInterval > 0, checkInterval
+		self.maxBufferedBytes = maxBufferedBytes
+		self.minTransferRate = minTransferRate
+		self.checkInterval = checkInterval
+
+
+	def __repr__(self):
+		return '%s(maxBufferedBytes=%r, minTransferRate=%r, ' \
+			'checkInterval=%r)' % (
+				self.__class__.__name__,
+				self.maxBufferedBytes, self.minTransferRate, self.checkInterval)
+
+
+
+# Classes of transports that _getBufferedBytes can't measure, and that
+# have already been logged.
+_unmeasurableTransports = set()
+
+def _getBufferedBytes(transport):
+	"""
+	Return the number of bytes written to C{transport} but not yet sent,
+	or C{None} if that can't be told for this kind of transport.
+
+	This is the one place that reads the private write buffer attributes
+	of L{abstract.FileDescriptor} (C{dataBuffer}, C{offset} and
+	C{_tempDataLen}), which TCP transports and L{DummyTCPTransport} have.
+
+	Protocol wrappers (L{policies.ProtocolWrapper}, and
+	L{TLSMemoryBIOProtocol} for HTTPS) are looked through to the
+	transport they write to, adding any cleartext that TLS is holding
+	back.  Bytes buffered below TLS are encrypted, so they are counted
+	with TLS's small overhead.
+
+	The first time a class of transport that can't be measured is seen,
+	this is logged; slow client detection is skipped for it.
+	"""
+	buffered = 0
+	while True:
+		tls = getattr(transport, 'protocol', None) \
+			if getattr(transport, 'TLS', False) else transport
+		for chunk in getattr(tls, '_appSendBuffer', ()):
+			buffered += len(chunk)
+		if getattr(transport, 'wrappedProtocol', None) is None:
+			break
+		transport = transport.transport
+
+	dataBuffer = getattr(transport, 'dataBuffer', None)
+	if dataBuffer is None:
+		cls = transport.__class__
+		if cls not in _unmeasurableTransports:
+			_unmeasurableTransports.add(cls)
+			log.msg("Can't tell how many bytes are buffered in %s "
+				"transports; not checking them for slow clients" % (
+					reflect.qual(cls),))
+		return None
+	return buffered + len(dataBuffer) - getattr(transport, 'offset', 0) + \
+		getattr(transport, '_tempDataLen', 0)
+
+
+def _abortTransport(transport):
+	if hasattr(transport, 'abortConnection'):
+		transport.abortConnection()
+	else:
+		transport.loseConnection()
 
 
 
 class ConnectionTrackingSite(BetterSite):
+	"""
+	A L{BetterSite} that keeps a set of all open connections in
+	C{.connections}, and aggregated statistics about connections in
+	C{.connectionStats} (a L{stats.ConnectionStats}).
+
+	Connections are not logged individually, unless C{logConnectionsEvery}
+	is given, in which case every Nth connection's connect and disconnect
+	are logged.
+
+	If a L{ConnectionLimits} is passed as C{limits}, it stops accepting
+	connections (on the ports registered with L{addListeningPort}) when
+	there are too many connections or requests in flight, and resumes
+	when both are at or below their low-water marks.
+
+	If a L{SlowClientLimits} is passed as C{slowClientLimits}, connections
+	that buffer too many unsent bytes, or that read their responses too
+	slowly, are aborted.  These are counted in C{slowClientsAborted}.
+
+	Call L{drain} before shutting down, to finish the requests in flight
+	without accepting any new connections or requests.
+	"""
 	protocol = ConnectionTrackingHTTPChannel
 
 	def __init__(self, *args, **kwargs):
+		limits = kwargs.pop('limits', None)
+		logConnectionsEvery = kwargs.pop('logConnectionsEvery', None)
+		slowClientLimits = kwargs.pop('slowClientLimits', None)
 		BetterSite.__init__(self, *args, **kwargs)
 		self.connections = set()
+		# The channels in self.connections in the order they connected,
+		# plus some that have disconnected (dropped in bulk by
+		# _channelDisconnected).  Used by DisplayConnections.
+		self._connectionOrder = []
+		self.connectionStats = ConnectionStats()
+		self._logConnectionsEvery = logConnectionsEvery
+		self.requestsInFlight = 0
+		self.acceptingPaused = False
+		self.draining = False
+		self._limits = limits
+		self._listeningPorts = []
+		# channel -> None, oldest-idle first.  Used only if limits.shedIdle.
+		self._idleConnections = OrderedDict()
+		self._drainDeferred = None
+		self._drainProgressCall = None
+		self._drainTimeoutCall = None
+		self._slowClientLimits = slowClientLimits
+		self._slowClientCall = None
+		self.slowClientsAborted = 0
+
+
+	def addListeningPort(self, port):
+		"""
+		Register C{port} (an L{IListeningPort} that is also an
+		L{IReadDescriptor}, like the return value of C{listenTCP}) as a port
+		that serves this site, so that it can be paused and resumed.
+		"""
+		self._listeningPorts.append(port)
+		if self.acceptingPaused:
+			port.stopReading()
+
+
+	def removeListeningPort(self, port):
+		self._listeningPorts.remove(port)
+
+
+	def _pauseAccepting(self):
+		if not self.acceptingPaused:
+			self.acceptingPaused = True
+			log.msg('%r: pausing accepting connections; %d connections, '
+				'%d requests in flight' % (
+					self, len(self.connections), self.requestsInFlight))
+			for port in self._listeningPorts:
+				port.stopReading()
+
+
+	def _resumeAccepting(self):
+		if self.acceptingPaused and not self.draining:
+			self.acceptingPaused = False
+			log.msg('%r: resuming accepting connections; %d connections, '
+				'%d requests in flight' % (
+					self, len(self.connections), self.requestsInFlight))
+			for port in self._listeningPorts:
+				port.startReading()
+
+
+	def _shedIdleConnections(self, count):
+		idle = self._idleConnections
+		while count > 0 and idle:
+			channel, _ = idle.popitem(last=False)
+			channel._idle = False
+			channel.transport.loseConnection()
+			count -= 1
+
+
+	def _checkHighWater(self):
+		limits = self._limits
+		if limits is None:
+			return
+		nConnections = len(self.connections)
+		if limits.maxConnections is not None and \
+		nConnections >= limits.maxConnections:
+			if limits.shedIdle:
+				self._shedIdleConnections(
+					nConnections - limits.connectionsLowWater)
+			self._pauseAccepting()
+		elif limits.maxRequests is not None and \
+		self.requestsInFlight >= limits.maxRequests:
+			self._pauseAccepting()
+
+
+	def _checkLowWater(self):
+		limits = self._limits
+		if limits is None or not self.acceptingPaused:
+			return
+		if limits.maxConnections is not None and \
+		len(self.connections) > limits.connectionsLowWater:
+			return
+		if limits.maxRequests is not None and \
+		self.requestsInFlight > limits.requestsLowWater:
+			return
+		self._resumeAccepting()
+
+
+	def drain(self, timeout=30, progressInterval=1, progress=None):
+		"""
+		Stop accepting connections, close idle connections, and close the
+		other connections as soon as their requests in flight are done.
+		Connections that are still open after C{timeout} seconds are
+		aborted.
+
+		@param progress: a 2-arg callable that is called every
+			C{progressInterval} seconds with the number of open connections
+			and the number of requests in flight, or C{None} to log them.
+
+		@return: a L{Deferred} that fires with C{None} when all connections
+			are closed.
+		"""
+		if self._drainDeferred is not None:
+			raise RuntimeError("%r is already draining" % (self,))
+		self.draining = True
+		self._drainDeferred = defer.Deferred()
+		if progress is None:
+			progress = self._logDrainProgress
+
+		ports = self._listeningPorts
+		self._listeningPorts = []
+		for port in ports:
+			port.stopListening()
+
+		for channel in list(self.connections):
+			self._closeWhenDone(channel)
+
+		self._drainProgressCall = task.LoopingCall(
+			lambda: progress(len(self.connections), self.requestsInFlight))
+		self._drainProgressCall.clock = self._clock
+		self._drainProgressCall.start(progressInterval)
+		self._drainTimeoutCall = self._clock.callLater(timeout, self._abortAll)
+
+		d = self._drainDeferred
+		self._maybeDrained()
+		return d
+
+
+	def _logDrainProgress(self, connections, requestsInFlight):
+		log.msg('%r: draining; %d connections, %d requests in flight' % (
+			self, connections, requestsInFlight))
+
+
+	def _closeWhenDone(self, channel):
+		if not channel.requests:
+			channel.transport.loseConnection()
+			return
+		# HTTPChannel.requestDone closes non-persistent connections after
+		# the last response.
+		channel.persistent = False
+		for request in channel.requests:
+			if not request.startedWriting:
+				request.responseHeaders.setRawHeaders('connection', ['close'])
+
+
+	def _abortAll(self):
+		self._drainTimeoutCall = None
+		log.msg('%r: drain timed out; aborting %d connections' % (
+			self, len(self.connections)))
+		for channel in list(self.connections):
+			_abortTransport(channel.transport)
+
+
+	def _maybeDrained(self):
+		if self.connections or self._drainDeferred is None or \
+		self._drainDeferred.called:
+			return
+		self._drainProgressCall.stop()
+		self._drainProgressCall = None
+		if self._drainTimeoutCall is not None:
+			self._drainTimeoutCall.cancel()
+			self._drainTimeoutCall = None
+		self._drainDeferred.callback(None)
+
+
+	def _checkSlowClients(self):
+		limits = self._slowClientLimits
+		maxBuffered = limits.maxBufferedBytes
+		minDelivered = None
+		if limits.minTransferRate is not None:
+			minDelivered = limits.minTransferRate * limits.checkInterval
+		for channel in list(self.connections):
+			if not channel.requests and channel._lastDelivered is None:
+				continue
+			transport = channel.transport
+			buffered = _getBufferedBytes(transport)
+			if buffered is None:
+				continue
+			if maxBuffered is not None and buffered > maxBuffered:
+				self._abortSlowClient(channel)
+				continue
+			if minDelivered is None:
+				continue
+			written = channel._bytesWritten
+			for request in channel.requests:
+				written += request.sentLength
+			delivered = written - buffered
+			if channel._lastDelivered is not None and \
+			delivered - channel._lastDelivered < minDelivered:
+				self._abortSlowClient(channel)
+				continue
+			channel._lastDelivered = delivered if buffered else None
+
+
+	def _abortSlowClient(self, channel):
+		self.slowClientsAborted += 1
+		channel._lastDelivered = None
+		_abortTransport(channel.transport)
+
+
+	def _channelConnected(self, channel):
+		self.connections.add(channel)
+		self._connectionOrder.append(channel)
+		stats = self.connectionStats
+		stats.connectionOpened()
+		channel._connectionId = stats.opened
+		channel._connectedAt = self._clock.seconds()
+		if self._logConnectionsEvery and \
+		stats.opened % self._logConnectionsEvery == 0:
+			channel._logged = True
+		if self._slowClientLimits is not None and self._slowClientCall is None:
+			self._slowClientCall = task.LoopingCall(self._checkSlowClients)
+			self._slowClientCall.clock = self._clock
+			self._slowClientCall.start(
+				self._slowClientLimits.checkInterval, now=False)
+		if self.draining:
+			self._closeWhenDone(channel)
+			return
+		self._checkHighWater()
+
+
+	def _channelDisconnected(self, channel):
+		self.connections.remove(channel)
+		connections = self.connections
+		if len(self._connectionOrder) > 2 * len(connections) + 64:
+			self._connectionOrder = [
+				c for c in self._connectionOrder if c in connections]
+		self.connectionStats.connectionClosed(
+			self._clock.seconds() - channel._connectedAt, channel._requestCount)
+		if channel._idle:
+			channel._idle = False
+			del self._idleConnections[channel]
+		if channel._inFlight:
+			self.requestsInFlight -= channel._inFlight
+			channel._inFlight = 0
+		if not self.connections and self._slowClientCall is not None:
+			self._slowClientCall.stop()
+			self._slowClientCall = None
+		if self.draining:
+			self._maybeDrained()
+		else:
+			self._checkLowWater()
+
+
+	def _channelIdle(self, channel):
+		if self._limits is not None and self._limits.shedIdle:
+			channel._idle = True
+			self._idleConnections[channel] = None
+
+
+	def _channelBusy(self, channel):
+		channel._idle = False
+		del self._idleConnections[channel]
+
+
+	def _requestStarted(self):
+		self.requestsInFlight += 1
+		self._checkHighWater()
+
+
+	def _requestFinished(self):
+		self.requestsInFlight -= 1
+		self._checkLowWater()
+
+
+
+def _getConnectionState(channel):
+	if channel.requests:
+		return 'busy'
+	elif channel._requestCount:
+		return 'idle'
+	else:
+		return 'new'
+
+
+def _describePeer(channel):
+	peer = channel.transport.getPeer()
+	host = getattr(peer, 'host', None)
+	if host is None:
+		return str(peer)
+	return '%s:%s' % (host, peer.port)
 
 
 
 class DisplayConnections(BetterResource):
 	"""
-	Display a list of all connections connected to this server.
-	You might not need this, because ConnectionTrackingHTTPChannel
-	emits log messages.
+	Display the connections connected to a L{ConnectionTrackingSite}, as
+	JSON, with summary statistics.
+
+	Query arguments:
+
+	*	C{peer}: only include connections whose "host:port" starts with
+		this string.
+
+	*	C{state}: only include connections in this state: "new" (no request
+		received yet), "busy" (a request is being received or served), or
+		"idle" (waiting for another keep-alive request).
+
+	*	C{minAge}, C{maxAge}: only include connections that have been open
+		for at least/at most this many seconds.
+
+	*	C{offset}, C{limit}: skip the first C{offset} matching connections,
+		and include at most C{limit} (default 100, maximum 1000).  If
+		C{"more"} in the output is true, there are more matching
+		connections.  Connections are listed in the order they were
+		opened, so that pages are consistent from one request to the next
+		(apart from connections that opened or closed in between).
+
+	*	C{format}: "json" (the default) or "html".
+
+	The connections are scanned in batches (with a L{task.Cooperator}), so
+	that a request does not block the reactor on a server with many
+	connections.
 	"""
 	isLeaf = True
-	def render_GET(self, request):
-		conns = repr(request.channel.factory.connections)
-		out = """\
+
+	defaultLimit = 100
+	maxLimit = 1000
+	batchSize = 500
+
+	def __init__(self, cooperator=None):
+		"""
+		@param cooperator: a L{task.Cooperator} used to scan the
+			connections, or C{None} to use the global one.
+		"""
+		BetterResource.__init__(self)
+		if cooperator is None:
+			self._cooperate = task.cooperate
+		else:
+			self._cooperate = cooperator.cooperate
+
+
+	def _parseFilters(self, request):
+		args = request.args
+		def get(name, convert, default=None):
+			try:
+				value = args[name][0]
+			except (KeyError, IndexError):
+				return default
+			return convert(value)
+
+		filters = {
+			'peer': get('peer', str),
+			'state': get('state', str),
+			'minAge': get('minAge', float),
+			'maxAge': get('maxAge', float),
+			'offset': get('offset', int, 0),
+			'limit': get('limit', int, self.defaultLimit),
+			'format': get('format', str, 'json'),
+		}
+		if filters['state'] not in (None, 'new', 'busy', 'idle'):
+			raise ValueError("state must be new, busy, or idle")
+		if filters['format'] not in ('json', 'html'):
+			raise ValueError("format must be json or html")
+		if filters['offset'] < 0 or not 0 <= filters['limit'] <= self.maxLimit:
+			raise ValueError("need offset >= 0 and 0 <= limit <= %d" % (
+				self.maxLimit,))
+		return filters
+
+
+	def _scan(self, channels, connections, filters, now, matched):
+		"""
+		A generator that appends the channels that match C{filters} to
+		C{matched}, yielding every C{batchSize} channels.  It stops after
+		finding one more channel than needed, to tell whether there are
+		more results.
+		"""
+		peer = filters['peer']
+		state = filters['state']
+		minAge = filters['minAge']
+		maxAge = filters['maxAge']
+		wanted = filters['offset'] + filters['limit'] + 1
+		for n, channel in enumerate(channels):
+			if n and n % self.batchSize == 0:
+				yield None
+			# A channel may have disconnected while we were yielding.
+			if channel not in connections:
+				continue
+			if state is not None and _getConnectionState(channel) != state:
+				continue
+			age = now - channel._connectedAt
+			if minAge is not None and age < minAge:
+				continue
+			if maxAge is not None and age > maxAge:
+				continue
+			if peer is not None and not _describePeer(channel).startswith(peer):
+				continue
+			matched.append(channel)
+			if len(matched) >= wanted:
+				return
+
+
+	def _describe(self, channel, now):
+		return {
+			'id': channel._connectionId,
+			'peer': _describePeer(channel),
+			'age': now - channel._connectedAt,
+			'state': _getConnectionState(channel),
+			'requests': channel._requestCount,
+			'inFlight': channel._inFlight,
+		}
+
+
+	def _getSummary(self, site):
+		return {
+			'connections': len(site.connections),
+			'requestsInFlight': site.requestsInFlight,
+			'acceptingPaused': site.acceptingPaused,
+			'draining': site.draining,
+			'slowClientsAborted': site.slowClientsAborted,
+			'stats': site.connectionStats.asDict(),
+		}
+
+
+	def _write(self, request, site, filters, now, matched):
+		offset = filters['offset']
+		limit = filters['limit']
+		more = len(matched) > offset + limit
+		page = matched[offset:offset + limit]
+		if filters['format'] == 'html':
+			out = """\
 <pre>
 %s
 </pre>
-""" % (cgi.escape(conns),)
-		return out
+""" % (cgi.escape('\n'.join(repr(c) for c in page)),)
+		else:
+			request.responseHeaders.setRawHeaders(
+				'content-type', ['application/json'])
+			out = json.dumps({
+				'summary': self._getSummary(site),
+				'offset': offset,
+				'limit': limit,
+				'more': more,
+				'connections': [self._describe(c, now) for c in page],
+			})
+		request.write(out)
+		request.finish()
+
+
+	def _scanFailed(self, f, request):
+		if f.check(task.TaskStopped):
+			# The client went away.
+			return
+		log.err(f, "%r: error listing connections" % (self,))
+		if not request.startedWriting:
+			request.setResponseCode(500)
+		request.finish()
+
+
+	def render_GET(self, request):
+		site = request.channel.factory
+		setNoCacheNoStoreHeaders(request)
+		try:
+			filters = self._parseFilters(request)
+		except ValueError, e:
+			request.setResponseCode(400)
+			request.responseHeaders.setRawHeaders(
+				'content-type', ['text/plain; charset=UTF-8'])
+			return 'Bad request: %s\n' % (e,)
+
+		now = site._clock.seconds()
+		matched = []
+		# Copy the list, because it may change while we are scanning it.
+		# It is already in connection order, so pages are stable without
+		# sorting.
+		channels = site._connectionOrder[:]
+		scanTask = self._cooperate(self._scan(
+			channels, site.connections, filters, now, matched))
+		request.notifyFinish().addErrback(lambda _: scanTask.stop())
+		d = scanTask.whenDone()
+		d.addCallback(
+			lambda _: self._write(request, site, filters, now, matched))
+		d.addErrback(self._scanFailed, request)
+		return server.NOT_DONE_YET
 
 
 
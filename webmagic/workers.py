@@ -0,0 +1,413 @@
+"""
+Run several worker processes that serve the same L{server.Site} on one
+listening socket, so that a site can use more than one CPU core.
+
+A L{Supervisor} either creates the listening socket and passes it to each
+worker as an inherited file descriptor, or (with reusePort=True) has each
+worker bind its own socket with SO_REUSEPORT.  Workers are started with
+C{python -m webmagic.workers}, and they periodically report their health
+and connection counts to the supervisor as JSON lines on stdout.
+
+A site factory is given as the fully-qualified name of a 0-arg callable that
+returns a L{server.Site}, for example C{"myapp.site.makeSite"}.  If the
+site is a L{untwist.ConnectionTrackingSite}, the workers also report the
+number of open connections and requests in flight.
+"""
+
+import os
+import sys
+import json
+import signal
+import socket
+import optparse
+
+from twisted.internet import defer, error, protocol, task
+from twisted.python import log
+from twisted.python.reflect import namedAny
+
+_postImportVars = vars().keys()
+
+
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if _SO_REUSEPORT is None and sys.platform.startswith('linux'):
+	_SO_REUSEPORT = 15
+
+# The file descriptor number at which workers inherit the listening socket.
+INHERITED_FD = 3
+
+
+def _makeSocket(interface, port, reusePort):
+	if reusePort and _SO_REUSEPORT is None:
+		raise RuntimeError("SO_REUSEPORT is not available on this platform")
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reusePort:
+		sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+	sock.bind((interface, port))
+	return sock
+
+
+def listenReusePort(reactor, port, factory, interface='', backlog=50):
+	"""
+	Like C{reactor.listenTCP}, but set SO_REUSEPORT on the socket, so that
+	several processes can listen on the same port.
+
+	@return: an L{IListeningPort}.
+	"""
+	sock = _makeSocket(interface, port, True)
+	try:
+		sock.listen(backlog)
+		sock.setblocking(False)
+		return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+	finally:
+		# adoptStreamPort duplicated the file descriptor.
+		sock.close()
+
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+	"""
+	Receives health reports from one worker process.
+	"""
+	def __init__(self, supervisor, generation):
+		self.supervisor = supervisor
+		self.generation = generation
+		self.pid = None
+		self.lastReport = None
+		self.lastReportAt = None
+		self.stopping = False
+		self.exited = defer.Deferred()
+		self._buffer = ''
+
+
+	def connectionMade(self):
+		self.pid = self.transport.pid
+
+
+	def outReceived(self, data):
+		lines = (self._buffer + data).split('\n')
+		self._buffer = lines.pop()
+		for line in lines:
+			try:
+				report = json.loads(line)
+			except ValueError:
+				log.msg('Worker %r wrote a bad report: %r' % (self.pid, line))
+			else:
+				self.lastReport = report
+				self.lastReportAt = self.supervisor._reactor.seconds()
+
+
+	def errReceived(self, data):
+		for line in data.rstrip('\n').split('\n'):
+			log.msg('Worker %r: %s' % (self.pid, line))
+
+
+	def processEnded(self, reason):
+		self.supervisor._workerEnded(self, reason)
+		self.exited.callback(None)
+
+
+	def __repr__(self):
+		return '<%s pid=%r generation=%r stopping=%r>' % (
+			self.__class__.__name__, self.pid, self.generation, self.stopping)
+
+
+
+class Supervisor(object):
+	"""
+	Starts, restarts, and monitors worker processes serving one site.
+	Workers that exit unexpectedly are replaced.
+	"""
+	def __init__(self, siteFactoryName, workers, port, interface='127.0.0.1',
+	reusePort=False, backlog=50, reportInterval=1.0, stopTimeout=30,
+	reactor=None, executable=sys.executable, env=None):
+		"""
+		@param siteFactoryName: a C{str}, the fully-qualified name of a
+			0-arg callable that returns a L{server.Site}.  It is called in
+			each worker.
+
+		@param workers: the number of worker processes to run.
+
+		@param port: the TCP port to listen on, or 0 to pick one.  After
+			L{start}, C{.port} is the actual port.
+
+		@param reusePort: If true, each worker binds its own socket with
+			SO_REUSEPORT, instead of inheriting the supervisor's socket.
+			Note that with SO_REUSEPORT, connections still in an exiting
+			worker's accept queue are reset.
+
+		@param reportInterval: how often, in seconds, workers send reports.
+
+		@param stopTimeout: the maximum number of seconds that a stopping
+			worker waits for its connections to drain.
+
+		@param env: the environment for worker processes, or C{None} to
+			use this process's environment, with C{sys.path} as the
+			C{PYTHONPATH}.
+		"""
+		if reactor is None:
+			from twisted.internet import reactor
+		if env is None:
+			env = os.environ.copy()
+			env['PYTHONPATH'] = os.pathsep.join(sys.path)
+		self.siteFactoryName = siteFactoryName
+		self.workers = workers
+		self.port = port
+		self.interface = interface
+		self.reusePort = reusePort
+		self.backlog = backlog
+		self.reportInterval = reportInterval
+		self.stopTimeout = stopTimeout
+		self._reactor = reactor
+		self._executable = executable
+		self._env = env
+		self._socket = None
+		self._generation = 0
+		self._running = False
+		self._processes = []
+
+
+	def start(self):
+		"""
+		Bind the socket and start the workers.
+		"""
+		assert not self._running
+		self._running = True
+		# With reusePort, keep a bound (but not listening) socket, so that
+		# the port stays reserved for workers.
+		self._socket = _makeSocket(self.interface, self.port, self.reusePort)
+		if not self.reusePort:
+			self._socket.listen(self.backlog)
+			# Workers require a non-blocking socket.  This flag is shared
+			# by every process that has the socket.
+			self._socket.setblocking(False)
+		self.port = self._socket.getsockname()[1]
+		self._spawnAll()
+
+
+	def _workerArgs(self):
+		args = [self._executable, '-m', 'webmagic.workers',
+			'--site', self.siteFactoryName,
+			'--report-interval', str(self.reportInterval),
+			'--stop-timeout', str(self.stopTimeout)]
+		if self.reusePort:
+			args += ['--reuse-port', str(self.port),
+				'--interface', self.interface,
+				'--backlog', str(self.backlog)]
+		else:
+			args += ['--fd', str(INHERITED_FD)]
+		return args
+
+
+	def _spawn(self, generation):
+		proto = _WorkerProtocol(self, generation)
+		childFDs = {0: 'w', 1: 'r', 2: 'r'}
+		if not self.reusePort:
+			childFDs[INHERITED_FD] = self._socket.fileno()
+		self._reactor.spawnProcess(
+			proto, self._executable, self._workerArgs(), env=self._env,
+			childFDs=childFDs)
+		self._processes.append(proto)
+		return proto
+
+
+	def _spawnAll(self):
+		self._generation += 1
+		for i in xrange(self.workers):
+			self._spawn(self._generation)
+
+
+	def _stopProcesses(self, processes):
+		ds = []
+		for proto in processes:
+			ds.append(proto.exited)
+			if not proto.stopping:
+				proto.stopping = True
+				try:
+					proto.transport.signalProcess('TERM')
+				except (OSError, error.ProcessExitedAlready):
+					pass
+		return defer.DeferredList(ds)
+
+
+	def restart(self):
+		"""
+		Gracefully restart all workers: start a new set of workers, then
+		tell the old workers to stop accepting connections and exit when
+		their requests in flight are done.
+
+		@return: a L{Deferred} that fires when all of the old workers
+			have exited.
+		"""
+		assert self._running
+		old = [p for p in self._processes if not p.stopping]
+		self._spawnAll()
+		return self._stopProcesses(old)
+
+
+	def stop(self):
+		"""
+		Gracefully stop all workers and close the socket.
+
+		@return: a L{Deferred} that fires when all workers have exited.
+		"""
+		self._running = False
+		d = self._stopProcesses(self._processes[:])
+		def closeSocket(_):
+			if self._socket is not None:
+				self._socket.close()
+				self._socket = None
+		d.addCallback(closeSocket)
+		return d
+
+
+	def _workerEnded(self, proto, reason):
+		self._processes.remove(proto)
+		if not proto.stopping:
+			log.msg('Worker %r exited unexpectedly: %s' % (proto, reason.value))
+			if self._running:
+				self._spawn(proto.generation)
+
+
+	def getWorkerReports(self):
+		"""
+		@return: a C{list} of C{dict}s, one for each running worker, with
+			keys C{"pid"}, C{"healthy"} (whether the worker has reported
+			within the last 3 report intervals), C{"stopping"}, and
+			C{"report"} (the last report from the worker, or C{None}).
+		"""
+		now = self._reactor.seconds()
+		reports = []
+		for proto in self._processes:
+			healthy = proto.lastReportAt is not None and \
+				now - proto.lastReportAt <= 3 * self.reportInterval
+			reports.append({
+				'pid': proto.pid,
+				'healthy': healthy,
+				'stopping': proto.stopping,
+				'report': proto.lastReport,
+			})
+		return reports
+
+
+	def getConnectionCount(self):
+		"""
+		@return: the total number of open connections across all workers,
+			as of their last reports.
+		"""
+		total = 0
+		for proto in self._processes:
+			if proto.lastReport is not None:
+				total += proto.lastReport.get('connections') or 0
+		return total
+
+
+
+class _Worker(object):
+	"""
+	The worker side: serves the site and reports to the supervisor.
+	"""
+	def __init__(self, reactor, site, port, reportInterval, stopTimeout,
+	out=sys.stdout):
+		self._reactor = reactor
+		self._site = site
+		self._port = port
+		self._stopTimeout = stopTimeout
+		self._out = out
+		self._stopping = False
+		self._reportCall = task.LoopingCall(self.report)
+		self._reportCall.clock = reactor
+		self._reportCall.start(reportInterval)
+
+
+	def report(self):
+		site = self._site
+		connections = getattr(site, 'connections', None)
+		self._out.write(json.dumps({
+			'pid': os.getpid(),
+			'stopping': self._stopping,
+			'connections': None if connections is None else len(connections),
+			'requestsInFlight': getattr(site, 'requestsInFlight', None),
+		}) + '\n')
+		self._out.flush()
+
+
+	def stop(self):
+		"""
+		Stop accepting connections, then stop the reactor.  If the site
+		supports L{untwist.ConnectionTrackingSite.drain}, first drain it
+		for up to C{stopTimeout} seconds, sending a report to the
+		supervisor every report interval.
+		"""
+		if self._stopping:
+			return
+		self._stopping = True
+		if hasattr(self._site, 'drain'):
+			d = self._site.drain(self._stopTimeout,
+				progressInterval=self._reportCall.interval,
+				progress=lambda connections, requestsInFlight: self.report())
+		else:
+			d = defer.maybeDeferred(self._port.stopListening)
+		def stopReactor(_):
+			self._reportCall.stop()
+			self.report()
+			self._reactor.stop()
+		d.addCallback(stopReactor)
+
+
+
+def _parseArgs(argv):
+	parser = optparse.OptionParser(
+		usage="python -m webmagic.workers --site SITE_FACTORY "
+			"(--fd FD | --reuse-port PORT)")
+	parser.add_option('--site', help="fully-qualified name of a 0-arg "
+		"callable that returns a Site")
+	parser.add_option('--fd', type='int', help="inherited listening socket")
+	parser.add_option('--reuse-port', type='int', dest='reusePort',
+		help="port to bind with SO_REUSEPORT")
+	parser.add_option('--interface', default='')
+	parser.add_option('--backlog', type='int', default=50)
+	parser.add_option('--report-interval', type='float', default=1.0,
+		dest='reportInterval')
+	parser.add_option('--stop-timeout', type='float', default=30,
+		dest='stopTimeout')
+	options, args = parser.parse_args(argv)
+	if not options.site or (options.fd is None) == (options.reusePort is None):
+		parser.error("need --site and exactly one of --fd or --reuse-port")
+	return options
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	options = _parseArgs(argv)
+
+	from twisted.internet import reactor
+
+	log.startLogging(sys.stderr, setStdout=False)
+	site = namedAny(options.site)()
+	if options.fd is not None:
+		port = reactor.adoptStreamPort(options.fd, socket.AF_INET, site)
+		os.close(options.fd)
+	else:
+		port = listenReusePort(reactor, options.reusePort, site,
+			options.interface, options.backlog)
+	if hasattr(site, 'addListeningPort'):
+		site.addListeningPort(port)
+
+	worker = _Worker(reactor, site, port,
+		options.reportInterval, options.stopTimeout)
+	def installHandler():
+		signal.signal(signal.SIGTERM,
+			lambda signum, frame: reactor.callFromThread(worker.stop))
+	reactor.callWhenRunning(installHandler)
+	reactor.run()
+
+
+try: from refbinder.api import bindRecursive
+except ImportError: pass
+else: bindRecursive(sys.modules[__name__], _postImportVars)
+
+
+if __name__ == '__main__':
+	main()